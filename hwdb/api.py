@@ -0,0 +1,267 @@
+"""
+Author: Benjamin Arbogast
+
+Read-only JSON API for Parts, attributes, AttrTypes and Units.
+
+The lists are paged with keysets instead of offsets: every page contains the
+cursor "next" (the sort key of its last row), which is passed as parameter
+"after" to get the following page. So the cost of a page doesn't depend on
+its position in the list. "next" is null on the last page.
+
+Parameters of all lists:
+ - limit: number of rows per page (default 100, at most 1000)
+ - after: the cursor of the previous page
+ - fields: comma separated list of the fields to return (default: all)
+"""
+
+from collections import OrderedDict
+import base64
+import json
+
+from flask import Blueprint, abort, jsonify, request
+from sqlalchemy import and_, or_, select
+
+import hwdb.model as M
+from hwdb import search as search_module
+
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def _encode_cursor(sort_value, id):
+    data = json.dumps([sort_value, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        sort_value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).
+                                    decode('utf-8'))
+        return sort_value, int(id)
+    except (ValueError, TypeError):
+        abort(400, 'Invalid cursor %r' % cursor)
+
+
+def _get_int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, 'Parameter %s must be an integer' % name)
+
+
+def _get_float_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        abort(400, 'Parameter %s must be a number' % name)
+
+
+def _get_fields(fields):
+    """ Returns the names of the fields requested by the parameter fields """
+    if not request.args.get('fields'):
+        return list(fields)
+    names = [name.strip() for name in request.args['fields'].split(',')]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        abort(400, 'Unknown fields: %s' % ', '.join(unknown))
+    return names
+
+
+def _after(sort_column, id_column, sort_value, last_id):
+    """ Condition for the rows following the key (sort_value, last_id) """
+    if sort_value is None:
+        # NULL is sorted first
+        return or_(sort_column!=None,
+                   and_(sort_column==None, id_column > last_id))
+    # Written this way the index on sort_column is used
+    return and_(sort_column >= sort_value,
+                or_(sort_column > sort_value, id_column > last_id))
+
+
+def query_page(query, sort_column, id_column, after=None, limit=DEFAULT_LIMIT):
+    """
+    Returns query limited to one page ordered by sort_column, id_column.
+    after is the key (sort value, id) of the last row of the previous page.
+    """
+    if after is not None:
+        query = query.filter(_after(sort_column, id_column, *after))
+    return query.order_by(sort_column, id_column).limit(limit)
+
+
+def _page(key, query, fields, sort_column, id_column):
+    """
+    Returns the JSON response with one page of query (ordered by sort_column,
+    id_column).
+    fields: OrderedDict field name => column of the query
+    """
+    names = _get_fields(fields)
+    limit = min(max(_get_int_arg('limit', DEFAULT_LIMIT), 1), MAX_LIMIT)
+    after = None
+    if request.args.get('after'):
+        after = _decode_cursor(request.args['after'])
+
+    # One additional row tells whether there is a next page
+    rows = query_page(query.with_entities(sort_column, id_column,
+                                          *[fields[name] for name in names]),
+                      sort_column, id_column, after, limit + 1).\
+        all()
+
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = _encode_cursor(rows[-1][0], rows[-1][1])
+    items = [dict(zip(names, row[2:])) for row in rows]
+    return jsonify(**{key: items, 'next': cursor})
+
+
+@bp.route('/parts')
+def parts():
+    """
+    Filters:
+     - parent: id of the parent Part
+     - attr_type: name of an AttrType assigned to the Parts
+     - standard: name of a standard supported by the Parts
+     - attr, min, max: name of an AttrType and the range its numeric value
+       has to be in (min or max can be left out)
+    """
+    fields = OrderedDict([
+        ('id', M.Part.id),
+        ('name', M.Part.name),
+        ('note', M.Part.note),
+        ('parent_part_id', M.Part.parent_part_id),
+        ('is_standard', M.Part.is_standard),
+        ('is_connector', M.Part.is_connector),
+        ('is_system', M.Part.is_system),
+    ])
+    query = M.db_session.query(M.Part)
+
+    parent_part_id = _get_int_arg('parent')
+    if parent_part_id is not None:
+        query = query.filter(M.Part.parent_part_id==parent_part_id)
+    if 'attr_type' in request.args:
+        part_ids = select([M.PartAttrTypeMap.part_id]).\
+            where(and_(M.PartAttrTypeMap.attr_type_id==M.AttrType.id,
+                       M.AttrType.name==request.args['attr_type']))
+        query = query.filter(M.Part.id.in_(part_ids))
+    if 'standard' in request.args:
+        standard = M.Part.__table__.alias('standard')
+        part_ids = select([M.PartConnection.contained_part_id]).\
+            where(and_(M.PartConnection.container_part_id==standard.c.id,
+                       standard.c.is_standard==True,
+                       standard.c.name==request.args['standard']))
+        query = query.filter(M.Part.id.in_(part_ids))
+    if 'attr' in request.args:
+        attrs = M.db_session.query(M.Attr.id).join(M.AttrType).\
+            filter(and_(M.AttrType.name==request.args['attr'],
+                        M.Attr.range_condition(_get_float_arg('min'),
+                                               _get_float_arg('max'))))
+        part_ids = select([M.PartAttrMap.part_id]).\
+            where(M.PartAttrMap.attr_id.in_(attrs.subquery()))
+        query = query.filter(M.Part.id.in_(part_ids))
+
+    return _page('parts', query, fields, M.Part.name, M.Part.id)
+
+
+@bp.route('/search')
+def search():
+    """
+    Parametric search for Parts, parameter q is the search query, i.e.
+    /api/search?q=Vendor=Intel and L2 cache>=512 and supports SSE2
+    With the parameter inherited the attributes of the parent Parts match
+    too. See hwdb.search for the query language.
+    """
+    try:
+        condition = search_module.compile_query(request.args.get('q', ''),
+                                                'inherited' in request.args)
+    except ValueError as e:
+        abort(400, str(e))
+    fields = OrderedDict([
+        ('id', M.Part.id),
+        ('name', M.Part.name),
+        ('parent_part_id', M.Part.parent_part_id),
+    ])
+    query = M.db_session.query(M.Part).filter(condition)
+    return _page('parts', query, fields, M.Part.name, M.Part.id)
+
+
+@bp.route('/attributes')
+def attributes():
+    """
+    Ordered by value.
+    Filters:
+     - attr_type: name of the AttrType
+     - value: the exact value
+     - part: id of a Part having the attributes
+    """
+    fields = OrderedDict([
+        ('id', M.Attr.id),
+        ('value', M.Attr.value),
+        ('value_from', M.Attr.value_from),
+        ('value_to', M.Attr.value_to),
+        ('attr_type_id', M.Attr.attr_type_id),
+        ('attr_type', M.AttrType.name),
+    ])
+    query = M.db_session.query(M.Attr).join(M.AttrType)
+
+    if 'attr_type' in request.args:
+        query = query.filter(M.AttrType.name==request.args['attr_type'])
+    if 'value' in request.args:
+        query = query.filter(M.Attr.value==request.args['value'])
+    part_id = _get_int_arg('part')
+    if part_id is not None:
+        attr_ids = select([M.PartAttrMap.attr_id]).\
+            where(M.PartAttrMap.part_id==part_id)
+        query = query.filter(M.Attr.id.in_(attr_ids))
+
+    return _page('attributes', query, fields, M.Attr.value, M.Attr.id)
+
+
+@bp.route('/attr_types')
+def attr_types():
+    """
+    Filters:
+     - unit: name of the Unit
+     - part: id of a Part the AttrTypes are assigned to
+    """
+    fields = OrderedDict([
+        ('id', M.AttrType.id),
+        ('name', M.AttrType.name),
+        ('note', M.AttrType.note),
+        ('from_to', M.AttrType.from_to),
+        ('multi_value', M.AttrType.multi_value),
+        ('unit_id', M.AttrType.unit_id),
+        ('unit', M.Unit.name),
+    ])
+    query = M.db_session.query(M.AttrType).join(M.Unit)
+
+    if 'unit' in request.args:
+        query = query.filter(M.Unit.name==request.args['unit'])
+    part_id = _get_int_arg('part')
+    if part_id is not None:
+        attr_type_ids = select([M.PartAttrTypeMap.attr_type_id]).\
+            where(M.PartAttrTypeMap.part_id==part_id)
+        query = query.filter(M.AttrType.id.in_(attr_type_ids))
+
+    return _page('attr_types', query, fields, M.AttrType.name, M.AttrType.id)
+
+
+@bp.route('/units')
+def units():
+    fields = OrderedDict([
+        ('id', M.Unit.id),
+        ('name', M.Unit.name),
+        ('label', M.Unit.label),
+        ('format', M.Unit.format),
+        ('note', M.Unit.note),
+    ])
+    query = M.db_session.query(M.Unit)
+    return _page('units', query, fields, M.Unit.name, M.Unit.id)
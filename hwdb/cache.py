@@ -0,0 +1,160 @@
+"""
+Author: Benjamin Arbogast
+
+Cache for rendered HTML fragments (the trees of /parts, /standards and
+/combinations).
+Every fragment is stored together with the versions of the tables it was
+rendered from (see model.get_table_versions). A fragment is only returned if
+the versions didn't change, so every flush changing one of the tables
+invalidates it.
+
+The validators of conditional requests (ETag, Last-Modified) are computed
+from the same versions, see get_etag and get_last_modified.
+"""
+
+from collections import OrderedDict
+import hashlib
+import io
+import math
+import os
+import tempfile
+import threading
+import time
+
+import six
+
+
+class FragmentCache(object):
+    """
+    LRU cache name => (version, fragment) keeping one version per fragment.
+    If a directory is given, the fragments are also written to it and survive
+    restarts of the application.
+    A FragmentCache is shared by the threads serving requests, the entries and
+    counters are only accessed with the lock held.
+    """
+    def __init__(self, max_size=100, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._fragments)
+
+
+    def _get_path(self, name):
+        return os.path.join(self.directory,
+                            hashlib.sha1(name.encode('utf-8')).hexdigest() + '.html')
+
+
+    def _load(self, name, version):
+        try:
+            with io.open(self._get_path(name), encoding='utf-8') as f:
+                if f.readline().rstrip('\n') != repr(version):
+                    return None
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+
+    def _store(self, name, version, fragment):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first, concurrent readers never see a
+        # partially written fragment
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(repr(version)) + '\n')
+            f.write(fragment)
+        os.rename(tmp_path, self._get_path(name))
+
+
+    def get(self, name, version):
+        """ Returns the fragment or None if it's missing or outdated """
+        with self._lock:
+            entry = self._fragments.get(name)
+            if entry is not None and entry[0] == version:
+                self._fragments[name] = self._fragments.pop(name)
+                self.hits += 1
+                return entry[1]
+
+        fragment = None
+        if self.directory is not None:
+            fragment = self._load(name, version)
+        with self._lock:
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._set(name, version, fragment)
+        return fragment
+
+
+    def _set(self, name, version, fragment):
+        """ Stores the entry, the lock has to be held """
+        self._fragments.pop(name, None)
+        self._fragments[name] = (version, fragment)
+        while len(self._fragments) > self.max_size:
+            self._fragments.popitem(last=False)
+
+
+    def set(self, name, version, fragment):
+        fragment = six.text_type(fragment)
+        with self._lock:
+            self._set(name, version, fragment)
+        if self.directory is not None:
+            self._store(name, version, fragment)
+
+
+    def get_or_render(self, name, version, render):
+        """
+        Returns the cached fragment or calls render() and caches its result
+        (converted to text).
+        """
+        fragment = self.get(name, version)
+        if fragment is None:
+            fragment = six.text_type(render())
+            self.set(name, version, fragment)
+        return fragment
+
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+
+def get_etag(url, table_names, versions):
+    """ Returns the ETag of url for the versions of the given tables """
+    key = [url] + [versions[table_name] for table_name in table_names]
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def get_last_modified(versions, now=None):
+    """
+    Returns the Last-Modified (unix timestamp in whole seconds) for the
+    versions: the time of the last change rounded up.
+    Returns None while that second isn't over, a later change within it
+    would get the same Last-Modified and the client would keep a stale copy.
+    """
+    changed_at = max([0.0] + [changed_at for version, changed_at in versions.values()])
+    last_modified = int(math.ceil(changed_at))
+    if last_modified > (time.time() if now is None else now):
+        return None
+    return last_modified
+
+
+def is_not_modified(etag, last_modified, if_none_match=None, if_modified_since=None):
+    """
+    Tells whether the copy of the client is still valid. if_none_match is a
+    function returning whether an ETag matches, if_modified_since a unix
+    timestamp. If-None-Match takes precedence.
+    """
+    if if_none_match is not None:
+        return if_none_match(etag)
+    if if_modified_since is not None and last_modified is not None:
+        return last_modified <= if_modified_since
+    return False
@@ -0,0 +1,473 @@
+"""
+Author: Benjamin Arbogast
+
+Full-text search for Parts. Every Part is indexed as a document with the
+fields
+ - name: Part.name
+ - note: Part.note
+ - attrs: the names of the AttrTypes of the Part (attributes and
+   PartAttrTypeMaps) and the values of its text attributes
+The words of the search text are matched as prefixes, all of them have to
+match. The results are ranked with a matching name weighted highest.
+
+With SQLite the index is the FTS5 table part_fts, created with the other
+tables by create_all. It's updated within the transaction with the Parts
+changed by its flushes, before the commit or before a search (see
+update_pending_index).
+Without FTS5 (or with other databases) an in-memory index per engine is used,
+which is shared by all threads and rebuilt when the tables were changed by
+another process (see model.table_version). The changes of a transaction are
+applied to it after the commit. Until then a search of the transaction uses
+a private copy of the index with the changes applied.
+"""
+
+from collections import defaultdict
+import bisect
+import math
+import re
+import threading
+import weakref
+
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Session
+
+import hwdb.model as M
+
+
+FIELDS = ('name', 'note', 'attrs')
+# Weights of the fields for the ranking
+FIELD_WEIGHTS = {'name': 10.0, 'note': 1.0, 'attrs': 2.0}
+# Units of the attributes whose values are indexed
+TEXT_UNITS = ('text', 'json')
+# Tables whose changes can change the indexed documents
+TABLES = ('part', 'attr', 'attr_type', 'unit', 'part_attr_map', 'part_attr_type_map')
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _tokenize(value):
+    return _WORD_RE.findall(value.lower()) if value else []
+
+
+def load_documents(connection, part_ids=None):
+    """
+    Returns a dict part id => dict field => text for the given Parts
+    (default: all) with three queries
+    """
+    part = M.Part.__table__
+    attr = M.Attr.__table__
+    attr_type = M.AttrType.__table__
+    unit = M.Unit.__table__
+    attr_map = M.PartAttrMap.__table__
+    attr_type_map = M.PartAttrTypeMap.__table__
+
+    def _where(query, column):
+        return query if part_ids is None else query.where(column.in_(part_ids))
+
+    docs = {}
+    attrs = defaultdict(list)
+    for row in connection.execute(_where(select([part.c.id, part.c.name, part.c.note]),
+                                         part.c.id)):
+        docs[row.id] = {'name': row.name, 'note': row.note or ''}
+    for row in connection.execute(_where(
+            select([attr_map.c.part_id, attr_type.c.name, attr.c.value,
+                    unit.c.name.label('unit_name')]).
+                select_from(attr_map.join(attr).join(attr_type).join(unit)),
+            attr_map.c.part_id)):
+        attrs[row.part_id].append(row.name)
+        if row.unit_name in TEXT_UNITS and row.value:
+            attrs[row.part_id].append(row.value)
+    for row in connection.execute(_where(
+            select([attr_type_map.c.part_id, attr_type.c.name]).
+                select_from(attr_type_map.join(attr_type)),
+            attr_type_map.c.part_id)):
+        attrs[row.part_id].append(row.name)
+
+    for part_id, doc in docs.items():
+        doc['attrs'] = ' '.join(attrs[part_id])
+    return docs
+
+
+class _Fts5Index(object):
+    """ The index in the SQLite FTS5 table part_fts """
+    def update(self, connection, part_ids):
+        part_ids = list(part_ids)
+        for i in range(0, len(part_ids), 500):
+            chunk = part_ids[i:i + 500]
+            connection.execute(text('DELETE FROM part_fts WHERE rowid IN (%s)' %
+                                    ', '.join(str(int(part_id)) for part_id in chunk)))
+            self._insert(connection, load_documents(connection, chunk))
+
+    def rebuild(self, connection):
+        connection.execute(text('DELETE FROM part_fts'))
+        self._insert(connection, load_documents(connection))
+
+    def _insert(self, connection, docs):
+        if docs:
+            connection.execute(
+                text('INSERT INTO part_fts (rowid, name, note, attrs) '
+                     'VALUES (:id, :name, :note, :attrs)'),
+                [dict(doc, id=part_id) for part_id, doc in docs.items()])
+
+    def search(self, connection, words, limit, offset):
+        # Every word is a quoted prefix query, FTS5 combines them with AND
+        query = ' '.join('"%s"*' % word for word in words)
+        weights = ', '.join(str(FIELD_WEIGHTS[field]) for field in FIELDS)
+        rows = connection.execute(
+            text('SELECT rowid FROM part_fts WHERE part_fts MATCH :query '
+                 'ORDER BY bm25(part_fts, %s), rowid LIMIT :limit OFFSET :offset' % weights),
+            query=query, limit=limit, offset=offset)
+        return [row[0] for row in rows]
+
+
+class _MemoryIndex(object):
+    """
+    Inverted index word => {part id: weight} with the words kept sorted for
+    prefix lookups. The documents are only read and changed with the lock
+    held, the queries run outside of it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.versions = None
+        self._docs = {}
+        self._postings = defaultdict(dict)
+        self._words = []
+        self._words_sorted = True
+
+    def copy(self):
+        index = _MemoryIndex()
+        with self._lock:
+            index.versions = self.versions
+            index._docs = dict(self._docs)
+            index._postings = defaultdict(dict, ((word, dict(postings))
+                                                 for word, postings in self._postings.items()))
+            index._words = list(self._words)
+            index._words_sorted = self._words_sorted
+        return index
+
+    def _remove(self, part_id):
+        for word in self._docs.pop(part_id, ()):
+            postings = self._postings[word]
+            postings.pop(part_id, None)
+            if not postings:
+                del self._postings[word]
+                self._words_sorted = False
+
+    def _add(self, part_id, doc):
+        weights = defaultdict(float)
+        for field in FIELDS:
+            for word in _tokenize(doc[field]):
+                weights[word] += FIELD_WEIGHTS[field]
+        for word, weight in weights.items():
+            if word not in self._postings:
+                self._words_sorted = False
+            self._postings[word][part_id] = weight
+        self._docs[part_id] = list(weights)
+
+    def update(self, connection, part_ids):
+        if self.versions is None:
+            # Built on the next search
+            return
+        self.apply(part_ids, load_documents(connection, list(part_ids)),
+                   M.get_table_versions(TABLES, connection))
+
+    def apply(self, part_ids, docs, versions, base_versions=None):
+        """
+        Replaces the documents of the Parts by docs (part id => document, a
+        missing one is removed) and sets the versions. With base_versions
+        only if the index is at them, otherwise it's built again on the
+        next search.
+        """
+        with self._lock:
+            if self.versions is None:
+                return
+            if base_versions is not None and self.versions != base_versions:
+                self.versions = None
+                return
+            for part_id in part_ids:
+                self._remove(part_id)
+                if part_id in docs:
+                    self._add(part_id, docs[part_id])
+            self.versions = versions
+
+    def invalidate(self):
+        """ The index is built again on the next search """
+        with self._lock:
+            self.versions = None
+
+    def rebuild(self, connection):
+        docs = load_documents(connection)
+        versions = M.get_table_versions(TABLES, connection)
+        with self._lock:
+            self._reset()
+            for part_id, doc in docs.items():
+                self._add(part_id, doc)
+            self.versions = versions
+
+    def search(self, connection, words, limit, offset):
+        # Another process changed the database
+        if self.versions != M.get_table_versions(TABLES, connection):
+            self.rebuild(connection)
+        with self._lock:
+            return self._search(words, limit, offset)
+
+    def _search(self, words, limit, offset):
+        if not self._words_sorted:
+            self._words = sorted(self._postings)
+            self._words_sorted = True
+
+        scores = None
+        for word in words:
+            # All indexed words starting with word
+            word_scores = defaultdict(float)
+            i = bisect.bisect_left(self._words, word)
+            while i < len(self._words) and self._words[i].startswith(word):
+                postings = self._postings[self._words[i]]
+                idf = math.log(1 + float(len(self._docs)) / len(postings))
+                for part_id, weight in postings.items():
+                    word_scores[part_id] += weight * idf
+                i += 1
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = dict((part_id, score + word_scores[part_id])
+                              for part_id, score in scores.items() if part_id in word_scores)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [part_id for part_id, score in ranked[offset:offset + limit]]
+
+
+# engine => index
+_indexes = weakref.WeakKeyDictionary()
+
+
+def _has_fts5(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    try:
+        return bool(connection.execute(
+            text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+    except Exception:
+        return False
+
+
+def _has_fts_table(connection):
+    return bool(connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='part_fts'")).scalar())
+
+
+def _get_index(connection):
+    engine = connection.engine
+    index = _indexes.get(engine)
+    if index is None:
+        use_fts5 = _has_fts5(connection) and _has_fts_table(connection)
+        index = _indexes[engine] = _Fts5Index() if use_fts5 else _MemoryIndex()
+    return index
+
+
+@event.listens_for(M.Base.metadata, 'after_create')
+def _create_fts_table(metadata, connection, **kwargs):
+    """ Creates (and fills) the table part_fts if FTS5 is available """
+    if not _has_fts5(connection) or _has_fts_table(connection):
+        return
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE part_fts USING fts5(%s, prefix='2 3')" % ', '.join(FIELDS)))
+    _indexes.pop(connection.engine, None)
+    _get_index(connection).rebuild(connection)
+
+
+def rebuild_index(connection=None):
+    """
+    Indexes all Parts again, needed after the database was changed without
+    the ORM (bulk inserts). The in-memory index would include the uncommitted
+    changes, it's rebuilt on the next search instead.
+    """
+    if connection is None:
+        connection = M.db_session.connection()
+    index = _get_index(connection)
+    if isinstance(index, _MemoryIndex):
+        index.invalidate()
+    else:
+        index.rebuild(connection)
+
+
+def update_index(part_ids, connection=None):
+    """
+    Indexes the given Parts again (removes the deleted ones), needed after
+    they were changed without the ORM. Like in rebuild_index the in-memory
+    index is rebuilt on the next search instead.
+    """
+    if connection is None:
+        connection = M.db_session.connection()
+    index = _get_index(connection)
+    if isinstance(index, _MemoryIndex):
+        index.invalidate()
+    else:
+        index.update(connection, set(part_ids))
+
+
+def search(value, limit=20, offset=0):
+    """
+    Returns the Parts matching all words of value as prefixes, the best
+    matches first
+    """
+    words = _tokenize(value)
+    if not words:
+        return []
+    update_pending_index()
+    connection = M.db_session.connection()
+    index = M.db_session.info.get('fulltext_index') or _get_index(connection)
+    part_ids = index.search(connection, words, limit, offset)
+    parts = dict((part.id, part) for part in
+                 M.db_session.query(M.Part).filter(M.Part.id.in_(part_ids)))
+    return [parts[part_id] for part_id in part_ids if part_id in parts]
+
+
+def _get_changed_part_ids(session):
+    """ Returns the ids of the Parts whose documents might have changed """
+    part_ids = set()
+    attr_ids = []
+    attr_type_ids = []
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(obj, M.Part):
+            part_ids.add(obj.id)
+        elif isinstance(obj, (M.PartAttrMap, M.PartAttrTypeMap)):
+            part_ids.add(obj.part_id)
+            part_ids.update(M.get_history(obj, 'part_id').sum())
+        elif isinstance(obj, M.Attr) and obj not in session.new:
+            attr_ids.append(obj.id)
+        elif isinstance(obj, M.AttrType) and obj not in session.new:
+            attr_type_ids.append(obj.id)
+
+    connection = session.connection()
+    if attr_ids:
+        part_ids.update(row[0] for row in connection.execute(
+            select([M.PartAttrMap.part_id]).where(M.PartAttrMap.attr_id.in_(attr_ids))))
+    if attr_type_ids:
+        attr_map = M.PartAttrMap.__table__
+        part_ids.update(row[0] for row in connection.execute(
+            select([attr_map.c.part_id]).
+                select_from(attr_map.join(M.Attr.__table__)).
+                where(M.Attr.attr_type_id.in_(attr_type_ids))))
+        part_ids.update(row[0] for row in connection.execute(
+            select([M.PartAttrTypeMap.part_id]).
+                where(M.PartAttrTypeMap.attr_type_id.in_(attr_type_ids))))
+    part_ids.discard(None)
+    return part_ids
+
+
+def _get_memory_index(session):
+    """ Returns the in-memory index of the engine of session if there is one """
+    index = _indexes.get(session.connection().engine)
+    return index if isinstance(index, _MemoryIndex) else None
+
+
+@event.listens_for(Session, 'before_flush')
+def _record_versions(session, flush_context, instances):
+    """
+    Records the versions before the first flush of the transaction in
+    session.info['fulltext_versions']. Its changes are only applied to the
+    in-memory index if it's still at them (see _MemoryIndex.apply).
+    """
+    if 'fulltext_versions' not in session.info and _get_memory_index(session) is not None:
+        session.info['fulltext_versions'] = M.get_table_versions(TABLES, session)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    """
+    Records the Parts to index again in session.info['fulltext_changes']
+    """
+    part_ids = _get_changed_part_ids(session)
+    if part_ids:
+        session.info.setdefault('fulltext_changes', set()).update(part_ids)
+
+
+def _get_private_index(session, connection, index):
+    """
+    Returns the copy of the in-memory index with the changes of the
+    transaction in session.info['fulltext_index']
+    """
+    private_index = session.info.get('fulltext_index')
+    if private_index is None:
+        if index.versions is not None and \
+                index.versions == session.info.get('fulltext_versions'):
+            private_index = index.copy()
+        else:
+            private_index = _MemoryIndex()
+            private_index.rebuild(connection)
+        session.info['fulltext_index'] = private_index
+    return private_index
+
+
+def update_pending_index(session=None):
+    """
+    Flushes the session (default: db_session) and indexes the Parts changed
+    in the current transaction (in the private copy of an in-memory index).
+    Runs before every search.
+    """
+    session = session or M.db_session
+    session.flush()
+    part_ids = session.info.pop('fulltext_changes', None)
+    if not part_ids:
+        return
+    connection = session.connection()
+    index = _get_index(connection)
+    if isinstance(index, _MemoryIndex):
+        # Applied to the shared index after the commit
+        session.info.setdefault('fulltext_indexed', set()).update(part_ids)
+        _get_private_index(session, connection, index).update(connection, part_ids)
+    else:
+        index.update(connection, part_ids)
+
+
+def _pop_pending(session):
+    session.info.pop('fulltext_index', None)
+    part_ids = session.info.pop('fulltext_changes', set())
+    part_ids.update(session.info.pop('fulltext_indexed', ()))
+    return part_ids, session.info.pop('fulltext_versions', None)
+
+
+@event.listens_for(Session, 'before_commit')
+def _update_index(session):
+    """
+    Updates the FTS5 table, or loads the documents to apply to the in-memory
+    index after the commit (it has to hold committed documents only)
+    """
+    session.flush()
+    if not session.info.get('fulltext_changes') and not session.info.get('fulltext_indexed'):
+        _pop_pending(session)
+        return
+    connection = session.connection()
+    index = _get_index(connection)
+    if not isinstance(index, _MemoryIndex):
+        update_pending_index(session)
+        return
+    part_ids, base_versions = _pop_pending(session)
+    if index.versions is not None:
+        session.info['fulltext_commit'] = (
+            index, part_ids, load_documents(connection, list(part_ids)),
+            M.get_table_versions(TABLES, connection), base_versions)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_to_memory_index(session):
+    pending = session.info.pop('fulltext_commit', None)
+    if pending is None:
+        return
+    index, part_ids, docs, versions, base_versions = pending
+    if base_versions is None:
+        # The index was created during the transaction
+        index.invalidate()
+    else:
+        index.apply(part_ids, docs, versions, base_versions)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    """ The in-memory index only holds committed documents, nothing to undo """
+    _pop_pending(session)
+    session.info.pop('fulltext_commit', None)
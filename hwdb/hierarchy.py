@@ -0,0 +1,136 @@
+"""
+Author: Benjamin Arbogast
+
+Query builders for the Part hierarchy (Part.parent_part) using recursive
+common table expressions (WITH RECURSIVE). A whole tree is fetched with one
+query and returned as flat rows with the columns depth and path. Works with
+SQLite (>= 3.8.3) and PostgreSQL (order the trees by sort_order(), not by the
+column sort_key).
+
+For simple ancestor/descendant lookups of a single Part see also the closure
+table (Part.query_ancestors, Part.query_descendants).
+"""
+
+from sqlalchemy import Integer, Text, and_, cast, func, literal_column, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.sql.util import ClauseAdapter
+
+import hwdb.model as M
+
+
+# Separators used in sort_key. They sort before any printable character when
+# compared byte-wise (see sort_order), so a Part is ordered before its
+# children and siblings are ordered by name.
+_NAME_END = '\x01'
+_SEGMENT_END = '\x02'
+# Number of digits of the ids in sort_key, they are zero-padded to sort
+# numerically
+_ID_DIGITS = 10
+
+
+class _bytewise(FunctionElement):
+    """ Its text argument compared byte-wise """
+    type = Text()
+    name = 'bytewise'
+
+
+@compiles(_bytewise)
+def _compile_bytewise(element, compiler, **kwargs):
+    # SQLite compares text with memcmp (collation BINARY) by default
+    return compiler.process(element.clauses, **kwargs)
+
+
+@compiles(_bytewise, 'postgresql')
+def _compile_bytewise_postgresql(element, compiler, **kwargs):
+    # The usual collations of PostgreSQL ignore control characters
+    return '%s COLLATE "C"' % compiler.process(element.clauses, **kwargs)
+
+
+def _text(expr):
+    # Both parts of a recursive CTE must have the same column types in
+    # PostgreSQL
+    return cast(expr, Text)
+
+
+def _zero():
+    return literal_column('0', Integer)
+
+
+def _padded_id(part):
+    padded = literal_column("'%s'" % ('0' * _ID_DIGITS), Text) + _text(part.c.id)
+    return func.substr(padded, func.length(padded) - (_ID_DIGITS - 1))
+
+
+def _sort_segment(part):
+    return _text(part.c.name) + _NAME_END + _padded_id(part) + _SEGMENT_END
+
+
+def sort_order(tree):
+    """ The expression to order a tree of part_descendants depth-first """
+    return _bytewise(tree.c.sort_key)
+
+
+def _adapt(condition, alias):
+    """ Rewrites a condition on the table part to the given alias """
+    if condition is None:
+        return True
+    return ClauseAdapter(alias).traverse(condition)
+
+
+def part_descendants(root_condition=None, condition=None, name='part_tree'):
+    """
+    Returns a recursive CTE with the Parts matching root_condition (default:
+    Parts without parent) and all their descendants.
+    condition is applied on every level: a Part not matching it is left out
+    together with its subtree. Both conditions are expressions on Part, i.e.
+    M.Part.is_standard==False.
+    Columns:
+     - id, parent_part_id, name
+     - depth: 0 for the roots
+     - path: the ids from the root to the Part, i.e. '1/5/9'
+     - sort_key: ordering by sort_order(tree) returns the Parts depth-first
+       with the siblings ordered by name (and id)
+    """
+    part = M.Part.__table__
+    child = part.alias('child')
+    if root_condition is None:
+        root_condition = part.c.parent_part_id==None
+
+    tree = select([part.c.id, part.c.parent_part_id, part.c.name,
+                   _zero().label('depth'),
+                   _text(part.c.id).label('path'),
+                   _sort_segment(part).label('sort_key')]).\
+        where(and_(root_condition, _adapt(condition, part))).\
+        cte(name, recursive=True)
+    return tree.union_all(
+        select([child.c.id, child.c.parent_part_id, child.c.name,
+                tree.c.depth + 1,
+                tree.c.path + '/' + _text(child.c.id),
+                tree.c.sort_key + _sort_segment(child)]).
+        where(and_(child.c.parent_part_id==tree.c.id,
+                   _adapt(condition, child))))
+
+
+def part_ancestors(part_id, name='part_ancestors'):
+    """
+    Returns a recursive CTE with the Part with the given id and all its
+    parents.
+    Columns:
+     - id, parent_part_id, name
+     - depth: 0 for the given Part, 1 for its parent, ...
+     - path: the ids from the given Part to the ancestor, i.e. '9/5/1'
+    """
+    part = M.Part.__table__
+    parent = part.alias('parent')
+
+    tree = select([part.c.id, part.c.parent_part_id, part.c.name,
+                   _zero().label('depth'),
+                   _text(part.c.id).label('path')]).\
+        where(part.c.id==part_id).\
+        cte(name, recursive=True)
+    return tree.union_all(
+        select([parent.c.id, parent.c.parent_part_id, parent.c.name,
+                tree.c.depth + 1,
+                tree.c.path + '/' + _text(parent.c.id)]).
+        where(parent.c.id==tree.c.parent_part_id))
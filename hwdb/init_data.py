@@ -473,7 +473,13 @@ def add_objects_computer_alt():
 '''
 
 
+from collections import OrderedDict
+
+import six
+from sqlalchemy import select
+
 from hwdb import data
+from hwdb import fulltext
 from hwdb import treetools
 
 
@@ -484,6 +490,7 @@ def import_units():
 
 def import_attr_types():
     for d in data.attr_types:
+        d = dict(d)
         unit = M.Unit.search(d.pop('unit'))
         M.AttrType(unit=unit, **d)
 
@@ -562,3 +569,188 @@ def import_systems():
         _import(system_parent, system_parent, system_dict['<children>'])
 
 
+
+
+class BulkImporter(object):
+    """
+    Imports element trees (see treetools.inflate_tree) like _import() but
+    without the ORM: Parts, AttrTypes and Attrs are looked up with one query
+    per table up front, the new rows are collected in memory and add() can be
+    called for multiple trees. write() then inserts the rows with one
+    executemany per table in dependency order.
+    New Parts and Attrs are inserted by add() one by one, their ids are
+    assigned by the database and needed by the other rows.
+    """
+    def __init__(self, connection=None):
+        self.connection = connection or M.db_session.connection()
+        part = M.Part.__table__
+        attr = M.Attr.__table__
+
+        # name => list of ids, in the order of the ids
+        self.part_ids = {}
+        for part_id, name in self.connection.execute(
+                select([part.c.id, part.c.name]).order_by(part.c.id)):
+            self.part_ids.setdefault(name, []).append(part_id)
+
+        self.attr_type_ids = {}
+        # id => (unit name, unit format, from_to) to parse the numeric values
+        self.attr_type_units = {}
+        for row in self.connection.execute(
+                select([M.AttrType.id, M.AttrType.name, M.AttrType.from_to,
+                        M.Unit.name.label('unit_name'), M.Unit.format]).
+                    select_from(M.AttrType.__table__.join(M.Unit.__table__))):
+            self.attr_type_ids.setdefault(row.name, []).append(row.id)
+            self.attr_type_units[row.id] = (row.unit_name, row.format, row.from_to)
+
+        # (attr_type_id, value) => id
+        self.attr_ids = dict(
+            ((attr_type_id, value), attr_id) for attr_id, attr_type_id, value
+            in self.connection.execute(select([attr.c.id, attr.c.attr_type_id, attr.c.value])))
+        self.attr_type_maps = set(tuple(row) for row in self.connection.execute(
+            select([M.PartAttrTypeMap.part_id, M.PartAttrTypeMap.attr_type_id])))
+        self.attr_maps = set(tuple(row) for row in self.connection.execute(
+            select([M.PartAttrMap.part_id, M.PartAttrMap.attr_id])))
+
+        # Names of the tables add() inserted into
+        self.inserted_table_names = set()
+        # id of a new Part => list of (ancestor id, depth)
+        self._ancestors = {}
+        # id of a new Part => set of allowed AttrType ids
+        self._allowed_attr_type_ids = {}
+        # table => list of row dicts, in the order in which they are inserted
+        self.rows = OrderedDict((table, []) for table in (
+            M.part_closure, M.PartAttrTypeMap.__table__, M.PartAttrMap.__table__,
+            M.PartConnection.__table__))
+
+    def _insert(self, table, row):
+        """ Inserts the row, returns the id assigned by the database """
+        self.inserted_table_names.add(table.name)
+        return self.connection.execute(table.insert(), row).inserted_primary_key[0]
+
+    def _search(self, ids_by_name, cls, name):
+        """ Returns the id for the name, like cls.search() """
+        ids = ids_by_name.get(name)
+        if not ids:
+            raise Exception('No %s found with name %r' % (cls.__name__, name))
+        if len(ids) > 1:
+            raise Exception('Multiple %ss found with name %r' % (cls.__name__, name))
+        return ids[0]
+
+    def _get_or_add_part(self, name, note, parent_id, is_standard=False, is_connector=False):
+        """ Like _get_or_add_part() but returns the id of the Part """
+        if name in self.part_ids:
+            return self.part_ids[name][0]
+
+        part_id = self._insert(M.Part.__table__, dict(
+            name=name, note=note, parent_part_id=parent_id,
+            is_standard=is_standard, is_connector=is_connector, is_system=False))
+        self.part_ids[name] = [part_id]
+
+        ancestors = [(part_id, 0)]
+        if parent_id is not None:
+            ancestors.extend((ancestor_id, depth + 1)
+                             for ancestor_id, depth in self._get_ancestors(parent_id))
+        self._ancestors[part_id] = ancestors
+        self.rows[M.part_closure].extend(
+            dict(ancestor_id=ancestor_id, descendant_id=part_id, depth=depth)
+            for ancestor_id, depth in ancestors)
+        self._allowed_attr_type_ids[part_id] = set()
+        return part_id
+
+    def _get_ancestors(self, part_id):
+        if part_id not in self._ancestors:
+            self._ancestors[part_id] = [tuple(row) for row in self.connection.execute(
+                select([M.part_closure.c.ancestor_id, M.part_closure.c.depth]).
+                where(M.part_closure.c.descendant_id==part_id))]
+        return self._ancestors[part_id]
+
+    def _is_allowed(self, part_id, attr_type_id):
+        for ancestor_id, depth in self._get_ancestors(part_id):
+            if ancestor_id in self._allowed_attr_type_ids:
+                allowed_ids = self._allowed_attr_type_ids[ancestor_id]
+            else:
+                allowed_ids = M.get_attr_type_resolver().get_allowed_attr_type_ids(ancestor_id)
+            if attr_type_id in allowed_ids:
+                return True
+        return False
+
+    def _add_attr_type(self, part_id, attr_type_name):
+        attr_type_id = self._search(self.attr_type_ids, M.AttrType, attr_type_name)
+        if (part_id, attr_type_id) in self.attr_type_maps:
+            return
+        self.attr_type_maps.add((part_id, attr_type_id))
+        self.rows[M.PartAttrTypeMap.__table__].append(
+            dict(part_id=part_id, attr_type_id=attr_type_id))
+        # The mapping isn't in the database yet, existing Parts need it too
+        self._allowed_attr_type_ids.setdefault(
+            part_id, set(M.get_attr_type_resolver().get_allowed_attr_type_ids(part_id))).\
+            add(attr_type_id)
+
+    def _add_attribute(self, part_id, part_name, attr_type_name, value):
+        attr_type_id = self._search(self.attr_type_ids, M.AttrType, attr_type_name)
+        if not self._is_allowed(part_id, attr_type_id):
+            raise Exception('AttrType %s is not registered for %s' % (attr_type_name, part_name))
+
+        value = six.text_type(value)
+        attr_id = self.attr_ids.get((attr_type_id, value))
+        if attr_id is None:
+            unit_name, unit_format, from_to = self.attr_type_units[attr_type_id]
+            value_from, value_to = M.parse_numeric_value(value, unit_name, unit_format,
+                                                         from_to)
+            attr_id = self.attr_ids[(attr_type_id, value)] = self._insert(
+                M.Attr.__table__, dict(attr_type_id=attr_type_id, value=value,
+                                       value_from=value_from, value_to=value_to))
+        if (part_id, attr_id) not in self.attr_maps:
+            self.attr_maps.add((part_id, attr_id))
+            self.rows[M.PartAttrMap.__table__].append(dict(part_id=part_id, attr_id=attr_id))
+
+    def add(self, elements, parent_id=None, **part_kwargs):
+        """ Adds the rows for the elements and their children """
+        for el_dict in elements:
+            name = el_dict.pop('<name>')
+            part_id = self._get_or_add_part(name, el_dict.pop('<note>', None),
+                                            parent_id, **part_kwargs)
+
+            for attr_type_name in el_dict.pop('<attr_types>', []):
+                self._add_attr_type(part_id, attr_type_name)
+            for attr_type_name, value in six.iteritems(el_dict.pop('<attrs>', {})):
+                self._add_attribute(part_id, name, attr_type_name, value)
+            for standard_name in el_dict.pop('<standards>', []):
+                standard_id = self._search(self.part_ids, M.Part, standard_name)
+                self.rows[M.PartConnection.__table__].append(dict(
+                    container_part_id=standard_id, contained_part_id=part_id,
+                    parent_part_id=None, quantity=1))
+            if '<children>' in el_dict:
+                self.add(el_dict.pop('<children>'), part_id, **part_kwargs)
+
+            assert not el_dict, el_dict
+
+    def write(self):
+        """ Inserts the collected rows, one executemany per table """
+        table_names = sorted(self.inserted_table_names)
+        self.inserted_table_names.clear()
+        for table, rows in six.iteritems(self.rows):
+            if rows:
+                self.connection.execute(table.insert(), rows)
+                table_names.append(table.name)
+            del rows[:]
+        # The ORM events (closure table, effective attributes, full-text
+        # index, caches, table versions) were bypassed
+        if M.PartAttrMap.__table__.name in table_names:
+            M.rebuild_effective_attrs(self.connection)
+        M.bump_table_versions(self.connection, table_names)
+        fulltext.rebuild_index(self.connection)
+        M.clear_session_caches()
+
+
+def bulk_import_parts():
+    """
+    Imports parts, standards, connectors and subparts like the import_*
+    functions, but with a BulkImporter
+    """
+    importer = BulkImporter()
+    importer.add(treetools.inflate_tree(data.parts), None)
+    importer.add(treetools.inflate_tree(data.standards), None, is_standard=True)
+    importer.add(treetools.inflate_tree(data.connectors), None, is_connector=True)
+    importer.add(treetools.inflate_tree(data.subparts), None)
+    importer.write()
@@ -16,12 +16,18 @@ Open questions:
 
 import re
 import os
+import time
+import itertools
+from collections import OrderedDict
 
 import six
+import sqlalchemy
 from sqlalchemy import (Column, Integer, String, ForeignKey, UniqueConstraint,
-                        Boolean, Float, Table, create_engine, and_, event)
+                        Boolean, Float, Table, Index, create_engine, and_, event,
+                        select, literal, func)
 from sqlalchemy.orm import (relationship, backref, sessionmaker, scoped_session,
-                            mapper)
+                            mapper, Session)
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
@@ -46,14 +52,48 @@ class _TableWithNameColMixin(object):
     def search(cls, name):
         """
         Searches a record by the given name. If multiple records with the
-        given name are found, an Exception is raised
+        given name are found, an Exception is raised.
+        The id of the found record is kept in the name cache of the session,
+        so repeated searches for the same name don't query by name again.
         """
-        try:
-            return db_session.query(cls).filter_by(name=name).one()
-        except NoResultFound:
-            raise Exception('No %s found with name %r' % (cls.__name__, name))
-        except MultipleResultsFound:
-            raise Exception('Multiple %ss found with name %r' % (cls.__name__, name))
+        return cls.search_many([name])[0]
+
+    @classmethod
+    def query_by_names(cls, names):
+        """ Returns a query of the records with one of the given names """
+        return db_session.query(cls).filter(cls.name.in_(names))
+
+    @classmethod
+    def search_many(cls, names):
+        """
+        Like search() but for a list of names. Returns the records in the
+        order of the given names. Names which are not in the name cache yet are
+        looked up with one IN query (per 500 names).
+        """
+        ids = get_name_cache(cls=cls)
+        missing = list(set(name for name in names if name not in ids))
+        found = {}
+        for i in range(0, len(missing), 500):
+            for record in cls.query_by_names(missing[i:i + 500]):
+                found.setdefault(record.name, []).append(record)
+        for name in missing:
+            if name not in found:
+                raise Exception('No %s found with name %r' % (cls.__name__, name))
+            if len(found[name]) > 1:
+                raise Exception('Multiple %ss found with name %r' % (cls.__name__, name))
+            ids[name] = found[name][0].id
+
+        # Cached records are usually in the identity map of the session
+        query = db_session.query(cls)
+        records = []
+        for name in names:
+            record = found[name][0] if name in found else query.get(ids[name])
+            if record is None:
+                # Deleted without the ORM, look the name up again
+                del ids[name]
+                record = cls.search_many([name])[0]
+            records.append(record)
+        return records
 
 
 def _convert_camel_to_underscore(s):
@@ -89,13 +129,6 @@ class Unit(_TableWithNameColMixin, Base):
     note = Column(String, nullable=True, unique=False)
 
 
-# Note: this is used to store attributes which were inserted into the
-# database. It is used to access Attr objects before they are commited
-# to the database. This way newly created Attr objects can be shared
-# between different parts before they are inserted. The key for this
-# dict is '%s.%s' % (attr_type.id, value)
-_attr_cache = {}
-
 class Part(_TableWithNameColMixin, Base):
     """
     A Part represents a hardware part or an IT standard.
@@ -116,9 +149,9 @@ class Part(_TableWithNameColMixin, Base):
     mark which Attr Types are allowed for this Part
     """
     __table_args__ = (UniqueConstraint('id', 'parent_part_id'),)
-    parent_part_id = Column(Integer, ForeignKey('part.id'))
+    parent_part_id = Column(Integer, ForeignKey('part.id'), index=True)
     parent_part = relationship('Part', remote_side='Part.id', backref='children')
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     note = Column(String, nullable=True, unique=False)
     is_standard = Column(Boolean, nullable=False, server_default=SERVER_DEFAULT_FALSE)
     is_connector = Column(Boolean, nullable=False, server_default=SERVER_DEFAULT_FALSE)
@@ -149,18 +182,10 @@ class Part(_TableWithNameColMixin, Base):
     def add_attributes(self, attributes):
         for attr_type_name, value in six.iteritems(attributes):
             attr_type = AttrType.search(attr_type_name)
-            if not search_PartAttrTypeMap(self, attr_type):
+            if not get_attr_type_resolver().is_allowed(self, attr_type):
                 raise Exception('AttrType %s is not registered for %s' % (attr_type.name, self.name))
 
-            key = '%s.%s' % (attr_type.id, value)
-            attr = _attr_cache.get(key)
-            if not attr:
-                attr = db_session.query(Attr).\
-                    filter(and_(Attr.attr_type==attr_type, Attr.value==value)).\
-                    first()
-            if not attr:
-                attr = Attr(value=value, attr_type=attr_type)
-                _attr_cache[key] = attr
+            attr = Attr.get_or_add(attr_type, value)
             attr_map = PartAttrMap(part=self, attr=attr)
             self.attr_maps.append(attr_map)
 
@@ -181,11 +206,156 @@ class Part(_TableWithNameColMixin, Base):
         Add the Standards (=Parts) looked up by the given standard names to the
         Part
         """
-        for standard_name in standard_names:
-            standard = Part.search(standard_name)
+        for standard in Part.search_many(standard_names):
             mapping = PartConnection(container_part=standard, contained_part=self)
             self.container_maps.append(mapping)
 
+    def query_ancestors(self, include_self=False):
+        """
+        Returns a query for all parents of this Part (parent, grandparent, ...)
+        ordered from the nearest to the most distant one. Uses the closure
+        table, so the whole chain is fetched with one query.
+        """
+        min_depth = 0 if include_self else 1
+        return db_session.query(Part).\
+            join(part_closure, part_closure.c.ancestor_id==Part.id).\
+            filter(and_(part_closure.c.descendant_id==self.id,
+                        part_closure.c.depth>=min_depth)).\
+            order_by(part_closure.c.depth)
+
+    def query_descendants(self, include_self=False):
+        """
+        Returns a query for all Parts below this Part in the hierarchy
+        (children, grandchildren, ...) ordered by their distance to this Part.
+        """
+        min_depth = 0 if include_self else 1
+        return db_session.query(Part).\
+            join(part_closure, part_closure.c.descendant_id==Part.id).\
+            filter(and_(part_closure.c.ancestor_id==self.id,
+                        part_closure.c.depth>=min_depth)).\
+            order_by(part_closure.c.depth)
+
+
+    def query_effective_attrs(self):
+        """
+        Returns a query of (Attr, source_part_id) tuples: the attributes of
+        this Part including the ones inherited from its ancestors (see
+        effective_attr). source_part_id is the id of the Part the attribute
+        is taken from.
+        """
+        refresh_pending_effective_attrs()
+        return db_session.query(Attr, effective_attr.c.source_part_id).\
+            join(effective_attr, effective_attr.c.attr_id==Attr.id).\
+            filter(effective_attr.c.part_id==self.id).\
+            order_by(effective_attr.c.depth)
+
+
+    @classmethod
+    def query_by_attr_range(cls, attr_type, min_value=None, max_value=None):
+        """
+        Returns a query for the Parts with an attribute of the AttrType
+        (object or name) whose numeric value is in the range, see
+        Attr.range_condition. Example: CPUs with 2000 to 3000 MHz:
+        Part.query_by_attr_range('Frequency', 2000, 3000)
+        """
+        attrs = Attr.query_range(attr_type, min_value, max_value).\
+            with_entities(Attr.id)
+        part_ids = select([PartAttrMap.part_id]).\
+            where(PartAttrMap.attr_id.in_(attrs.subquery()))
+        return db_session.query(cls).filter(cls.id.in_(part_ids))
+
+
+# Closure table for the Part hierarchy: contains a row for every pair of a
+# Part and one of its ancestors (including the Part itself with depth 0).
+# The rows are maintained by the mapper events below, so ancestors and
+# subtrees of a Part can be looked up with a single indexed query instead of
+# walking Part.parent_part level by level.
+part_closure = Table('part_closure', Base.metadata,
+    Column('ancestor_id', Integer, ForeignKey(Part.id), primary_key=True),
+    Column('descendant_id', Integer, ForeignKey(Part.id), primary_key=True),
+    Column('depth', Integer, nullable=False),
+    Index('ix_part_closure_descendant_id_depth', 'descendant_id', 'depth'),
+)
+
+
+def _insert_closure_rows(connection, part_id, parent_part_id):
+    """ Links part_id (and its subtree) below parent_part_id """
+    anc = part_closure.alias('anc')
+    desc = part_closure.alias('desc')
+    connection.execute(part_closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select([anc.c.ancestor_id, desc.c.descendant_id,
+                anc.c.depth + desc.c.depth + 1]).
+            where(and_(anc.c.descendant_id==parent_part_id,
+                       desc.c.ancestor_id==part_id))))
+
+
+@event.listens_for(Part, 'after_insert')
+def _part_closure_after_insert(mapper, connection, part):
+    connection.execute(part_closure.insert().values(
+        ancestor_id=part.id, descendant_id=part.id, depth=0))
+    if part.parent_part_id is not None:
+        _insert_closure_rows(connection, part.id, part.parent_part_id)
+
+
+@event.listens_for(Part, 'after_update')
+def _part_closure_after_update(mapper, connection, part):
+    if not get_history(part, 'parent_part_id').has_changes():
+        return
+
+    new_parent_id = part.parent_part_id
+    if new_parent_id is not None:
+        is_descendant = connection.execute(
+            select([part_closure.c.depth]).
+            where(and_(part_closure.c.ancestor_id==part.id,
+                       part_closure.c.descendant_id==new_parent_id))).first()
+        if is_descendant:
+            raise Exception('Part %r can not be moved below its own descendant %r'
+                            % (part.name, new_parent_id))
+
+    # Detach the subtree from its old ancestors ...
+    subtree = select([part_closure.c.descendant_id]).\
+        where(part_closure.c.ancestor_id==part.id)
+    connection.execute(part_closure.delete().where(and_(
+        part_closure.c.descendant_id.in_(subtree),
+        ~part_closure.c.ancestor_id.in_(subtree))))
+    # ... and attach it to the new ones
+    if new_parent_id is not None:
+        _insert_closure_rows(connection, part.id, new_parent_id)
+
+
+@event.listens_for(Part, 'after_delete')
+def _part_closure_after_delete(mapper, connection, part):
+    connection.execute(part_closure.delete().where(
+        (part_closure.c.ancestor_id==part.id) |
+        (part_closure.c.descendant_id==part.id)))
+
+
+def rebuild_part_closure(connection=None):
+    """
+    Recreates the closure table from Part.parent_part_id. Needed for databases
+    which were created before the closure table existed. Executes one
+    statement per level of the hierarchy.
+    """
+    if connection is None:
+        connection = db_session.connection()
+    connection.execute(part_closure.delete())
+    connection.execute(part_closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select([Part.id.label('ancestor_id'), Part.id.label('descendant_id'),
+                literal(0)])))
+
+    depth = 0
+    while True:
+        result = connection.execute(part_closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select([part_closure.c.ancestor_id, Part.id, literal(depth + 1)]).
+                where(and_(part_closure.c.descendant_id==Part.parent_part_id,
+                           part_closure.c.depth==depth))))
+        if not result.rowcount:
+            break
+        depth += 1
+
 
 class AttrType(_TableWithNameColMixin, Base):
     """
@@ -194,7 +364,7 @@ class AttrType(_TableWithNameColMixin, Base):
     Examples are 'Bus speed', 'Frequency', 'Release date'.
     TODO: describe the connection with part and from_to/multi_value
     """
-    name = Column(String, nullable=False, unique=False)
+    name = Column(String, nullable=False, unique=False, index=True)
     note = Column(String, nullable=True, unique=False)
     from_to = Column(Boolean, nullable=False, server_default=SERVER_DEFAULT_FALSE)
     multi_value = Column(Boolean, nullable=False, server_default=SERVER_DEFAULT_FALSE)
@@ -232,7 +402,7 @@ class PartAttrTypeMap(Base):
     __table_args__ = (UniqueConstraint('part_id', 'attr_type_id'),)
     part_id = Column(Integer, ForeignKey(Part.id), nullable=False)
     part = relationship(Part, backref='attr_type_maps')
-    attr_type_id = Column(Integer, ForeignKey(AttrType.id), nullable=False)
+    attr_type_id = Column(Integer, ForeignKey(AttrType.id), nullable=False, index=True)
     attr_type = relationship(AttrType, backref='part_maps')
 
     def __unicode__(self):
@@ -248,41 +418,388 @@ class PartConnection(Base):
     Example: 'Socket X' connected with 'CPU Y' belongs to 'PC Z'.
     The column quantity can be used if the same Part is contained multiple times.
     """
-    __table_args__ = (UniqueConstraint('container_part_id', 'contained_part_id', 'parent_part_id'),)
+    __table_args__ = (UniqueConstraint('container_part_id', 'contained_part_id', 'parent_part_id'),
+                      Index('ix_part_connection_parent_part_id_container_part_id',
+                            'parent_part_id', 'container_part_id'))
     container_part_id = Column(Integer, ForeignKey(Part.id), nullable=True)
     container_part = relationship(Part, backref='contained_maps', primaryjoin='Part.id==PartConnection.container_part_id')
-    contained_part_id = Column(Integer, ForeignKey(Part.id), nullable=True)
+    contained_part_id = Column(Integer, ForeignKey(Part.id), nullable=True, index=True)
     contained_part = relationship(Part, backref='container_maps', primaryjoin='Part.id==PartConnection.contained_part_id')
     parent_part_id = Column(Integer, ForeignKey(Part.id))
     parent_part = relationship(Part, backref='part_connection_children', primaryjoin='Part.id==PartConnection.parent_part_id')
     quantity = Column(Integer, nullable=False, server_default='1')
 
 
+# Units whose values are not numbers
+_NON_NUMERIC_UNITS = ('date', 'url', 'text', 'json')
+_BOOL_VALUES = {'1': 1.0, 'yes': 1.0, 'true': 1.0, '0': 0.0, 'no': 0.0, 'false': 0.0}
+# Thousands separated by commas, i.e. 1,200,000
+_NUMBER = r'[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?'
+_NUMBER_RE = re.compile(u'^(%s)$' % _NUMBER)
+_RANGE_RE = re.compile(u'^(%s)\\s*(?:-|\u2013|to)\\s*(%s)$' % (_NUMBER, _NUMBER))
+
+
+def _to_float(number):
+    return float(number.replace(',', ''))
+
+
+def parse_numeric_value(value, unit_name, unit_format=None, from_to=False):
+    """
+    Returns the tuple (value_from, value_to) of floats for the value of an
+    Attr or (None, None) if it isn't numeric. Single values have
+    value_from == value_to, ranges like '1.1-1.5' are only allowed if from_to
+    is set (see AttrType.from_to).
+    The text around the value in unit_format is ignored, i.e. ' MHz' of
+    '%(unit)s MHz'.
+    """
+    if value is None or unit_name in _NON_NUMERIC_UNITS:
+        return None, None
+    value = six.text_type(value).strip()
+
+    if unit_name == 'bool':
+        number = _BOOL_VALUES.get(value.lower())
+        return number, number
+    if unit_name == 'hex':
+        try:
+            number = float(int(value, 16))
+        except ValueError:
+            return None, None
+        return number, number
+
+    if unit_format:
+        prefix, _, suffix = unit_format.partition('%(unit)s')
+        if prefix.strip() and value.startswith(prefix.strip()):
+            value = value[len(prefix.strip()):].strip()
+        if suffix.strip() and value.endswith(suffix.strip()):
+            value = value[:-len(suffix.strip())].strip()
+
+    match = _NUMBER_RE.match(value)
+    if match:
+        number = _to_float(match.group(1))
+        return number, number
+    match = _RANGE_RE.match(value) if from_to else None
+    if match:
+        return _to_float(match.group(1)), _to_float(match.group(2))
+    return None, None
+
+
 class Attr(Base):
     """
     A attr represents an actual attribute of a Part. It is associated with an
     AttrType and a Part and contains the actual value of the attribute.
-    TODO: describe value_to, value_from
+    value_from and value_to contain the numeric value (or range if the
+    AttrType is from_to) parsed from value, see parse_numeric_value. They are
+    set when the Attr is flushed and used for range queries.
     """
-    __table_args__ = (UniqueConstraint('attr_type_id', 'value'),)
+    __table_args__ = (UniqueConstraint('attr_type_id', 'value'),
+                      Index('ix_attr_attr_type_id_value_from', 'attr_type_id', 'value_from'),
+                      Index('ix_attr_attr_type_id_value_to', 'attr_type_id', 'value_to'))
     attr_type_id = Column(Integer, ForeignKey(AttrType.id), nullable=False)
     attr_type = relationship(AttrType, backref='attrs')
-    value = Column(String, nullable=True) # TODO: nullable should be False
+    value = Column(String, nullable=True, index=True) # TODO: nullable should be False
     value_from = Column(Float, nullable=True)
     value_to = Column(Float, nullable=True)
 
     def __unicode__(self):
         return '%s: %s' % (self.attr_type.name, self.value)
 
+    @classmethod
+    def query_by_value(cls, attr_type, value):
+        """ Returns a query of the Attr with the given AttrType and value """
+        return db_session.query(cls).\
+            filter(and_(cls.attr_type==attr_type, cls.value==value))
+
+    @classmethod
+    def get_or_add(cls, attr_type, value):
+        """
+        Returns the Attr with the given AttrType and value. It is looked up in
+        the AttrCache of the session and in the database. If there is none, a
+        new Attr is created.
+        """
+        attr_cache = get_attr_cache()
+        attr = attr_cache.get(attr_type, value)
+        if not attr:
+            attr = cls.query_by_value(attr_type, value).first()
+            if not attr:
+                attr = Attr(value=value, attr_type=attr_type)
+            attr_cache.add(attr)
+        return attr
+
+
+    def update_numeric_value(self):
+        """ Sets value_from and value_to parsed from value """
+        unit = self.attr_type.unit
+        self.value_from, self.value_to = parse_numeric_value(
+            self.value, unit.name, unit.format, self.attr_type.from_to)
+
+
+    @classmethod
+    def range_condition(cls, min_value=None, max_value=None):
+        """
+        Returns the condition for Attrs whose numeric value (or range)
+        overlaps min_value..max_value. One of the limits can be None for a
+        threshold, with both None all numeric Attrs match.
+        """
+        conditions = []
+        if min_value is not None:
+            conditions.append(cls.value_to >= min_value)
+        if max_value is not None:
+            conditions.append(cls.value_from <= max_value)
+        if not conditions:
+            conditions.append(cls.value_from != None)
+        return and_(*conditions)
+
+
+    @classmethod
+    def query_range(cls, attr_type, min_value=None, max_value=None):
+        """
+        Returns a query of the Attrs of the AttrType (object or name) in the
+        range, see range_condition
+        """
+        if isinstance(attr_type, six.string_types):
+            attr_type = AttrType.search(attr_type)
+        return db_session.query(cls).\
+            filter(and_(cls.attr_type_id==attr_type.id,
+                        cls.range_condition(min_value, max_value)))
+
+
+@event.listens_for(Attr, 'before_insert')
+@event.listens_for(Attr, 'before_update')
+def _set_numeric_value(mapper, connection, attr):
+    attr.update_numeric_value()
+
+
+def update_numeric_values(connection=None, attr_type_ids=None):
+    """
+    Parses value_from and value_to again for all Attrs or the Attrs of the
+    given AttrTypes. Needed after the Unit or from_to of an AttrType or the
+    name or format of a Unit changed and for databases created before the
+    values were parsed.
+    Returns the number of updated Attrs.
+    """
+    if connection is None:
+        connection = db_session.connection()
+    attr = Attr.__table__
+    query = select([attr.c.id, attr.c.value, attr.c.value_from, attr.c.value_to,
+                    AttrType.from_to, Unit.name, Unit.format]).\
+        select_from(attr.join(AttrType.__table__).join(Unit.__table__))
+    if attr_type_ids is not None:
+        query = query.where(attr.c.attr_type_id.in_(list(attr_type_ids)))
+
+    rows = []
+    for row in connection.execute(query):
+        value_from, value_to = parse_numeric_value(row.value, row.name, row.format,
+                                                   row.from_to)
+        if (value_from, value_to) != (row.value_from, row.value_to):
+            rows.append(dict(attr_id=row.id, new_value_from=value_from,
+                             new_value_to=value_to))
+    if rows:
+        connection.execute(attr.update().
+                           where(attr.c.id==sqlalchemy.bindparam('attr_id')).
+                           values(value_from=sqlalchemy.bindparam('new_value_from'),
+                                  value_to=sqlalchemy.bindparam('new_value_to')),
+                           rows)
+        bump_table_versions(connection, ['attr'])
+    return len(rows)
+
+
+@event.listens_for(AttrType, 'after_update')
+def _update_numeric_values(mapper, connection, attr_type):
+    if (get_history(attr_type, 'from_to').has_changes() or
+            get_history(attr_type, 'unit_id').has_changes()):
+        update_numeric_values(connection, [attr_type.id])
+
+
+@event.listens_for(Unit, 'after_update')
+def _update_numeric_values_of_unit(mapper, connection, unit):
+    if (get_history(unit, 'name').has_changes() or
+            get_history(unit, 'format').has_changes()):
+        attr_type_ids = [attr_type_id for attr_type_id, in connection.execute(
+            select([AttrType.id]).where(AttrType.unit_id==unit.id))]
+        if attr_type_ids:
+            update_numeric_values(connection, attr_type_ids)
+
 
 class PartAttrMap(Base):
     __table_args__ = (UniqueConstraint('part_id', 'attr_id'),)
     part_id = Column(Integer, ForeignKey(Part.id), nullable=False)
     part = relationship(Part, backref='attr_maps')
-    attr_id = Column(Integer, ForeignKey(Attr.id), nullable=False)
+    attr_id = Column(Integer, ForeignKey(Attr.id), nullable=False, index=True)
     attr = relationship(Attr, backref='part_maps')
 
 
+# The effective attributes of every Part: its own attributes and the ones
+# inherited from its ancestors. For every AttrType the attributes of the
+# nearest Part (the Part itself or the closest ancestor) having attributes of
+# this AttrType are used, so a Part overrides the values of its parents.
+# The rows of the Parts changed by the flushes of a transaction (PartAttrMaps
+# or the Part hierarchy) are refreshed once, before the commit or before they
+# are read (see refresh_pending_effective_attrs).
+effective_attr = Table('effective_attr', Base.metadata,
+    Column('part_id', Integer, ForeignKey(Part.id, ondelete='CASCADE'), primary_key=True),
+    Column('attr_id', Integer, ForeignKey(Attr.id, ondelete='CASCADE'), primary_key=True,
+           index=True),
+    Column('attr_type_id', Integer, ForeignKey(AttrType.id), nullable=False),
+    # The Part the attribute is inherited from and its distance
+    Column('source_part_id', Integer, ForeignKey(Part.id, ondelete='CASCADE'),
+           nullable=False),
+    Column('depth', Integer, nullable=False),
+)
+
+
+def _insert_effective_attr_rows(connection, part_ids=None):
+    """
+    Inserts the effective attributes of the Parts in part_ids (a select of
+    ids, default: all Parts)
+    """
+    attr = Attr.__table__
+    attr_map = PartAttrMap.__table__
+    closure2 = part_closure.alias('closure2')
+    attr2 = attr.alias('attr2')
+    attr_map2 = attr_map.alias('attr_map2')
+
+    # Depth of the nearest Part having attributes of the AttrType
+    nearest_depth = select([func.min(closure2.c.depth)]).\
+        where(and_(closure2.c.descendant_id==part_closure.c.descendant_id,
+                   attr_map2.c.part_id==closure2.c.ancestor_id,
+                   attr2.c.id==attr_map2.c.attr_id,
+                   attr2.c.attr_type_id==attr.c.attr_type_id)).\
+        as_scalar()
+    conditions = [attr_map.c.part_id==part_closure.c.ancestor_id,
+                  attr.c.id==attr_map.c.attr_id,
+                  part_closure.c.depth==nearest_depth]
+    if part_ids is not None:
+        conditions.append(part_closure.c.descendant_id.in_(part_ids))
+
+    connection.execute(effective_attr.insert().from_select(
+        ['part_id', 'attr_id', 'attr_type_id', 'source_part_id', 'depth'],
+        select([part_closure.c.descendant_id, attr.c.id, attr.c.attr_type_id,
+                part_closure.c.ancestor_id, part_closure.c.depth]).
+            where(and_(*conditions))))
+
+
+def refresh_effective_attrs(connection, part_ids, deleted_part_ids=()):
+    """
+    Computes the effective attributes of the given Parts and their
+    descendants again. The rows of deleted Parts are removed.
+    """
+    connection.execute(effective_attr.delete().where(
+        effective_attr.c.part_id.in_(list(deleted_part_ids))))
+    part_ids = list(part_ids)
+    for i in range(0, len(part_ids), 500):
+        subtree_ids = select([part_closure.c.descendant_id]).\
+            where(part_closure.c.ancestor_id.in_(part_ids[i:i + 500]))
+        connection.execute(effective_attr.delete().where(
+            effective_attr.c.part_id.in_(subtree_ids)))
+        _insert_effective_attr_rows(connection, subtree_ids)
+    bump_table_versions(connection, ['effective_attr'])
+
+
+def rebuild_effective_attrs(connection=None):
+    """
+    Rebuilds the table effective_attr from scratch, i.e. after PartAttrMaps
+    were inserted without the ORM
+    """
+    if connection is None:
+        connection = db_session.connection()
+    connection.execute(effective_attr.delete())
+    _insert_effective_attr_rows(connection)
+    bump_table_versions(connection, ['effective_attr'])
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_effective_attr_changes(session, flush_context):
+    """
+    Records the Parts whose effective attributes have to be refreshed in
+    session.info['effective_attr_changes'] (part ids, deleted part ids)
+    """
+    part_ids = set()
+    deleted_part_ids = set()
+    changed_attr_ids = []
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, PartAttrMap):
+            # Old and new Part of the mapping
+            part_ids.update(get_history(obj, 'part_id').sum())
+            part_ids.add(obj.part_id)
+        elif isinstance(obj, Part):
+            if obj in session.deleted:
+                deleted_part_ids.add(obj.id)
+            elif obj in session.new or get_history(obj, 'parent_part_id').has_changes():
+                part_ids.add(obj.id)
+        elif isinstance(obj, Attr) and obj in session.dirty and \
+                get_history(obj, 'attr_type_id').has_changes():
+            changed_attr_ids.append(obj.id)
+
+    connection = session.connection()
+    if changed_attr_ids:
+        part_ids.update(part_id for part_id, in connection.execute(
+            select([PartAttrMap.part_id]).
+                where(PartAttrMap.attr_id.in_(changed_attr_ids))))
+    part_ids.discard(None)
+    part_ids -= deleted_part_ids
+    if part_ids or deleted_part_ids:
+        changed_ids, deleted_ids = session.info.setdefault('effective_attr_changes',
+                                                           (set(), set()))
+        changed_ids -= deleted_part_ids
+        changed_ids.update(part_ids)
+        deleted_ids.update(deleted_part_ids)
+
+
+def refresh_pending_effective_attrs(session=None):
+    """
+    Flushes the session (default: db_session) and refreshes the effective
+    attributes of the Parts changed in the current transaction. Runs before
+    every commit, readers of effective_attr call it to see the changes of the
+    transaction.
+    """
+    session = session or db_session
+    session.flush()
+    changes = session.info.pop('effective_attr_changes', None)
+    if changes:
+        part_ids, deleted_part_ids = changes
+        refresh_effective_attrs(session.connection(), part_ids, deleted_part_ids)
+
+
+@event.listens_for(Session, 'before_commit')
+def _refresh_effective_attrs(session):
+    refresh_pending_effective_attrs(session)
+
+
+# Keys (JSON encoded) of the rows which were created from hwdb.data, see
+# hwdb.sync. Rows which are not listed here were added by users and are never
+# deleted when the database is synced with hwdb.data.
+seeded_key = Table('seeded_key', Base.metadata,
+    Column('table_name', String, primary_key=True),
+    Column('key', String, primary_key=True),
+)
+
+
+# Content hashes of the Parts imported from Wikipedia (see
+# hwdb.wikipedia.upsert_records). A re-import skips the Parts whose rows
+# didn't change.
+imported_part = Table('imported_part', Base.metadata,
+    Column('part_id', Integer, ForeignKey(Part.id, ondelete='CASCADE'), primary_key=True),
+    Column('content_hash', String, nullable=False),
+)
+
+
+@event.listens_for(Part, 'after_delete')
+def _imported_part_after_delete(mapper, connection, part):
+    # SQLite doesn't enforce the foreign key (and its ON DELETE) by default,
+    # a stale hash would be used for a new Part reusing the id
+    connection.execute(imported_part.delete().where(imported_part.c.part_id==part.id))
+
+
+# A version per table, bumped on every flush which changes the table, see
+# bump_table_versions. changed_at is the unix timestamp of the last change.
+# Only the tables in VERSIONED_TABLES have versions.
+table_version = Table('table_version', Base.metadata,
+    Column('table_name', String, primary_key=True),
+    Column('version', Integer, nullable=False),
+    Column('changed_at', Float, nullable=False),
+)
+
+
 class MultiAttr(Base):
     attr_id = Column(Integer, ForeignKey(Attr.id), nullable=False)
     attr = relationship(Attr, backref='multi_attrs')
@@ -295,7 +812,49 @@ def get_engine(dbpath, debug):
 
 
 def create_all(engine):
+    """
+    Creates the missing tables. The tables derived from the Parts
+    (part_closure, effective_attr) are filled when they are added to an
+    existing database, otherwise i.e. no Attr could be assigned.
+    """
+    existing = set(sqlalchemy.inspect(engine).get_table_names())
     Base.metadata.create_all(engine)
+    if 'part' not in existing:
+        return
+    with engine.begin() as connection:
+        if 'part_closure' not in existing:
+            rebuild_part_closure(connection)
+        if 'part_closure' not in existing or 'effective_attr' not in existing:
+            rebuild_effective_attrs(connection)
+
+
+def upgrade_db(engine):
+    """
+    Creates the tables and indexes added by newer versions of the model in a
+    database created by an older version (see create_all). Returns the names
+    of the created tables.
+    """
+    existing = set(sqlalchemy.inspect(engine).get_table_names())
+    create_indexes(engine)
+    return sorted(set(sqlalchemy.inspect(engine).get_table_names()) - existing)
+
+
+def create_indexes(engine):
+    """
+    Creates the tables and indexes declared in the model which are missing
+    in the database, e.g. because the database was created by an older
+    version of the model. Returns the names of the created indexes.
+    """
+    create_all(engine)
+    inspector = sqlalchemy.inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    return created
 
 
 def init_scoped_session(engine):
@@ -320,20 +879,286 @@ def get_model_classes():
 
 def search_PartAttrTypeMap(part, attr_type):
     """
-    Searches a part and its parent recursivly for an PartAttrTypeMap
-    with the given attr_type.
+    Searches a part and its parents for an PartAttrTypeMap with the given
+    attr_type. The nearest mapping wins.
 
     :return: PartAttrTypeMap object or None"""
-    mapping = db_session.query(PartAttrTypeMap).\
-        filter(and_(PartAttrTypeMap.attr_type==attr_type, PartAttrTypeMap.part==part)).first()
-
-    if mapping:
-        return mapping
-    elif part.parent_part:
-        return search_PartAttrTypeMap(part.parent_part, attr_type)
-    else:
+    # Parts which are not flushed yet have no rows in the closure table
+    while part is not None and part.id is None:
+        for mapping in part.attr_type_maps:
+            if mapping.attr_type is attr_type:
+                return mapping
+        part = part.parent_part
+    if part is None:
         return None
 
+    return db_session.query(PartAttrTypeMap).\
+        join(part_closure, part_closure.c.ancestor_id==PartAttrTypeMap.part_id).\
+        filter(and_(PartAttrTypeMap.attr_type==attr_type,
+                    part_closure.c.descendant_id==part.id)).\
+        order_by(part_closure.c.depth).\
+        first()
+
+
+class AttrTypeResolver(object):
+    """
+    Answers which AttrTypes are allowed for a Part: the AttrTypes mapped to the
+    Part itself or to one of its parents (see PartAttrTypeMap).
+    The allowed AttrType ids of a Part are fetched with one query on first use
+    and then kept in memory, so bulk imports don't query the database for
+    every attribute. The cache is cleared when a PartAttrTypeMap or the parent
+    of a Part is changed (see _invalidate_attr_type_resolver).
+    Use get_attr_type_resolver() to get the resolver of the current session.
+    """
+    def __init__(self, session):
+        self.session = session
+        self._allowed_ids = {}
+
+    def invalidate(self):
+        self._allowed_ids.clear()
+
+    def query_allowed_attr_type_ids(self, part_id):
+        """ Returns a query of the ids of the AttrTypes allowed for the Part """
+        return self.session.query(PartAttrTypeMap.attr_type_id).\
+            join(part_closure, part_closure.c.ancestor_id==PartAttrTypeMap.part_id).\
+            filter(part_closure.c.descendant_id==part_id)
+
+    def get_allowed_attr_type_ids(self, part_id):
+        """ Returns the set of AttrType ids allowed for the Part with the given id """
+        allowed_ids = self._allowed_ids.get(part_id)
+        if allowed_ids is None:
+            allowed_ids = frozenset(attr_type_id for attr_type_id,
+                                    in self.query_allowed_attr_type_ids(part_id))
+            self._allowed_ids[part_id] = allowed_ids
+        return allowed_ids
+
+    def is_allowed(self, part, attr_type):
+        # Parts which are not flushed yet are not known by the database
+        while part is not None and part.id is None:
+            for mapping in part.attr_type_maps:
+                if mapping.attr_type is attr_type:
+                    return True
+            part = part.parent_part
+        if part is None or attr_type.id is None:
+            return False
+        return attr_type.id in self.get_allowed_attr_type_ids(part.id)
+
+
+def _get_session_cache(session, key, factory):
+    """
+    Returns the object stored under key in session.info. If there is none
+    yet, it is created by calling factory(session). The caches are cleared
+    when the transaction ends (see _end_session_caches), so they live at
+    most as long as one request in the UI.
+    """
+    session = session or db_session
+    obj = session.info.get(key)
+    if obj is None:
+        obj = session.info[key] = factory(session)
+    return obj
+
+
+def get_attr_type_resolver(session=None):
+    """ Returns the AttrTypeResolver of the given session (default: db_session) """
+    return _get_session_cache(session, 'attr_type_resolver', AttrTypeResolver)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_attr_type_resolver(session, flush_context):
+    resolver = session.info.get('attr_type_resolver')
+    if resolver is None:
+        return
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, PartAttrTypeMap) or (
+                isinstance(obj, Part) and obj in session.dirty and
+                get_history(obj, 'parent_part_id').has_changes()):
+            resolver.invalidate()
+            return
+
+
+class AttrCache(object):
+    """
+    Identity cache for Attr objects, keyed by the AttrType object and the
+    value (as text). It allows to share Attr objects between Parts before they
+    are flushed to the database (the combination of AttrType and value is
+    unique).
+    Pending Attrs are always kept. Once they are flushed they are moved to
+    a LRU list which is bounded by max_size. Both are cleared at the end of
+    the transaction. hits and misses count the results of get().
+    Use get_attr_cache() to get the cache of the current session.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}
+        self._attrs = OrderedDict()
+
+    @staticmethod
+    def _make_key(attr_type, value):
+        return attr_type, six.text_type(value)
+
+    def __len__(self):
+        return len(self._pending) + len(self._attrs)
+
+    def get(self, attr_type, value):
+        """ Returns the cached Attr or None """
+        key = self._make_key(attr_type, value)
+        attr = self._pending.get(key)
+        if attr is None:
+            attr = self._attrs.pop(key, None)
+            if attr is not None:
+                # Move the entry to the end of the LRU list
+                self._attrs[key] = attr
+        if attr is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return attr
+
+    def add(self, attr):
+        key = self._make_key(attr.attr_type, attr.value)
+        if attr.id is None:
+            self._pending[key] = attr
+        else:
+            self._attrs.pop(key, None)
+            self._attrs[key] = attr
+            while len(self._attrs) > self.max_size:
+                self._attrs.popitem(last=False)
+
+    def flushed(self):
+        """ Moves the pending Attrs (which have an id now) to the LRU list """
+        pending, self._pending = self._pending, {}
+        for attr in six.itervalues(pending):
+            self.add(attr)
+
+    def clear(self):
+        self._pending.clear()
+        self._attrs.clear()
+
+
+def get_attr_cache(session=None):
+    """ Returns the AttrCache of the given session (default: db_session) """
+    return _get_session_cache(session, 'attr_cache', lambda session: AttrCache())
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _flush_attr_cache(session, flush_context):
+    attr_cache = session.info.get('attr_cache')
+    if attr_cache is not None:
+        attr_cache.flushed()
+
+
+def get_name_cache(session=None, cls=None):
+    """
+    Returns the dict of the given session (default: db_session) which maps the
+    names of records of the class cls to their ids (see
+    _TableWithNameColMixin.search). If cls is None the dict containing the
+    dicts of all classes is returned.
+    """
+    name_cache = _get_session_cache(session, 'name_cache', lambda session: {})
+    if cls is None:
+        return name_cache
+    return name_cache.setdefault(cls, {})
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_name_cache(session, flush_context):
+    name_cache = session.info.get('name_cache')
+    if not name_cache:
+        return
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        ids = name_cache.get(type(obj))
+        if ids:
+            # Old and new names: a renamed record might be ambiguous now
+            for name in get_history(obj, 'name').sum():
+                ids.pop(name, None)
+
+
+def clear_session_caches(session=None):
+    """
+    Clears the caches kept in session.info (default: db_session). Needed when
+    the database was changed without the ORM, e.g. by bulk inserts.
+    """
+    info = (session or db_session).info
+    resolver = info.get('attr_type_resolver')
+    if resolver is not None:
+        resolver.invalidate()
+    for key in ('attr_cache', 'name_cache'):
+        cache = info.get(key)
+        if cache is not None:
+            cache.clear()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _clear_session_caches(session, previous_transaction):
+    """ Objects created or loaded in the rolled back transaction are invalid """
+    clear_session_caches(session)
+    session.info.pop('effective_attr_changes', None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _end_session_caches(session, transaction):
+    """
+    session.info survives close() and remove(), the cached objects would be
+    kept (and detached) with it. Also clears pending Attrs which were never
+    flushed.
+    """
+    if transaction.parent is None:
+        clear_session_caches(session)
+
+
+# The tables the caches of the views are keyed on (see hwdb.ui, hwdb.fulltext),
+# the changes of other tables don't bump a version
+VERSIONED_TABLES = frozenset(['unit', 'attr_type', 'part', 'part_attr_type_map',
+                              'part_connection', 'attr', 'part_attr_map', 'effective_attr'])
+
+
+def bump_table_versions(connection, table_names):
+    """
+    Increments the versions of the given tables (the ones not in
+    VERSIONED_TABLES are skipped). Called on every flush, code changing the
+    database without the ORM (bulk inserts) has to call it explicitly.
+    """
+    changed_at = time.time()
+    for table_name in sorted(set(table_names) & VERSIONED_TABLES):
+        result = connection.execute(
+            table_version.update().
+                where(table_version.c.table_name==table_name).
+                values(version=table_version.c.version + 1, changed_at=changed_at))
+        if not result.rowcount:
+            connection.execute(table_version.insert().
+                               values(table_name=table_name, version=1,
+                                      changed_at=changed_at))
+
+
+def get_table_versions(table_names, session=None):
+    """
+    Returns a dict table name => (version, changed_at) for the given tables
+    with one query. Tables which were never changed have the version
+    (0, 0.0).
+    """
+    session = session or db_session
+    versions = dict.fromkeys(table_names, (0, 0.0))
+    query = select([table_version]).\
+        where(table_version.c.table_name.in_(list(table_names)))
+    for row in session.execute(query):
+        versions[row.table_name] = (row.version, row.changed_at)
+    return versions
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_table_versions(session, flush_context):
+    # Objects in session.dirty whose columns didn't change (i.e. only a
+    # collection was appended to) didn't change their table
+    dirty = [obj for obj in session.dirty
+             if session.is_modified(obj, include_collections=False)]
+    table_names = [obj.__table__.name
+                   for obj in itertools.chain(session.new, dirty, session.deleted)
+                   if hasattr(obj, '__table__')]
+    if table_names:
+        bump_table_versions(session.connection(), table_names)
+
 
 def get_attr_types_without_part():
     """
@@ -0,0 +1,101 @@
+"""
+Author: Benjamin Arbogast
+
+Checks with SQLite's EXPLAIN QUERY PLAN that the frequent lookups done by the
+views (see ui_queries, api, search) and by the model use an index instead of
+scanning a table.
+Run it against a database with: run.py check_query_plans
+"""
+
+import re
+
+import hwdb.model as M
+from hwdb import api
+from hwdb import search
+from hwdb import ui_queries
+
+
+def _stand_in(cls, id=1):
+    """
+    Returns an object of cls with the given id which is neither added to the
+    session nor loaded, to build the queries of its methods and relationships
+    """
+    obj = cls.__mapper__.class_manager.new_instance()
+    obj.id = id
+    return obj
+
+
+def _hot_queries():
+    """
+    Returns a list of (description, query) tuples. The queries are built by
+    the functions of the model and the views issuing them per node/row or per
+    request, so a table scan in one of them makes the page time grow with the
+    size of the catalogue.
+    """
+    q = M.db_session.query
+    part = _stand_in(M.Part)
+    attr_type = _stand_in(M.AttrType)
+    attr = _stand_in(M.Attr)
+
+    def loads(relationship, obj):
+        """ The query of the lazy load of relationship of obj """
+        return q(relationship.property.mapper).with_parent(obj, relationship)
+
+    return [
+        ('Part.search', M.Part.query_by_names(['CPU'])),
+        ('AttrType.search', M.AttrType.query_by_names(['Frequency'])),
+        ('Unit.search', M.Unit.query_by_names(['MHz'])),
+        ('Part.children', loads(M.Part.children, part)),
+        ('Part.query_ancestors', part.query_ancestors()),
+        ('Part.query_descendants', part.query_descendants()),
+        ('AttrTypeResolver', M.get_attr_type_resolver().query_allowed_attr_type_ids(1)),
+        ('Part.attr_type_maps', loads(M.Part.attr_type_maps, part)),
+        ('AttrType.part_maps', loads(M.AttrType.part_maps, attr_type)),
+        ('Part.attr_maps', loads(M.Part.attr_maps, part)),
+        ('Attr.part_maps', loads(M.Attr.part_maps, attr)),
+        ('Part.add_attributes: Attr lookup', M.Attr.query_by_value(attr_type, '1')),
+        ('Part.container_maps', loads(M.Part.container_maps, part)),
+        ('Part.contained_maps', loads(M.Part.contained_maps, part)),
+        ('Part.query_effective_attrs', part.query_effective_attrs()),
+        ('Attr.query_range', M.Attr.query_range(attr_type, 1, 2)),
+        ('/parts?id: Part with attributes', ui_queries.query_part_detail(1)),
+        ('/parts?id: share counts', ui_queries.query_share_counts(1)),
+        ('/parts?id: inherited attributes', ui_queries.query_inherited_attrs(part)),
+        ('search: inherited attributes', search.search('Vendor=Intel', inherited=True)),
+        ('/api/parts: keyset page',
+         api.query_page(q(M.Part.id), M.Part.name, M.Part.id, ('CPU', 1), 100)),
+        ('/api/attributes: keyset page',
+         api.query_page(q(M.Attr.id), M.Attr.value, M.Attr.id, ('1', 1), 100)),
+    ]
+
+
+def get_query_plan(query):
+    """ Returns the lines of SQLite's EXPLAIN QUERY PLAN for the query """
+    connection = M.db_session.connection()
+    compiled = query.statement.compile(dialect=connection.dialect,
+                                       compile_kwargs={'literal_binds': True})
+    rows = connection.execute('EXPLAIN QUERY PLAN %s' % compiled)
+    # The last column contains the description of the step
+    return [row[-1] for row in rows]
+
+
+def find_table_scans():
+    """
+    Returns a list of (description, plan lines) for every hot query whose
+    plan contains a full table scan.
+    """
+    failures = []
+    for description, query in _hot_queries():
+        plan = get_query_plan(query)
+        if any(re.match(r'SCAN (TABLE )?\w+( AS \w+)?$', line) for line in plan):
+            failures.append((description, plan))
+    return failures
+
+
+def check_query_plans():
+    """ Raises an AssertionError if one of the hot queries scans a table """
+    failures = find_table_scans()
+    if failures:
+        raise AssertionError('Queries without index:\n' + '\n'.join(
+            '  %s: %s' % (description, '; '.join(plan))
+            for description, plan in failures))
@@ -0,0 +1,153 @@
+"""
+Author: Benjamin Arbogast
+
+Parametric search for Parts. A search query is compiled into a single SQL
+statement (one IN subquery per constraint), so it runs inside the database
+using the indexes of attr, part_attr_map (effective_attr) and part_closure.
+
+Query language: constraints joined with "and", i.e.
+    Vendor=Intel and L2 cache>=512 and supports SSE2
+Constraints:
+ - <AttrType name> <op> <value> with op one of = != < <= > >=
+   = and != compare the text of the value. The other operators compare the
+   numeric value (see Attr.value_from, Attr.value_to), a range matches if it
+   overlaps the condition.
+   != matches the Parts without an attribute with this value.
+   With inherited=True the effective attributes are used, so Parts inherit
+   the attributes of their parents (see model.effective_attr).
+ - supports <standard name>: the Part or one of its parents supports the
+   standard
+Names and values containing operators, double quotes or the word "and" have
+to be quoted with double quotes, backslash escapes a quote.
+"""
+
+import re
+
+from sqlalchemy import and_, select
+
+import hwdb.model as M
+
+
+_TOKEN_RE = re.compile(r'''\s*(?:
+    "(?P<quoted>(?:[^"\\]|\\.)*)"   |
+    (?P<op>>=|<=|!=|=|<|>)          |
+    (?P<word>(?:[^\s"<>=!]|!(?!=))+)
+    )\s*''', re.VERBOSE)
+
+
+def _tokenize(text):
+    """ Returns a list of (kind, value) tuples, kind is quoted, op or word """
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError('Invalid search query at %r' % text[pos:])
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'quoted':
+            value = re.sub(r'\\(.)', r'\1', value)
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+def _join_words(tokens):
+    return ' '.join(value for kind, value in tokens)
+
+
+def parse_query(text):
+    """
+    Parses a search query. Returns a list of constraints:
+     - ('attr', attr type name, operator, value)
+     - ('supports', standard name)
+    Raises a ValueError for invalid queries.
+    """
+    constraints = []
+    groups = [[]]
+    for kind, value in _tokenize(text):
+        if kind == 'word' and value.lower() == 'and':
+            groups.append([])
+        else:
+            groups[-1].append((kind, value))
+
+    for tokens in groups:
+        if not tokens:
+            raise ValueError('Empty constraint in search query %r' % text)
+        if tokens[0][0] == 'word' and tokens[0][1].lower() == 'supports' and \
+                len(tokens) > 1 and all(kind != 'op' for kind, value in tokens):
+            constraints.append(('supports', _join_words(tokens[1:])))
+            continue
+
+        ops = [i for i, (kind, value) in enumerate(tokens) if kind == 'op']
+        if len(ops) != 1 or ops[0] == 0 or ops[0] == len(tokens) - 1:
+            raise ValueError('Expected "<attribute type> <operator> <value>" or '
+                             '"supports <standard>", got %r' % _join_words(tokens))
+        i = ops[0]
+        op = tokens[i][1]
+        value = _join_words(tokens[i + 1:])
+        if op not in ('=', '!='):
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError('The operator %s needs a number, got %r' % (op, value))
+        constraints.append(('attr', _join_words(tokens[:i]), op, value))
+    return constraints
+
+
+def _attr_condition(op, value):
+    attr = M.Attr
+    if op in ('=', '!='):
+        return attr.value==value
+    return {'<': attr.value_from < value,
+            '<=': attr.value_from <= value,
+            '>': attr.value_to > value,
+            '>=': attr.value_to >= value}[op]
+
+
+def _constraint_condition(constraint, inherited):
+    """ Returns the condition on Part for one constraint """
+    if constraint[0] == 'supports':
+        standard = M.Part.__table__.alias('standard')
+        supporting_ids = select([M.PartConnection.contained_part_id]).\
+            where(and_(M.PartConnection.container_part_id==standard.c.id,
+                       standard.c.is_standard==True,
+                       standard.c.name==constraint[1]))
+        # The descendants of a supporting Part support the standard too
+        part_ids = select([M.part_closure.c.descendant_id]).\
+            where(M.part_closure.c.ancestor_id.in_(supporting_ids))
+        return M.Part.id.in_(part_ids)
+
+    _, attr_type_name, op, value = constraint
+    attr_ids = select([M.Attr.id]).\
+        where(and_(M.Attr.attr_type_id==M.AttrType.id,
+                   M.AttrType.name==attr_type_name,
+                   _attr_condition(op, value)))
+    if inherited:
+        part_ids = select([M.effective_attr.c.part_id]).\
+            where(M.effective_attr.c.attr_id.in_(attr_ids))
+    else:
+        part_ids = select([M.PartAttrMap.part_id]).\
+            where(M.PartAttrMap.attr_id.in_(attr_ids))
+    if op == '!=':
+        return ~M.Part.id.in_(part_ids)
+    return M.Part.id.in_(part_ids)
+
+
+def compile_query(text, inherited=False):
+    """
+    Returns the condition on Part for the search query text. With inherited
+    the attributes of the parents of a Part match too.
+    """
+    if inherited:
+        M.refresh_pending_effective_attrs()
+    return and_(*[_constraint_condition(constraint, inherited)
+                  for constraint in parse_query(text)])
+
+
+def search(text, inherited=False):
+    """ Returns a query of the Parts matching the search query, ordered by name """
+    return M.db_session.query(M.Part).\
+        filter(compile_query(text, inherited)).\
+        order_by(M.Part.name, M.Part.id)
@@ -0,0 +1,402 @@
+"""
+Author: Benjamin Arbogast
+
+Synchronizes an existing database with the declarative data in hwdb.data
+(see run.py sync_db). Instead of recreating the database only the rows which
+differ are inserted, updated or deleted.
+
+Rows are identified by natural keys (names), i.e. a Part by its name like in
+init_data._get_or_add_part. Rows are only deleted if they were created from
+hwdb.data before (see model.seeded_key), so rows added by users are kept.
+Parts added by users below a deleted Part are moved to its parent.
+"""
+
+import json
+from collections import OrderedDict
+
+import six
+from sqlalchemy import select
+
+import hwdb.model as M
+from hwdb import data
+from hwdb import treetools
+
+
+# The order in which the tables are synced. Deletions are done in reverse
+# order.
+TABLES = ('unit', 'attr_type', 'part', 'part_attr_type_map', 'part_attr_map',
+          'part_connection')
+
+
+class DataState(object):
+    """
+    The rows described by hwdb.data. For every table there is a dict
+    key => values (see TABLES):
+     - unit: (name,) => (label, format, note)
+     - attr_type: (name,) => (unit name, note)
+     - part: (name,) => (parent name, note, is_standard, is_connector, is_system)
+     - part_attr_type_map: (part name, attr type name) => None
+     - part_attr_map: (part name, attr type name, value) => None (a Part can
+       have multiple values of a multi_value AttrType)
+     - part_connection: (system name, container name, contained name) => quantity
+       (system name is None for the connections of standards)
+    """
+    def __init__(self):
+        self.tables = OrderedDict((table, OrderedDict()) for table in TABLES)
+
+    @classmethod
+    def from_data(cls):
+        state = cls()
+        for d in data.units:
+            state.tables['unit'][(d['name'],)] = (
+                d['label'], d.get('format', '%(unit)s'), d.get('note'))
+        for d in data.attr_types:
+            state.tables['attr_type'][(d['name'],)] = (d['unit'], d.get('note'))
+
+        state._add_parts(treetools.inflate_tree(data.parts), None)
+        state._add_parts(treetools.inflate_tree(data.standards), None, is_standard=True)
+        state._add_parts(treetools.inflate_tree(data.connectors), None, is_connector=True)
+        state._add_parts(treetools.inflate_tree(data.subparts), None)
+
+        parts = state.tables['part']
+        for system in treetools.inflate_tree(data.systems):
+            name = system['<name>']
+            parts[(name,)] = parts[(name,)][:4] + (True,)
+            state._add_connections(name, name, system['<children>'])
+        return state
+
+    def _add_parts(self, elements, parent, is_standard=False, is_connector=False):
+        """ Mirrors init_data._import """
+        for el in elements:
+            name = el['<name>']
+            # An existing Part with the same name is reused
+            if (name,) not in self.tables['part']:
+                self.tables['part'][(name,)] = (parent, el.get('<note>'),
+                                                is_standard, is_connector, False)
+            for attr_type_name in el.get('<attr_types>', []):
+                self.tables['part_attr_type_map'][(name, attr_type_name)] = None
+            for attr_type_name, value in six.iteritems(el.get('<attrs>', {})):
+                self.tables['part_attr_map'][
+                    (name, attr_type_name, six.text_type(value))] = None
+            for standard_name in el.get('<standards>', []):
+                self.tables['part_connection'][(None, standard_name, name)] = 1
+            self._add_parts(el.get('<children>', []), name, is_standard, is_connector)
+
+    def _add_connections(self, system, container, children):
+        """ Mirrors init_data.import_systems """
+        for child in children:
+            if '<via>' in child:
+                # Like in import_systems the container is kept for the
+                # following siblings
+                container = child['<via>']
+            key = (system, container, child['<name>'])
+            self.tables['part_connection'][key] = child.get('<quantity>', 1)
+            if '<children>' in child:
+                self._add_connections(system, child['<name>'], child['<children>'])
+
+
+class DbState(DataState):
+    """
+    The rows of the database in the format of DataState. Additionally
+    self.ids contains the id of the row for every key.
+    Of multiple Parts with the same name only the first one (lowest id) is
+    considered, like in init_data._get_or_add_part. Rows referencing the
+    other ones are ignored.
+    """
+    def __init__(self):
+        super(DbState, self).__init__()
+        self.ids = dict((table, {}) for table in TABLES)
+
+    def _add(self, table, key, row_id, values):
+        if key not in self.tables[table]:
+            self.tables[table][key] = values
+            self.ids[table][key] = row_id
+
+    @classmethod
+    def from_db(cls):
+        state = cls()
+        execute = M.db_session.execute
+        unit = M.Unit.__table__
+        attr_type = M.AttrType.__table__
+        part = M.Part.__table__
+        attr = M.Attr.__table__
+        part_attr_map = M.PartAttrMap.__table__
+        part_attr_type_map = M.PartAttrTypeMap.__table__
+        part_connection = M.PartConnection.__table__
+
+        for row in execute(select([unit]).order_by(unit.c.id)):
+            state._add('unit', (row.name,), row.id, (row.label, row.format, row.note))
+
+        attr_type_names = {}
+        for row in execute(select([attr_type.c.id, attr_type.c.name, attr_type.c.note,
+                                   unit.c.name.label('unit_name')]).
+                           select_from(attr_type.join(unit)).order_by(attr_type.c.id)):
+            attr_type_names[row.id] = row.name
+            state._add('attr_type', (row.name,), row.id, (row.unit_name, row.note))
+
+        rows = list(execute(select([part]).order_by(part.c.id)))
+        all_names = dict((row.id, row.name) for row in rows)
+        # id => name of the Parts which are identified by their name
+        names = {}
+        for row in rows:
+            if (row.name,) not in state.tables['part']:
+                names[row.id] = row.name
+                state._add('part', (row.name,), row.id, (
+                    all_names.get(row.parent_part_id), row.note,
+                    bool(row.is_standard), bool(row.is_connector), bool(row.is_system)))
+
+        for row in execute(select([part_attr_type_map]).order_by(part_attr_type_map.c.id)):
+            if row.part_id in names:
+                state._add('part_attr_type_map',
+                           (names[row.part_id], attr_type_names[row.attr_type_id]),
+                           row.id, None)
+
+        for row in execute(select([part_attr_map.c.id, part_attr_map.c.part_id,
+                                   attr.c.attr_type_id, attr.c.value]).
+                           select_from(part_attr_map.join(attr)).
+                           order_by(part_attr_map.c.id)):
+            if row.part_id in names:
+                state._add('part_attr_map',
+                           (names[row.part_id], attr_type_names[row.attr_type_id], row.value),
+                           row.id, None)
+
+        for row in execute(select([part_connection]).order_by(part_connection.c.id)):
+            part_ids = (row.parent_part_id, row.container_part_id, row.contained_part_id)
+            if all(part_id is None or part_id in names for part_id in part_ids):
+                key = tuple(names.get(part_id) for part_id in part_ids)
+                state._add('part_connection', key, row.id, row.quantity)
+        return state
+
+
+def _encode_key(key):
+    return json.dumps(list(key))
+
+
+def load_seeded_keys(current=None):
+    """
+    Returns a dict table name => set of keys. The part_attr_map keys recorded
+    before they contained the value (part name, attr type name) are converted
+    with the DbState current: they stand for the single value the Part has.
+    """
+    seeded = dict((table, set()) for table in TABLES)
+    for table_name, key in M.db_session.execute(select([M.seeded_key])):
+        seeded[table_name].add(tuple(json.loads(key)))
+
+    old_keys = set(key for key in seeded['part_attr_map'] if len(key) == 2)
+    if old_keys and current is not None:
+        seeded['part_attr_map'] -= old_keys
+        values = {}
+        for key in current.tables['part_attr_map']:
+            values.setdefault(key[:2], []).append(key)
+        for key in old_keys:
+            if len(values.get(key, ())) == 1:
+                seeded['part_attr_map'].add(values[key][0])
+    return seeded
+
+
+def record_seeded_keys(state):
+    """ Replaces the seeded keys with the keys of the given DataState """
+    M.db_session.execute(M.seeded_key.delete())
+    rows = [dict(table_name=table, key=_encode_key(key))
+            for table, keys in six.iteritems(state.tables) for key in keys]
+    if rows:
+        M.db_session.execute(M.seeded_key.insert(), rows)
+
+
+class _Sync(object):
+    def __init__(self, wanted, current, seeded):
+        self.wanted = wanted
+        self.current = current
+        self.seeded = seeded
+        # table => [inserted, updated, deleted]
+        self.stats = OrderedDict((table, [0, 0, 0]) for table in TABLES)
+        # name => new Part/AttrType which is not in self.current yet
+        self._new_parts = {}
+        self._new_attr_types = {}
+        self._orphan_attr_ids = set()
+        # (name, deleted parent name, new parent name) of the Parts which were
+        # moved because their parent was deleted
+        self.moved_parts = []
+
+    def _get(self, cls, table, key):
+        return M.db_session.query(cls).get(self.current.ids[table][key])
+
+    def _get_part(self, name):
+        if name is None:
+            return None
+        if name in self._new_parts:
+            return self._new_parts[name]
+        return self._get(M.Part, 'part', (name,))
+
+    def _get_attr_type(self, name):
+        if name in self._new_attr_types:
+            return self._new_attr_types[name]
+        return self._get(M.AttrType, 'attr_type', (name,))
+
+    def _changes(self, table):
+        """ Returns the lists of inserted, updated and deleted keys """
+        wanted = self.wanted.tables[table]
+        current = self.current.tables[table]
+        inserted = [key for key in wanted if key not in current]
+        updated = [key for key in wanted if key in current and current[key] != wanted[key]]
+        deleted = [key for key in self.seeded[table]
+                   if key not in wanted and key in current]
+        self.stats[table][0] += len(inserted)
+        self.stats[table][1] += len(updated)
+        return inserted, updated, deleted
+
+    def _delete(self, obj, table):
+        M.db_session.delete(obj)
+        self.stats[table][2] += 1
+
+    def run(self):
+        unit_changes = self._changes('unit')
+        for key in unit_changes[0]:
+            label, format, note = self.wanted.tables['unit'][key]
+            M.db_session.add(M.Unit(name=key[0], label=label, format=format, note=note))
+        for key in unit_changes[1]:
+            unit = self._get(M.Unit, 'unit', key)
+            unit.label, unit.format, unit.note = self.wanted.tables['unit'][key]
+        M.db_session.flush()
+
+        attr_type_changes = self._changes('attr_type')
+        for key in attr_type_changes[0]:
+            unit_name, note = self.wanted.tables['attr_type'][key]
+            attr_type = M.AttrType(name=key[0], unit=M.Unit.search(unit_name), note=note)
+            M.db_session.add(attr_type)
+            self._new_attr_types[key[0]] = attr_type
+        for key in attr_type_changes[1]:
+            unit_name, note = self.wanted.tables['attr_type'][key]
+            attr_type = self._get_attr_type(key[0])
+            attr_type.unit = M.Unit.search(unit_name)
+            attr_type.note = note
+        M.db_session.flush()
+
+        part_changes = self._changes('part')
+        for key in part_changes[0]:
+            parent_name, note, is_standard, is_connector, is_system = self.wanted.tables['part'][key]
+            part = M.Part(name=key[0], parent_part=self._get_part(parent_name), note=note,
+                          is_standard=is_standard, is_connector=is_connector,
+                          is_system=is_system)
+            M.db_session.add(part)
+            self._new_parts[key[0]] = part
+        for key in part_changes[1]:
+            parent_name, note, is_standard, is_connector, is_system = self.wanted.tables['part'][key]
+            part = self._get_part(key[0])
+            part.parent_part = self._get_part(parent_name)
+            part.note = note
+            part.is_standard = is_standard
+            part.is_connector = is_connector
+            part.is_system = is_system
+        M.db_session.flush()
+
+        map_changes = self._changes('part_attr_type_map')
+        for part_name, attr_type_name in map_changes[0]:
+            M.db_session.add(M.PartAttrTypeMap(part=self._get_part(part_name),
+                                               attr_type=self._get_attr_type(attr_type_name)))
+        for key in map_changes[2]:
+            self._delete(self._get(M.PartAttrTypeMap, 'part_attr_type_map', key),
+                         'part_attr_type_map')
+        M.db_session.flush()
+
+        # The value is part of the key, a changed value is deleted and inserted
+        attr_changes = self._changes('part_attr_map')
+        for part_name, attr_type_name, value in attr_changes[0]:
+            self._get_part(part_name).add_attributes({attr_type_name: value})
+        for key in attr_changes[2]:
+            attr_map = self._get(M.PartAttrMap, 'part_attr_map', key)
+            self._orphan_attr_ids.add(attr_map.attr_id)
+            self._delete(attr_map, 'part_attr_map')
+
+        connection_changes = self._changes('part_connection')
+        for key in connection_changes[0]:
+            system, container, contained = (self._get_part(name) for name in key)
+            M.db_session.add(M.PartConnection(
+                parent_part=system, container_part=container, contained_part=contained,
+                quantity=self.wanted.tables['part_connection'][key]))
+        for key in connection_changes[1]:
+            part_connection = self._get(M.PartConnection, 'part_connection', key)
+            part_connection.quantity = self.wanted.tables['part_connection'][key]
+        for key in connection_changes[2]:
+            self._delete(self._get(M.PartConnection, 'part_connection', key),
+                         'part_connection')
+        M.db_session.flush()
+
+        deleted_parts = [self._get_part(key[0]) for key in part_changes[2]]
+        self._move_children(deleted_parts)
+        for part in deleted_parts:
+            self._delete_part(part)
+        M.db_session.flush()
+        self._delete_orphan_attrs()
+
+        # AttrTypes and Units are only deleted if nothing refers to them
+        for key in attr_type_changes[2]:
+            attr_type = self._get_attr_type(key[0])
+            M.db_session.expire(attr_type)
+            if not attr_type.attrs and not attr_type.part_maps:
+                self._delete(attr_type, 'attr_type')
+        M.db_session.flush()
+        for key in unit_changes[2]:
+            unit = self._get(M.Unit, 'unit', key)
+            M.db_session.expire(unit)
+            if not unit.attr_types:
+                self._delete(unit, 'unit')
+        M.db_session.flush()
+
+        record_seeded_keys(self.wanted)
+        return self.stats
+
+    def _move_children(self, deleted_parts):
+        """
+        Moves the children of the Parts to delete which are kept (i.e. added
+        by users) to the nearest ancestor which is kept
+        """
+        deleted = set(deleted_parts)
+        for part in deleted_parts:
+            new_parent = part.parent_part
+            while new_parent in deleted:
+                new_parent = new_parent.parent_part
+            for child in list(part.children):
+                if child not in deleted:
+                    child.parent_part = new_parent
+                    self.moved_parts.append(
+                        (child.name, part.name, new_parent.name if new_parent else None))
+        M.db_session.flush()
+
+    def _delete_part(self, part):
+        """ Deletes the Part with the rows referring to it """
+        # The collections might still contain rows which were deleted above
+        M.db_session.expire(part)
+        for attr_map in part.attr_maps:
+            self._orphan_attr_ids.add(attr_map.attr_id)
+            M.db_session.delete(attr_map)
+        for obj in (part.attr_type_maps + part.container_maps + part.contained_maps +
+                    part.part_connection_children):
+            M.db_session.delete(obj)
+        self._delete(part, 'part')
+
+    def _delete_orphan_attrs(self):
+        """ Deletes the Attrs which were used by deleted/changed PartAttrMaps only """
+        if not self._orphan_attr_ids:
+            return
+        query = M.db_session.query(M.Attr).\
+            filter(M.Attr.id.in_(self._orphan_attr_ids)).\
+            filter(~M.Attr.part_maps.any())
+        for attr in query:
+            M.db_session.delete(attr)
+        M.db_session.flush()
+
+
+def sync_db():
+    """
+    Applies the differences between hwdb.data and the database. The caller
+    is responsible for committing the session.
+    Returns a tuple of
+     - an OrderedDict table name => [inserted, updated, deleted]
+     - a list of (name, deleted parent name, new parent name) of the Parts
+       which were moved because their parent was deleted
+    """
+    current = DbState.from_db()
+    sync = _Sync(DataState.from_data(), current, load_seeded_keys(current))
+    stats = sync.run()
+    return stats, sync.moved_parts
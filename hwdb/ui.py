@@ -3,20 +3,37 @@ Author: Benjamin Arbogast
 """
 
 from collections import OrderedDict
+import calendar
+import datetime
+import functools
 
 import six
-from flask import (Blueprint, render_template, render_template_string,
-                    request, jsonify, url_for)
+from flask import (Blueprint, Response, render_template, render_template_string,
+                    request, jsonify, url_for, stream_with_context, make_response, g)
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.sql import and_
 from sqlalchemy import func
+from markupsafe import Markup
 from flaskext.htmlbuilder import html as H
 
 import hwdb.model as M
+from hwdb import fulltext
+from hwdb import cache
+from hwdb import ui_queries
+from hwdb.cache import FragmentCache
 
 
 bp = Blueprint('ui', __name__, template_folder='templates')
 
+# Rendered trees of /parts, /standards and /combinations, see _render_fragment
+fragment_cache = FragmentCache()
+
+# Number of attributes per page of /attributes
+ATTRIBUTES_PAGE_SIZE = 100
+
+# Number of Parts per page of /search
+SEARCH_PAGE_SIZE = 20
+
 base_template = '''
 {% extends "base.html" %}
 {% block body %}
@@ -57,6 +74,93 @@ def _render_string(tmpl_str, **kwargs):
                                   admin_menu=_get_admin_menu(), **kwargs)
 
 
+def _render_part_tree():
+    """ Renders the tree of all non-standard Parts with their standards """
+    children, standards = ui_queries.load_part_tree()
+
+    def _get_html(parent_part_id):
+        li_elements = []
+        for part in children.get(parent_part_id, []):
+            links = []
+            for standard in standards.get(part.id, []):
+                if links:
+                    links.append(', ')
+                a = H.a(href=url_for('ui.parts', id=standard.id))(standard.name)
+                links.append(a)
+            container_parts = [': '] + links if links else ''
+
+            a = H.a(href=url_for('ui.parts', id=part.id))(part.name)
+            li_elements.append(H.li(a,
+                                    H.small(container_parts),
+                                    _get_html(part.id)))
+        return H.ul(li_elements)
+
+    return _get_html(None)
+
+
+def _render_fragment(name, table_names, render):
+    """
+    Returns the HTML fragment rendered by render() from the fragment_cache.
+    It's only rendered again if one of the given tables was changed.
+    """
+    # The versions might be loaded already, see _conditional
+    versions = getattr(g, 'table_versions', {})
+    if not all(table_name in versions for table_name in table_names):
+        versions = M.get_table_versions(table_names)
+    version = tuple(versions[table_name] for table_name in table_names)
+    # The links in the fragment depend on the script root
+    name = request.script_root + '/' + name
+    return Markup(fragment_cache.get_or_render(name, version, render))
+
+
+def _conditional(table_names):
+    """
+    Decorator for views answering conditional requests. The ETag and
+    Last-Modified of the response are computed from the versions of the given
+    tables (a tuple or a function returning one for the current request). If
+    the copy of the client is still valid 304 is returned without calling the
+    view.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            names = table_names() if callable(table_names) else table_names
+            versions = g.table_versions = M.get_table_versions(names)
+            etag = cache.get_etag(request.url, names, versions)
+            last_modified = cache.get_last_modified(versions)
+
+            since = None
+            if request.if_modified_since:
+                since = calendar.timegm(request.if_modified_since.utctimetuple())
+            if_none_match = request.if_none_match.contains if request.if_none_match else None
+            if cache.is_not_modified(etag, last_modified, if_none_match, since):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = datetime.datetime.utcfromtimestamp(last_modified)
+            # Clients have to revalidate every time
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def _get_parts_tables():
+    if 'download' in request.args:
+        return ('part', 'part_attr_type_map', 'attr_type')
+    elif 'id' in request.args:
+        return ('part', 'part_attr_map', 'attr', 'attr_type', 'unit', 'effective_attr')
+    return ui_queries.PART_TREE_TABLES
+
+
+def _get_attr_types_tables():
+    if 'download' in request.args:
+        return ('attr_type', 'unit')
+    return ('attr_type', 'unit', 'part_attr_type_map', 'part')
+
+
 @bp.route("/")
 def index():
     li_list = [H.li(H.a(href=href)(name)) for href, name in six.iteritems(_get_menu_items())]
@@ -68,78 +172,30 @@ def index():
 
 
 @bp.route("/parts")
+@_conditional(_get_parts_tables)
 def parts():
     if 'download' in request.args:
-        def _get_children(parent_part):
-            res = []
-            query = M.db_session.query(M.Part).\
-            filter(and_(M.Part.parent_part==parent_part,
-                        M.Part.is_standard==False,
-                        M.Part.is_connector==False)).\
-            order_by(M.Part.name)
-            for part in query:
-                d = {'name': part.name}
-                if part.note:
-                    d['note'] = part.note
-
-                children = _get_children(part)
-
-                if children:
-                    d['children'] = children
-
-                attr_types = []
-                for attr_type_map in part.attr_type_maps:
-                    attr_types.append(attr_type_map.attr_type.name)
-                if attr_types:
-                    d['attr_types'] = attr_types
-
-                res.append(d)
-            return res
-
-        return jsonify(parts=_get_children(None))
-
+        return Response(stream_with_context(ui_queries.iter_parts_json()),
+                        mimetype='application/json')
 
     elif 'id' in request.args:
-        part = M.db_session.query(M.Part).filter_by(id=request.args['id']).one()
-        has_parent = bool(part.parent_part)
+        part = ui_queries.query_part_detail(request.args['id']).one()
+        share_counts = dict(ui_queries.query_share_counts(part.id))
+        inherited_attrs = ui_queries.query_inherited_attrs(part).all()
 
         # Generate breadcrumb for part
         li_elements = []
         divider = H.span(class_='divider')(H.i(class_='icon-chevron-right')(), ' ')
 
-        parent_part = part
-        while parent_part:
+        for parent_part in reversed(part.query_ancestors(include_self=True).all()):
             a = H.a(href=url_for('ui.parts', id=parent_part.id))(parent_part.name)
             li_elements.append(H.li(divider, a))
-            parent_part = parent_part.parent_part
-        chain = H.join(reversed(li_elements))
-        return _render('parts_detail.html', part=part, parent_part_chain=chain)
+        chain = H.join(li_elements)
+        return _render('parts_detail.html', part=part, parent_part_chain=chain,
+                       share_counts=share_counts, inherited_attrs=inherited_attrs)
     else:
-        def _get_html(parent_part):
-            query = M.db_session.query(M.Part).\
-                filter(and_(M.Part.parent_part==parent_part,
-                            M.Part.is_standard==False)).\
-                order_by(M.Part.name)
-            li_elements = []
-            for part in query:
-                standards = []
-                for pc in part.container_maps:
-                    container = pc.container_part
-                    if container and container.is_standard:
-                        if standards:
-                            standards.append(', ')
-                        a = H.a(href=url_for('ui.parts', id=container.id))(container.name)
-                        standards.append(a)
-                container_parts = [': '] + standards if standards else ''
-
-                a = H.a(href=url_for('ui.parts', id=part.id))(part.name)
-                li_elements.append(H.li(a,
-                                        H.small(container_parts),
-                                        _get_html(part)))
-            return H.ul(li_elements)
-
         doc = H.div(
-            _get_html(None),
+            _render_fragment('parts', ui_queries.PART_TREE_TABLES, _render_part_tree),
             H.h3('Export'),
             H.a(href=url_for('ui.parts', download='json'))('Download parts as JSON'),
         )
@@ -147,6 +203,7 @@ def parts():
 
 
 @bp.route('/attr_types')
+@_conditional(_get_attr_types_tables)
 def attr_types():
     attributes = M.db_session.query(M.AttrType).order_by('name')
     if 'download' in request.args:
@@ -163,6 +220,7 @@ def attr_types():
 
 
 @bp.route('/units')
+@_conditional(('unit',))
 def units():
     units = M.db_session.query(M.Unit).order_by('name')
     if 'download' in request.args:
@@ -174,8 +232,8 @@ def units():
         return _render('units.html', units=units)
 
 
-@bp.route("/combinations")
-def combinations():
+def _render_combinations():
+    """ Renders the tree of all systems with their PartConnections """
     def _render_li(part, sub_parts, level, border=False):
         ul_dict = dict(class_='icons collapsible')
         li_dict = {}
@@ -197,14 +255,13 @@ def combinations():
             return H.li(**li_dict)(class_='noicon')(li_elements)
 
 
+    # (system id, container id) => list of contained Parts
+    connections = ui_queries.load_connections()
+
     def _render_part(system_part, part, level):
         level += 1
         sub_parts = []
-        query = M.db_session.query(M.PartConnection).\
-            filter(and_(M.PartConnection.parent_part==system_part,
-                        M.PartConnection.container_part==part))
-        for part_connection in query:
-            contained_part = part_connection.contained_part
+        for contained_part in connections.get((system_part.id, part.id), []):
             if contained_part.is_system:
                 subpart_html = _render_system(contained_part, level)
             else:
@@ -213,77 +270,118 @@ def combinations():
 
         return _render_li(part, sub_parts, level)
 
+    # Systems contained in other systems are rendered only once. Their level
+    # is always > 1 here and _render_li() renders all those levels alike.
+    rendered_systems = {}
 
     def _render_system(system_part, level):
         level += 1
-        sub_parts = []
+        if system_part.id not in rendered_systems:
+            # Get root parts of this system
+            sub_parts = [_render_part(system_part, contained_part, level)
+                         for contained_part in connections.get((system_part.id, system_part.id), [])]
+            rendered_systems[system_part.id] = _render_li(system_part, sub_parts, level, border=True)
+        return rendered_systems[system_part.id]
 
-        # Get root parts of this system
-        query = M.db_session.query(M.PartConnection).\
-            filter(and_(M.PartConnection.parent_part==system_part,
-                        M.PartConnection.container_part==system_part))
-        for part_connection in query:
-            contained_part = part_connection.contained_part
 
-            contained_html = _render_part(system_part, contained_part, level)
-            sub_parts.append(contained_html)
+    li_elements = []
+    for part in ui_queries.query_systems():
+        li_elements.append(_render_system(part, 1))
+    return H.ul(class_='icons collapsible')(li_elements)
 
-        return _render_li(system_part, sub_parts, level, border=True)
 
+@bp.route("/combinations")
+@_conditional(ui_queries.CONNECTION_TABLES)
+def combinations():
+    doc = _render_fragment('combinations', ui_queries.CONNECTION_TABLES,
+                           _render_combinations)
+    return _render_string(base_template, heading='Combinations', content=doc)
 
-    query = M.db_session.query(M.Part).\
-        filter(M.Part.is_system==True).order_by(M.Part.name)
 
-    li_elements = []
-    for part in query:
-        li_elements.append(_render_system(part, 1))
-    doc = H.ul(class_='icons collapsible')(li_elements)
-    return _render_string(base_template, heading='Combinations', content=doc)
+@bp.route('/search')
+@_conditional(fulltext.TABLES)
+def search():
+    """
+    Full-text search for Parts, best matches first (see hwdb.fulltext).
+    Parameters: q, page
+    """
+    q = request.args.get('q', '')
+    page = request.args.get('page', '1')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+    # One additional Part tells whether there is a next page
+    parts = fulltext.search(q, limit=SEARCH_PAGE_SIZE + 1,
+                            offset=(page - 1) * SEARCH_PAGE_SIZE)
+
+    previous_url = next_url = None
+    if page > 1:
+        previous_url = url_for('ui.search', q=q, page=page - 1)
+    if len(parts) > SEARCH_PAGE_SIZE:
+        parts = parts[:SEARCH_PAGE_SIZE]
+        next_url = url_for('ui.search', q=q, page=page + 1)
+    return _render('search.html', q=q, parts=parts,
+                   previous_url=previous_url, next_url=next_url)
 
 
 @bp.route("/attributes")
+@_conditional(('attr', 'attr_type', 'unit', 'part_attr_map', 'part'))
 def attributes():
-    stmt = M.db_session.query(M.Attr.id.label('attr_id'),
-                              func.count('*').label('cnt')).\
-                    join(M.PartAttrMap).\
-                    join(M.Part).\
-                    group_by(M.Attr.value, M.Attr.attr_type_id).\
-                    subquery()
-
-    attributes = M.db_session.query(M.Attr).\
-                    join(M.AttrType).\
-                    join(stmt, M.Attr.id == stmt.c.attr_id).\
-                    filter(stmt.c.cnt > 1).\
-                    order_by(M.AttrType.name).\
-                    all()
-    return _render('attributes.html', attributes=attributes)
-
-
-@bp.route("/standards")
-def standards():
-    def _get_html(parent_part):
+    """
+    Lists the attributes shared by multiple Parts with these Parts.
+    Parameters: attr_type (id) and value to filter, page
+    """
+    filters = {}
+    if request.args.get('attr_type', '').isdigit():
+        filters['attr_type'] = request.args['attr_type']
+    if 'value' in request.args:
+        filters['value'] = request.args['value']
+    query = ui_queries.query_shared_attributes(
+        int(filters['attr_type']) if 'attr_type' in filters else None,
+        filters.get('value'))
+
+    page = request.args.get('page', '1')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+    # One additional row tells whether there is a next page
+    attributes = query.offset((page - 1) * ATTRIBUTES_PAGE_SIZE).\
+        limit(ATTRIBUTES_PAGE_SIZE + 1).\
+        all()
+
+    previous_url = next_url = None
+    if page > 1:
+        previous_url = url_for('ui.attributes', page=page - 1, **filters)
+    if len(attributes) > ATTRIBUTES_PAGE_SIZE:
+        attributes = attributes[:ATTRIBUTES_PAGE_SIZE]
+        next_url = url_for('ui.attributes', page=page + 1, **filters)
+    return _render('attributes.html', attributes=attributes,
+                   previous_url=previous_url, next_url=next_url)
+
+
+def _render_standards():
+    """ Renders the tree of all standards with the Parts supporting them """
+    children, contained_parts = ui_queries.load_standard_tree()
+
+    def _get_html(parent_part_id):
         lis = []
-        query = M.db_session.query(M.Part).\
-            filter(and_(M.Part.parent_part==parent_part,
-                        M.Part.is_standard==True)).\
-            order_by(M.Part.name)
-
-        for standard in query:
-            # remove " (Standard)" from the end of the name
-            name = standard.name
+        for standard in children.get(parent_part_id, []):
             parts = []
-            for pc in standard.contained_maps:
+            for part in contained_parts.get(standard.id, []):
                 if parts:
                     parts.append(', ')
-                a = H.a(href=url_for('ui.parts', id=pc.contained_part.id))(pc.contained_part.name)
+                a = H.a(href=url_for('ui.parts', id=part.id))(part.name)
                 parts.append(a)
-            contained_parts = [': '] + parts if parts else ''
+            parts = [': '] + parts if parts else ''
 
             lis.append(H.li(
-                H.a(href=url_for('ui.parts', id=standard.id))(name),
-                contained_parts,
-                _get_html(standard)))
+                H.a(href=url_for('ui.parts', id=standard.id))(standard.name),
+                parts,
+                _get_html(standard.id)))
         return H.ul(lis)
 
-    doc = _get_html(None)
+    return _get_html(None)
+
+
+@bp.route("/standards")
+@_conditional(ui_queries.STANDARD_TREE_TABLES)
+def standards():
+    doc = _render_fragment('standards', ui_queries.STANDARD_TREE_TABLES,
+                           _render_standards)
     return _render_string(base_template, heading='Standards', content=doc)
@@ -0,0 +1,233 @@
+"""
+Author: Benjamin Arbogast
+
+The queries of the views in ui.py. They are kept apart from the rendering
+(which needs flaskext.htmlbuilder), so they can be tested and their plans
+checked (see query_plans).
+"""
+
+import itertools
+import json
+
+from sqlalchemy.orm import joinedload, aliased, contains_eager, selectinload
+from sqlalchemy.sql import and_, select
+from sqlalchemy import func
+
+import hwdb.model as M
+from hwdb import hierarchy
+
+
+# The tables read by load_part_tree, load_connections (with query_systems) and
+# load_standard_tree, the cached fragments rendered from them are keyed on
+# their versions (see ui._render_fragment)
+PART_TREE_TABLES = ('part', 'part_connection')
+CONNECTION_TABLES = ('part', 'part_connection')
+STANDARD_TREE_TABLES = ('part', 'part_connection')
+
+
+def load_part_tree():
+    """
+    Loads the hierarchy of all non-standard Parts and the standards they
+    support with two queries.
+    Returns a tuple of two dicts:
+     - parent_part_id => list of (id, parent_part_id, name) rows of the
+       child Parts (ordered by name)
+     - part id => list of (contained_part_id, id, name) rows of the standards
+       supported by the Part
+    """
+    children = {}
+    query = M.db_session.query(M.Part.id, M.Part.parent_part_id, M.Part.name).\
+        filter(M.Part.is_standard==False).\
+        order_by(M.Part.name)
+    for part in query:
+        children.setdefault(part.parent_part_id, []).append(part)
+
+    standards = {}
+    query = M.db_session.query(M.PartConnection.contained_part_id, M.Part.id,
+                               M.Part.name).\
+        join(M.Part, M.Part.id==M.PartConnection.container_part_id).\
+        filter(M.Part.is_standard==True).\
+        order_by(M.PartConnection.id)
+    for row in query:
+        standards.setdefault(row.contained_part_id, []).append(row)
+
+    return children, standards
+
+
+def query_parts_export():
+    """
+    Returns a select of all non-standard, non-connector Parts in depth-first
+    order (siblings ordered by name) with the columns id, depth, name, note
+    and attr_type_name. A Part with multiple AttrTypes has one consecutive
+    row per AttrType (ordered by the AttrType name).
+    """
+    tree = hierarchy.part_descendants(
+        condition=and_(M.Part.is_standard==False, M.Part.is_connector==False))
+
+    part = M.Part.__table__
+    attr_type_map = M.PartAttrTypeMap.__table__
+    attr_type = M.AttrType.__table__
+    return select([tree.c.id, tree.c.depth, part.c.name, part.c.note,
+                   attr_type.c.name.label('attr_type_name')]).\
+        select_from(tree.join(part, part.c.id==tree.c.id).
+                    outerjoin(attr_type_map, attr_type_map.c.part_id==part.c.id).
+                    outerjoin(attr_type, attr_type.c.id==attr_type_map.c.attr_type_id)).\
+        order_by(hierarchy.sort_order(tree), attr_type.c.name)
+
+
+def iter_parts_json():
+    """
+    Yields the JSON document {"parts": [...]} of the Part hierarchy chunk by
+    chunk while iterating over a single query. Every Part is an object with
+    the keys name, note (optional), attr_types (optional) and children
+    (optional).
+    """
+    yield '{"parts": ['
+    rows = M.db_session.execute(
+        query_parts_export().execution_options(stream_results=True))
+    depth = -1
+    for _, part_rows in itertools.groupby(rows, key=lambda row: row.id):
+        part_rows = list(part_rows)
+        part = part_rows[0]
+        if part.depth > depth:
+            chunk = ', "children": [' if depth >= 0 else ''
+        else:
+            # Close the previous Part and all finished children lists
+            chunk = '}' + ']}' * (depth - part.depth) + ', '
+        depth = part.depth
+
+        d = {'name': part.name}
+        if part.note:
+            d['note'] = part.note
+        attr_types = [row.attr_type_name for row in part_rows if row.attr_type_name]
+        if attr_types:
+            d['attr_types'] = attr_types
+        # Leave the object open, children might follow
+        yield chunk + json.dumps(d, sort_keys=True)[:-1]
+
+    if depth >= 0:
+        yield '}' + ']}' * depth
+    yield ']}'
+
+
+def query_part_detail(part_id):
+    """
+    Returns a query of the Part with the given id, its attributes are loaded
+    with their AttrTypes and Units in the same query
+    """
+    return M.db_session.query(M.Part).\
+        options(joinedload(M.Part.attr_maps).
+                joinedload(M.PartAttrMap.attr).
+                joinedload(M.Attr.attr_type).
+                joinedload(M.AttrType.unit)).\
+        filter_by(id=part_id)
+
+
+def query_share_counts(part_id):
+    """
+    Returns a query of (attr_id, count) rows: the number of Parts sharing
+    each of the attributes of the Part
+    """
+    attr_ids = M.db_session.query(M.PartAttrMap.attr_id).\
+        filter(M.PartAttrMap.part_id==part_id).\
+        subquery()
+    return M.db_session.query(M.PartAttrMap.attr_id, func.count('*')).\
+        filter(M.PartAttrMap.attr_id.in_(attr_ids)).\
+        group_by(M.PartAttrMap.attr_id)
+
+
+def query_inherited_attrs(part):
+    """
+    Returns a query of (Attr, source_part_id, name) rows: the attributes the
+    Part inherits from its parents with the names of the Parts they are
+    taken from (see Part.query_effective_attrs)
+    """
+    source_part = aliased(M.Part)
+    return part.query_effective_attrs().\
+        join(source_part, source_part.id==M.effective_attr.c.source_part_id).\
+        filter(source_part.id!=part.id).\
+        add_columns(source_part.name).\
+        options(joinedload(M.Attr.attr_type).joinedload(M.AttrType.unit))
+
+
+def load_connections():
+    """
+    Loads the PartConnections of all systems with one query. Returns a dict
+    (system id, container id) => list of (parent_part_id, container_part_id,
+    id, name, is_system) rows of the contained Parts
+    """
+    connections = {}
+    system_part = aliased(M.Part)
+    contained_part = aliased(M.Part)
+    query = M.db_session.query(M.PartConnection.parent_part_id,
+                               M.PartConnection.container_part_id,
+                               contained_part.id, contained_part.name,
+                               contained_part.is_system).\
+        join(system_part, system_part.id==M.PartConnection.parent_part_id).\
+        join(contained_part, contained_part.id==M.PartConnection.contained_part_id).\
+        filter(system_part.is_system==True).\
+        order_by(M.PartConnection.id)
+    for row in query:
+        key = (row.parent_part_id, row.container_part_id)
+        connections.setdefault(key, []).append(row)
+    return connections
+
+
+def query_systems():
+    """ Returns a query of the (id, name) rows of all systems ordered by name """
+    return M.db_session.query(M.Part.id, M.Part.name).\
+        filter(M.Part.is_system==True).order_by(M.Part.name)
+
+
+def query_shared_attributes(attr_type_id=None, value=None):
+    """
+    Returns a query of the attributes shared by multiple Parts (optionally
+    of one AttrType and with one value) ordered by AttrType name and value.
+    Their AttrTypes, Units and Parts are loaded with the query.
+    """
+    # Attributes of more than one Part
+    counts = M.db_session.query(M.PartAttrMap.attr_id,
+                                func.count('*').label('cnt')).\
+        group_by(M.PartAttrMap.attr_id).\
+        having(func.count('*') > 1).\
+        subquery()
+
+    query = M.db_session.query(M.Attr).\
+        join(counts, M.Attr.id==counts.c.attr_id).\
+        join(M.Attr.attr_type).\
+        join(M.AttrType.unit).\
+        options(contains_eager(M.Attr.attr_type).contains_eager(M.AttrType.unit),
+                selectinload(M.Attr.part_maps).joinedload(M.PartAttrMap.part))
+    if attr_type_id is not None:
+        query = query.filter(M.Attr.attr_type_id==attr_type_id)
+    if value is not None:
+        query = query.filter(M.Attr.value==value)
+    return query.order_by(M.AttrType.name, M.Attr.value, M.Attr.id)
+
+
+def load_standard_tree():
+    """
+    Loads all standards and the Parts supporting them with two queries.
+    Returns a tuple of two dicts:
+     - parent_part_id => list of the rows of the child standards (ordered by
+       name), see hierarchy.part_descendants
+     - standard id => list of (container_part_id, id, name) rows of the
+       Parts supporting the standard
+    """
+    tree = hierarchy.part_descendants(
+        root_condition=and_(M.Part.parent_part_id==None, M.Part.is_standard==True),
+        condition=M.Part.is_standard==True)
+    children = {}
+    for standard in M.db_session.execute(select([tree]).order_by(hierarchy.sort_order(tree))):
+        children.setdefault(standard.parent_part_id, []).append(standard)
+
+    contained_parts = {}
+    query = M.db_session.query(M.PartConnection.container_part_id, M.Part.id,
+                               M.Part.name).\
+        join(M.Part, M.Part.id==M.PartConnection.contained_part_id).\
+        filter(M.PartConnection.container_part_id.in_(select([tree.c.id]))).\
+        order_by(M.PartConnection.id)
+    for row in query:
+        contained_parts.setdefault(row.container_part_id, []).append(row)
+
+    return children, contained_parts
@@ -1,39 +1,264 @@
 #-*-encoding=utf-8-*-
 """
 Author: Benjamin Arbogast
+
+Import of processors from the lists on Wikipedia.
+
+Articles are fetched by an ArticleFetcher. It keeps the wikitext of every
+fetched revision in an ArticleCache on disk and only downloads an article if
+its latest revision isn't cached yet. The network access is done by a
+transport: HttpTransport uses the MediaWiki API, FixtureTransport reads
+articles from a local directory (offline rebuilds, tests).
+
+import_articles imports several articles: they are fetched by a pool of
+threads and parsed by a pool of processes, while the rows are inserted by a
+single writer in the main process. A single article (ARTICLES currently
+configures only one) is parsed in the main process, a pool wouldn't help.
+How the columns of an article are mapped is configured per article in
+ARTICLES.
 """
 
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import functools
+import hashlib
+import io
 import json
+import multiprocessing
+import os
 import re
+import tempfile
+import threading
+import time
 
-import requests
+import six
+from sqlalchemy import and_, bindparam, exists, select
 
 import hwdb.model as M
+from hwdb import fulltext
 
 
 # https://github.com/earwig/mwparserfromhell
 # https://bitbucket.org/JanKanis/wiki2csv
 
+WIKIPEDIA_API_URL = 'https://en.wikipedia.org/w/api.php'
+
+# Number of threads fetching articles
+FETCH_THREADS = 8
+# Number of rows inserted per transaction
+BATCH_SIZE = 1000
+
+
+def _normalize_title(title):
+    return title.strip().replace(' ', '_')
+
+
+# Transports
+class HttpTransport(object):
+    """
+    Fetches articles with the MediaWiki API. It can be shared by the threads
+    of fetch_articles, every thread uses its own requests.Session.
+    """
+    def __init__(self, url=WIKIPEDIA_API_URL, timeout=30):
+        # requests is only needed for the network, not for offline imports
+        import requests
+        self._session_class = requests.Session
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()
+
+
+    @property
+    def session(self):
+        """ The requests.Session of the current thread, they aren't thread-safe """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._session_class()
+        return session
+
+
+    def _get_revision(self, title, rvprop):
+        # http://en.wikipedia.org/w/api.php?format=json&action=query&titles=List_of_Intel_Pentium_4_microprocessors&prop=revisions&rvprop=ids|content
+        payload = {'format': 'json', 'action': 'query', 'titles': title,
+                   'prop': 'revisions', 'rvprop': rvprop}
+        r = self.session.get(self.url, params=payload, timeout=self.timeout)
+        r.raise_for_status()
+        # The result contains a single page, keyed by its page id
+        page = list(r.json()['query']['pages'].values())[0]
+        if 'revisions' not in page:
+            raise Exception('Wikipedia article %r not found' % title)
+        return page['revisions'][0]
+
+
+    def get_revision_id(self, title):
+        """ Returns the id of the latest revision of the article """
+        return self._get_revision(title, 'ids')['revid']
+
+
+    def get_article(self, title):
+        """ Returns the id and the wikitext of the latest revision """
+        revision = self._get_revision(title, 'ids|content')
+        return revision['revid'], revision['*']
+
+
+class FixtureTransport(object):
+    """
+    Reads the articles from the files <title>.txt (utf-8) of a directory.
+    The revision id is derived from the content of the file.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def _read(self, title):
+        path = os.path.join(self.directory, _normalize_title(title) + '.txt')
+        if not os.path.exists(path):
+            raise Exception('Wikipedia article %r not found in %r' % (title, self.directory))
+        with io.open(path, encoding='utf-8') as f:
+            wikitext = f.read()
+        return hashlib.sha1(wikitext.encode('utf-8')).hexdigest()[:16], wikitext
+
+
+    def get_revision_id(self, title):
+        return self._read(title)[0]
+
+
+    def get_article(self, title):
+        return self._read(title)
+
+
+# Cache
+class ArticleCache(object):
+    """
+    Stores the wikitext of articles in a directory, keyed by title and
+    revision id, and remembers the latest known revision of every title.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def _get_path(self, title, extension):
+        name = hashlib.sha1(_normalize_title(title).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + extension)
+
+
+    def _write(self, path, text):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first, concurrent readers never see a
+        # partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(text))
+        os.rename(tmp_path, path)
+
+
+    def get(self, title, revision_id):
+        """ Returns the wikitext of the revision or None if it isn't cached """
+        try:
+            with io.open(self._get_path(title, '-%s.txt' % revision_id), encoding='utf-8') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+
+    def get_latest(self, title):
+        """
+        Returns (revision id, time of the last check) of the latest known
+        revision or (None, None)
+        """
+        try:
+            with io.open(self._get_path(title, '.json'), encoding='utf-8') as f:
+                latest = json.load(f)
+            return latest['revision_id'], latest['checked_at']
+        except (IOError, OSError, ValueError, KeyError):
+            return None, None
+
+
+    def set_latest(self, title, revision_id):
+        self._write(self._get_path(title, '.json'),
+                    json.dumps({'title': title, 'revision_id': revision_id,
+                                'checked_at': time.time()}))
+
+
+    def set(self, title, revision_id, wikitext):
+        self._write(self._get_path(title, '-%s.txt' % revision_id), wikitext)
+        self.set_latest(title, revision_id)
+
+
+class ArticleFetcher(object):
+    """
+    Returns the wikitext of articles. With a cache, an article is only
+    downloaded if its latest revision isn't cached. Otherwise only the id
+    of the latest revision is requested (revalidation), which is skipped
+    entirely if the last check is younger than max_age seconds.
+    Without a transport only cached articles are available (offline).
+    fetch can be called by several threads at once.
+    """
+    def __init__(self, transport=None, cache=None, max_age=0):
+        if transport is None and cache is None:
+            raise Exception('An ArticleFetcher needs a transport or a cache')
+        self.transport = transport
+        self.cache = cache
+        self.max_age = max_age
+        self.hits = 0
+        self.downloads = 0
+        self._counter_lock = threading.Lock()
+
+
+    def _count(self, counter):
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+    def fetch(self, title):
+        """ Returns the wikitext of the latest revision of the article """
+        if self.cache is None:
+            self._count('downloads')
+            return self.transport.get_article(title)[1]
+
+        revision_id, checked_at = self.cache.get_latest(title)
+        wikitext = None
+        if revision_id is not None:
+            if self.transport is None or time.time() - checked_at < self.max_age:
+                wikitext = self.cache.get(title, revision_id)
+            else:
+                latest_revision_id = self.transport.get_revision_id(title)
+                wikitext = self.cache.get(title, latest_revision_id)
+                if wikitext is not None:
+                    self.cache.set_latest(title, latest_revision_id)
+
+        if wikitext is not None:
+            self._count('hits')
+            return wikitext
+        if self.transport is None:
+            raise Exception('Wikipedia article %r is not cached' % title)
+        self._count('downloads')
+        revision_id, wikitext = self.transport.get_article(title)
+        self.cache.set(title, revision_id, wikitext)
+        return wikitext
 
-def fetch_from_wikipedia():
-    # http://en.wikipedia.org/w/api.php
-    # http://en.wikipedia.org/w/api.php?format=xml&action=query&titles=List_of_Intel_Pentium_4_microprocessors&prop=revisions&rvprop=content
 
-    # http://en.wikipedia.org/wiki/List_of_Intel_Pentium_4_microprocessors
-    # http://en.wikipedia.org/wiki/Pin_grid_array
-    payload = {'format': 'json', 'action': 'query', 'titles': 'List_of_Intel_Pentium_4_microprocessors', 'prop': 'revisions', 'rvprop': 'content'}
-    r = requests.get("http://en.wikipedia.org/w/api.php", params=payload)
+def fetch_from_wikipedia(title='List_of_Intel_Pentium_4_microprocessors', fetcher=None):
+    """ Returns the wikitext of the article, by default from the network """
+    fetcher = fetcher or ArticleFetcher(HttpTransport())
+    return fetcher.fetch(title)
 
-    j = json.loads(r.text)
-    wikitext = j['query']['pages']['4589953']['revisions'][0]['*']
-    return wikitext
+
+def fetch_articles(titles=None, fetcher=None):
+    """
+    Returns an OrderedDict title => wikitext of the articles (default: the
+    articles of ARTICLES)
+    """
+    fetcher = fetcher or ArticleFetcher(HttpTransport())
+    return OrderedDict((title, fetcher.fetch(title)) for title in titles or ARTICLES)
 
 
 # Helpers
 def parse_maybe_url(text):
     """ Tries to parse a wikipedia url and returns a tuple of (text, url) """
-    m = re.search('(?P<prefix>.*)\[(?P<url>.+)(?P<url_label> .*)\](?P<postfix>.*)', text)
+    m = re.search(r'(?P<prefix>.*)\[(?P<url>(?:https?:)?//[^\] ]+)(?P<url_label> [^\]]*)\](?P<postfix>.*)', text)
     if not m:
         return text, None
     d = m.groupdict()
@@ -66,112 +291,251 @@ def multi_split(s, seperators):
 
 
 # Parsers
-def split_table_strings(wikitext):
-    """ Extracts the tables from a wikipedia article. Returns a list with
-    strings starting with the table header and ending with the last table row """
-    tables = []
-    table_is_active = False
-    current_table = []
-
-    for line in wikitext.split('\n'):
-        if line.strip().startswith('|}'):
-            table_text = '\n'.join(current_table)
-            # Hack to skip tables which have spanning rows
-            # (for which parsing is not yet implemented)
-            if not 'rowspan' in table_text:
-                tables.append(table_text)
-            table_is_active = False
-            current_table = []
-
-        if table_is_active:
-            current_table.append(line)
-
-        if line.strip().startswith('{|'):
-            table_is_active = True
-
-    return tables
-
-
-def parse_table_rows(table_string):
-    """ Parses each table row to a dict. The header of the table will be key of
-    the dict. Tables rows spanning multiple physical rows are recognized. """
-    headers = None
-    data = []
-    current_row = None
-
-    # remove empty lines
-    table_rows = [row for row in table_string.split('\n') if row.strip()]
-
-    # parse + remove header
-    if table_rows[0].startswith('!'):
-        headers = [cell.strip() for cell in table_rows[0].strip('!').split('||')]
-        table_rows.pop(0)
-        table_rows.pop(0)
-    else:
-        headers = None
+_CELL_ATTRS_RE = re.compile(r"""^\s*(?:[\w-]+\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'|]+)\s*)+$""")
+_SPAN_RE = re.compile(r"""(rowspan|colspan)\s*=\s*["']?\s*(\d+)""", re.IGNORECASE)
 
-    # join rows again and split them by |- to get table rows spanning multiple
-    # physical rows
-    for row in '\n'.join(table_rows).split('|-'):
-        row_dict = {}
-        row = row.strip('|')
-        for i, cell in enumerate(row.split('||')):
-            row_dict[headers[i]] = cell.strip()
-        data.append(row_dict)
 
-    return data
+def _split_outside_links(text, separators):
+    """
+    Splits text at the separators which aren't inside [[...]] or {{...}}
+    (links and templates contain pipes)
+    """
+    parts = []
+    depth = 0
+    start = i = 0
+    while i < len(text):
+        pair = text[i:i + 2]
+        if pair in ('[[', '{{'):
+            depth += 1
+            i += 2
+        elif pair in (']]', '}}') and depth:
+            depth -= 1
+            i += 2
+        elif depth == 0 and pair in separators:
+            parts.append(text[start:i])
+            start = i = i + 2
+        elif depth == 0 and pair[:1] in separators:
+            parts.append(text[start:i])
+            start = i = i + 1
+        else:
+            i += 1
+    parts.append(text[start:])
+    return parts
 
-def fix_table_row_dict(table_row_dicts):
+
+def _parse_cell(text):
+    """
+    Returns (content, rowspan, colspan) of a cell. The attributes of a cell
+    are separated from its content by a single pipe: rowspan="2" | content
+    """
+    parts = _split_outside_links(text, ('|',))
+    if len(parts) > 1 and _CELL_ATTRS_RE.match(parts[0]):
+        spans = dict((name.lower(), int(value)) for name, value in _SPAN_RE.findall(parts[0]))
+        return ('|'.join(parts[1:]).strip(),
+                max(spans.get('rowspan', 1), 1), max(spans.get('colspan', 1), 1))
+    return text.strip(), 1, 1
+
+
+def _expand_row(cells, pending):
+    """
+    Returns the values of the columns of a row. Cells with a colspan fill
+    several columns, cells with a rowspan are remembered in pending (column
+    => [remaining rows, content]) and fill the column of the following rows.
+    """
+    values = []
+
+    def fill_pending():
+        while len(values) in pending:
+            remaining = pending[len(values)]
+            values.append(remaining[1])
+            remaining[0] -= 1
+            if not remaining[0]:
+                del pending[len(values) - 1]
+
+    for content, rowspan, colspan in cells:
+        fill_pending()
+        for i in range(colspan):
+            if rowspan > 1:
+                pending[len(values)] = [rowspan - 1, content]
+            values.append(content)
+    fill_pending()
+    # Spanning cells behind columns missing in this row
+    for column in sorted(c for c in pending if c > len(values)):
+        values.extend([''] * (column - len(values)))
+        fill_pending()
+    return values
+
+
+def _get_headers(header_rows):
+    """ Names of the columns, the headers of stacked header rows are joined """
+    headers = []
+    for column in six.moves.zip_longest(*header_rows, fillvalue=''):
+        names = []
+        for name in column:
+            if name and name not in names:
+                names.append(name)
+        headers.append(' '.join(names))
+    return headers
+
+
+def iter_table_rows(wikitext):
+    """
+    Parses the tables of a wikipedia article in a single pass and yields every
+    row as a dict header => content. wikitext is a string or an iterable of
+    lines (i.e. a file).
+    The rows before the first row containing data cells are the header.
+    Cells spanning rows or columns are repeated in every row and column they
+    span. Tables without a header and nested tables (kept as content of the
+    cell containing them) are skipped.
+    """
+    if isinstance(wikitext, six.string_types):
+        wikitext = six.StringIO(wikitext)
+
+    depth = 0
+    for line in wikitext:
+        line = line.rstrip('\r\n')
+        stripped = line.strip()
+
+        if depth == 0:
+            if stripped.startswith('{|'):
+                depth = 1
+                header_rows, headers, pending = [], None, {}
+                # (content, rowspan, colspan, is_header) of the current row
+                cells = []
+            continue
+
+        if depth > 1 or stripped.startswith('{|'):
+            # Nested table
+            if stripped.startswith('{|'):
+                depth += 1
+            elif stripped.startswith('|}'):
+                depth -= 1
+            if cells:
+                cells[-1][0] += '\n' + line
+            continue
+
+        if stripped.startswith('|-') or stripped.startswith('|}'):
+            if cells:
+                is_header_row = all(cell[3] for cell in cells)
+                values = _expand_row([cell[:3] for cell in cells], pending)
+                if headers is None and is_header_row:
+                    header_rows.append(values)
+                else:
+                    if headers is None:
+                        headers = _get_headers(header_rows)
+                    if headers:
+                        values.extend([''] * (len(headers) - len(values)))
+                        yield dict(zip(headers, values))
+                cells = []
+            if stripped.startswith('|}'):
+                depth = 0
+        elif stripped.startswith('|+'):
+            # Caption
+            continue
+        elif stripped.startswith('!'):
+            cells.extend([list(_parse_cell(text)) + [True] for text in
+                          _split_outside_links(stripped[1:], ('!!', '||'))])
+        elif stripped.startswith('|'):
+            cells.extend([list(_parse_cell(text)) + [False] for text in
+                          _split_outside_links(stripped[1:], ('||',))])
+        elif cells and stripped:
+            # Continuation of a cell spanning multiple lines (blank lines
+            # are dropped, they would end up at the end of the cell)
+            content = cells[-1][0]
+            cells[-1][0] = content + '\n' + stripped if content else stripped
+
+# Converters of the cells of a column
+def _strip(chars, value):
+    return value.strip(chars)
+
+
+def _parse_sspecs(sspec_number):
+    seperators = []
+    if '\n' in sspec_number:
+        seperators.append('\n')
+    if '<br>' in sspec_number:
+        seperators.append('<br>')
+    if len(seperators) > 1:
+        raise Exception('Line has newline and breaks, dont know what to do: %r'%sspec_number)
+    if seperators:
+        specs = sspec_number.split(seperators[0])
+    else:
+        specs = [sspec_number]
+
+    sspecs = []
+    for s in specs:
+        spec_name, spec_url = parse_maybe_url(s)
+        sspecs.append(dict(name=spec_name, url=spec_url))
+    return sspecs
+
+
+def _parse_frequency(frequency):
+    """ Returns the frequency in MHz """
+    if frequency.endswith('&nbsp;GHz'):
+        return str(int(float(frequency.strip('&nbsp;GHz')) * 1000))
+    return frequency
+
+
+def _split_part_numbers(part_numbers):
+    return multi_split(part_numbers, ['\n', '<br>'])
+
+
+# Mapping of the table columns to the keys of the rows returned by
+# fix_table_row_dict: key => headers (aliases of the column in the articles),
+# convert (function applied to the cell), optional (rows may lack the column).
+# The converters have to be module level functions (or partials of them),
+# the mappings are sent to the parsing processes.
+# The cell of "name" is split into the keys name and URL.
+PROCESSOR_COLUMNS = OrderedDict([
+    ('name', {'headers': ('Model Number', 'Model Number  Clock Speed')}),
+    ('sspecs', {'headers': ('sSpec&nbsp;Number', 'sSpec number', 'sSpec Number'),
+                'convert': _parse_sspecs}),
+    ('Frequency', {'headers': ('Frequency', 'Clock Speed'), 'convert': _parse_frequency}),
+    ('Release price', {'headers': ('Release Price (USD)', ), 'optional': True}),
+    ('Clock multiplier', {'headers': ('Multiplier', 'Clock Multiplier', '[[clock multiplier|Mult]]'),
+                          'convert': functools.partial(_strip, u'×')}),
+    ('Part number', {'headers': ('Part Number(s)', ), 'convert': _split_part_numbers}),
+    ('Voltage range', {'headers': ('Voltage', 'Voltage Range')}),
+    ('Front side bus', {'headers': ('[[Front Side Bus]]', 'FSB Speed'),
+                        'convert': functools.partial(_strip, ' MT/s')}),
+    ('Release date', {'headers': ('Release Date', )}),
+    ('L2 cache', {'headers': ('L2 Cache', '[[CPU caches#Multi-level caches|L2-Cache]]')}),
+    ('Socket', {'headers': ('Socket', '[[CPU socket|Socket]]')}),
+    ('Thermal design power', {'headers': ('[[Thermal Design Power|TDP]]', '[[Thermal design power|TDP]]', 'TDP'),
+                              'convert': functools.partial(_strip, ' W')}),
+])
+
+# Imported articles: title => parent (name of the Part the processors are
+# added to) and columns (see PROCESSOR_COLUMNS). The articles are only parsed
+# in parallel if more than one is imported (see iter_parsed_articles).
+ARTICLES = OrderedDict([
+    ('List_of_Intel_Pentium_4_microprocessors', {'parent': 'Pentium 4', 'columns': PROCESSOR_COLUMNS}),
+])
+
+
+def fix_table_row_dict(table_row_dicts, columns=PROCESSOR_COLUMNS):
     """ Returns the row dicts with unified keys. Cells containing multiple
     values are returned as list/dicts """
     fixed_data = []
-    left_over_cols = set()
     for row in table_row_dicts:
         fixed_row = {}
-        model_number = pop_one_of(row, ('Model Number', 'Model Number  Clock Speed'))
+        model_number = pop_one_of(row, columns['name']['headers'], assert_when_missing=False)
+        # Not a table of processors
+        if model_number is None:
+            continue
         fixed_row['name'], fixed_row['URL'] = parse_maybe_url(model_number)
 
-        seperators = []
-        sspec_number = pop_one_of(row, ('sSpec&nbsp;Number', 'sSpec number', 'sSpec Number'))
-        if '\n' in sspec_number:
-            seperators.append('\n')
-        if '<br>' in sspec_number:
-            seperators.append('<br>')
-        if len(seperators) > 1:
-            raise Exception('Line has newline and breaks, dont know what to do: %r'%sspec_number)
-        if seperators:
-            specs = sspec_number.split(seperators[0])
-        else:
-            specs = [sspec_number]
-
-        fixed_row['sspecs'] = []
-        for s in specs:
-            spec_name, spec_url = parse_maybe_url(s)
-            fixed_row['sspecs'].append(dict(name=spec_name, url=spec_url))
-
-        fixed_row['Frequency'] = pop_one_of(row, ['Frequency', 'Clock Speed'])
-        if fixed_row['Frequency'].endswith('&nbsp;GHz'):
-            fixed_row['Frequency'] = str(int(float(fixed_row['Frequency'].strip('&nbsp;GHz')) * 1000))
-
-        price = pop_one_of(row, ['Release Price (USD)', ], assert_when_missing=False)
-        if price is not None:
-            fixed_row['Release price'] = price
-
-        fixed_row['Clock multiplier'] = pop_one_of(row, ['Multiplier', 'Clock Multiplier', '[[clock multiplier|Mult]]'])
-        fixed_row['Clock multiplier'] = fixed_row['Clock multiplier'].strip('×'.decode('utf-8'))
-
-        fixed_row['Part number'] = multi_split(pop_one_of(row, ['Part Number(s)']), ['\n', '<br>'])
-        fixed_row['Voltage range'] = pop_one_of(row, ['Voltage', 'Voltage Range'])
-        fixed_row['Front side bus'] = pop_one_of(row, ['[[Front Side Bus]]', 'FSB Speed']).strip(' MT/s')
-        fixed_row['Release date'] = pop_one_of(row, ['Release Date', ])
-        fixed_row['L2 cache'] = pop_one_of(row, ['L2 Cache', '[[CPU caches#Multi-level caches|L2-Cache]]'])
-        fixed_row['Socket'] = pop_one_of(row, ['Socket', '[[CPU socket|Socket]]'])
-        fixed_row['Thermal design power'] = pop_one_of(row, ['[[Thermal Design Power|TDP]]', '[[Thermal design power|TDP]]', 'TDP']).strip(' W')
+        for key, column in columns.items():
+            if key == 'name':
+                continue
+            value = pop_one_of(row, column['headers'],
+                               assert_when_missing=not column.get('optional', False))
+            if value is not None:
+                convert = column.get('convert')
+                fixed_row[key] = convert(value) if convert else value
 
         fixed_data.append(fixed_row)
 
-        #left_over_cols.update(row.keys())
-
     return fixed_data
 
 
@@ -179,7 +543,7 @@ def replace_html_chars(table_row_dicts):
     """ Replaces &nbsp; with a blank and decodes utf-8 """
     for row in table_row_dicts:
         for k in row:
-            if isinstance(row[k], basestring):
+            if isinstance(row[k], six.string_types):
                 row[k] = row[k].replace('&nbsp;', ' ')
 
                 # doesnt seem to work when getting the text via HTTP (and not from the file)
@@ -193,30 +557,356 @@ def replace_html_chars(table_row_dicts):
                 raise Exception()
 
 
-def insert_record(attributes):
+def _prepare_record(attributes):
+    """ Returns the name and the attributes to store of a row """
     name = attributes.pop('name')
-    attributes.pop('Voltage range') # TODO
-    attributes.pop('Socket') # TODO
-    attributes.pop('Part number') # TODO
-    attributes.pop('sspecs') # TODO
-    if attributes['url'] is None:
-        attributes.pop('url')
-    part = M.Part.init(name, 'Pentium 4', attributes=attributes)
+    url = attributes.pop('URL', None)
+    if url is not None:
+        attributes['Source'] = url
+    for key in ('Voltage range', 'Socket', 'Part number', 'sspecs'):
+        attributes.pop(key, None) # TODO
+    return name, attributes
+
+
+def insert_record(attributes, parent_part_name='Pentium 4'):
+    name, attributes = _prepare_record(attributes)
+    part = M.Part.init(name, parent_part_name, attributes=attributes)
     M.db_session.add(part)
 
 
-def get_all_rows(wikitext):
-    all_dicts = []
-    tables = split_table_strings(wikitext)
-    for table in tables:
-        row_dicts = parse_table_rows(table)
-        fixed_row_dicts = fix_table_row_dict(row_dicts)
-        replace_html_chars(fixed_row_dicts)
-        all_dicts.extend(fixed_row_dicts)
+def _get_attr_types(connection, names):
+    """
+    Returns a dict AttrType name => (id, unit name, unit format, from_to)
+    with one query
+    """
+    attr_types = {}
+    for row in connection.execute(
+            select([M.AttrType.id, M.AttrType.name, M.AttrType.from_to,
+                    M.Unit.name.label('unit_name'), M.Unit.format]).
+                select_from(M.AttrType.__table__.join(M.Unit.__table__)).
+                where(M.AttrType.name.in_(list(names)))):
+        if row.name in attr_types:
+            raise Exception('Multiple AttrTypes found with name %r' % row.name)
+        attr_types[row.name] = (row.id, row.unit_name, row.format, row.from_to)
+    for name in names:
+        if name not in attr_types:
+            raise Exception('No AttrType found with name %r' % name)
+    return attr_types
+
+
+def _get_attr_ids(connection, keys):
+    """ Returns a dict (attr type id, value) => id of the existing Attrs """
+    attr = M.Attr.__table__
+    attr_ids = {}
+    attr_type_ids = list(set(attr_type_id for attr_type_id, value in keys))
+    values = sorted(set(value for attr_type_id, value in keys))
+    for i in range(0, len(values), 500):
+        for attr_id, attr_type_id, value in connection.execute(
+                select([attr.c.id, attr.c.attr_type_id, attr.c.value]).
+                    where(and_(attr.c.attr_type_id.in_(attr_type_ids),
+                               attr.c.value.in_(values[i:i + 500])))):
+            if (attr_type_id, value) in keys:
+                attr_ids[(attr_type_id, value)] = attr_id
+    return attr_ids
+
+
+def _get_content_hash(values):
+    """ Hash of the (attr type id, value) pairs of a record """
+    return hashlib.sha1(json.dumps(sorted(values)).encode('utf-8')).hexdigest()
+
+
+class _RecordWriter(object):
+    """
+    Writes the records (name, attributes) of one parent with executemany
+    statements instead of the ORM. The parent, the AttrTypes, the allowed
+    AttrTypes and the existing Attrs are looked up once for all records,
+    Attrs with the same value are shared.
+    Like in BulkImporter the new Parts and Attrs are inserted one by one, so
+    the database assigns their ids.
+    """
+    def __init__(self, connection, records, parent_part_name):
+        self.connection = connection
+        self.parent_id = M.Part.search(parent_part_name).id
+        # A new Part has no AttrTypes of its own, it's allowed what the parent is
+        allowed_ids = M.get_attr_type_resolver().get_allowed_attr_type_ids(self.parent_id)
+        self.ancestors = [(ancestor_id, depth + 1) for ancestor_id, depth in connection.execute(
+            select([M.part_closure.c.ancestor_id, M.part_closure.c.depth]).
+                where(M.part_closure.c.descendant_id==self.parent_id))]
+        attr_types = _get_attr_types(connection, set(
+            attr_type_name for name, attributes in records for attr_type_name in attributes))
+        # AttrType id => arguments of parse_numeric_value
+        self.units = dict((attr_type[0], attr_type[1:]) for attr_type in six.itervalues(attr_types))
+
+        # Convert the values and check the AttrTypes before anything is written:
+        # list of (name, list of (attr type id, value))
+        self.values = []
+        for name, attributes in records:
+            record_values = []
+            for attr_type_name, value in sorted(six.iteritems(attributes)):
+                attr_type_id = attr_types[attr_type_name][0]
+                if attr_type_id not in allowed_ids:
+                    raise Exception('AttrType %s is not registered for %s' % (attr_type_name, name))
+                record_values.append((attr_type_id, six.text_type(value)))
+            self.values.append((name, record_values))
+        self.attr_ids = _get_attr_ids(connection, set(
+            key for name, keys in self.values for key in keys))
+
+        # Ids of the inserted or changed Parts
+        self.part_ids = []
+        # Names of the tables inserted into before write()
+        self.inserted_table_names = set()
+        # table => list of row dicts, in the order in which they are inserted
+        self.rows = OrderedDict((table, []) for table in (
+            M.part_closure, M.PartAttrMap.__table__, M.imported_part))
+        # (part id, attr id) of the PartAttrMaps to delete
+        self.deleted_attr_maps = []
+
+    def _insert(self, table, row):
+        """ Inserts the row, returns the id assigned by the database """
+        self.inserted_table_names.add(table.name)
+        return self.connection.execute(table.insert(), row).inserted_primary_key[0]
+
+    def _get_attr_id(self, key):
+        if key not in self.attr_ids:
+            value_from, value_to = M.parse_numeric_value(key[1], *self.units[key[0]])
+            self.attr_ids[key] = self._insert(M.Attr.__table__, dict(
+                attr_type_id=key[0], value=key[1],
+                value_from=value_from, value_to=value_to))
+        return self.attr_ids[key]
+
+    def add_part(self, name, values):
+        part_id = self._insert(M.Part.__table__, dict(
+            name=name, note=None, parent_part_id=self.parent_id,
+            is_standard=False, is_connector=False, is_system=False))
+        self.rows[M.part_closure].extend(
+            dict(ancestor_id=ancestor_id, descendant_id=part_id, depth=depth)
+            for ancestor_id, depth in [(part_id, 0)] + self.ancestors)
+        self.set_attributes(part_id, values, {})
+
+    def set_attributes(self, part_id, values, current_attr_ids):
+        """
+        Sets the attributes of the Part to values (list of (attr type id,
+        value)). Existing attributes of the same AttrTypes are replaced.
+        current_attr_ids: attr type id => set of the current attr ids
+        """
+        attr_ids = set(self._get_attr_id(key) for key in values)
+        for attr_type_id in set(attr_type_id for attr_type_id, value in values):
+            for attr_id in current_attr_ids.get(attr_type_id, ()):
+                if attr_id not in attr_ids:
+                    self.deleted_attr_maps.append(dict(part_id=part_id, attr_id=attr_id))
+        current = set(attr_id for ids in six.itervalues(current_attr_ids) for attr_id in ids)
+        for attr_id in sorted(attr_ids - current):
+            self.rows[M.PartAttrMap.__table__].append(dict(part_id=part_id, attr_id=attr_id))
+        self.rows[M.imported_part].append(dict(part_id=part_id,
+                                               content_hash=_get_content_hash(values)))
+        self.part_ids.append(part_id)
+
+    def _delete_orphan_attrs(self):
+        """
+        Deletes the Attrs of the deleted PartAttrMaps which aren't used by
+        any Part anymore (like sync._Sync._delete_orphan_attrs). Returns
+        whether any were deleted.
+        """
+        attr_ids = sorted(set(row['attr_id'] for row in self.deleted_attr_maps))
+        attr = M.Attr.__table__
+        attr_map = M.PartAttrMap.__table__
+        deleted = 0
+        for i in range(0, len(attr_ids), 500):
+            deleted += self.connection.execute(attr.delete().where(and_(
+                attr.c.id.in_(attr_ids[i:i + 500]),
+                ~exists().where(attr_map.c.attr_id==attr.c.id)))).rowcount
+        return deleted > 0
+
+    def write(self):
+        """ Executes the collected statements """
+        connection = self.connection
+        table_names = sorted(self.inserted_table_names)
+        if self.deleted_attr_maps:
+            attr_map = M.PartAttrMap.__table__
+            connection.execute(attr_map.delete().where(and_(
+                attr_map.c.part_id==bindparam('b_part_id'),
+                attr_map.c.attr_id==bindparam('b_attr_id'))),
+                [dict(b_part_id=row['part_id'], b_attr_id=row['attr_id'])
+                 for row in self.deleted_attr_maps])
+            table_names.append(attr_map.name)
+        if self.part_ids:
+            connection.execute(M.imported_part.delete().where(
+                M.imported_part.c.part_id.in_(self.part_ids)))
+        for table, rows in six.iteritems(self.rows):
+            if rows:
+                connection.execute(table.insert(), rows)
+                table_names.append(table.name)
+        if not self.part_ids:
+            return
+        # The ORM events were bypassed, see BulkImporter.write
+        M.refresh_effective_attrs(connection, self.part_ids)
+        if self._delete_orphan_attrs():
+            table_names.append(M.Attr.__table__.name)
+        M.bump_table_versions(connection, table_names)
+        fulltext.update_index(self.part_ids, connection)
+        M.clear_session_caches()
+
+
+def _get_writer(rows, parent_part_name, connection):
+    if connection is None:
+        # The parent might not be flushed yet
+        M.db_session.flush()
+        connection = M.db_session.connection()
+    records = [_prepare_record(dict(row)) for row in rows]
+    return _RecordWriter(connection, records, parent_part_name)
+
+
+def insert_records(rows, parent_part_name='Pentium 4', connection=None):
+    """
+    Bulk version of insert_record: inserts a Part for every row with
+    executemany inserts instead of the ORM (see _RecordWriter).
+    Returns the ids of the new Parts.
+    """
+    if not rows:
+        return []
+    writer = _get_writer(rows, parent_part_name, connection)
+    for name, values in writer.values:
+        writer.add_part(name, values)
+    writer.write()
+    return writer.part_ids
+
 
+def upsert_records(rows, parent_part_name='Pentium 4', connection=None):
+    """
+    Like insert_records, but a row updates the existing Part with the same
+    name and parent instead of adding another one. The attributes of the
+    AttrTypes in the row are replaced, the others are kept. Parts whose row
+    didn't change since the last import (see model.imported_part) are
+    skipped. Of rows with the same name the last one is used.
+    Returns the numbers of (inserted, updated, unchanged) Parts. They are
+    counted per distinct name, so they don't add up to the number of rows
+    if names are repeated.
+    """
+    if not rows:
+        return 0, 0, 0
+    writer = _get_writer(rows, parent_part_name, connection)
+    part = M.Part.__table__
+    # name => values, the last row of a name wins
+    values = OrderedDict(writer.values)
+    names = list(values)
+
+    # name => (id, content hash) of the existing Parts, the oldest Part of a
+    # name is updated
+    existing = {}
+    for i in range(0, len(names), 500):
+        for part_id, name, content_hash in writer.connection.execute(
+                select([part.c.id, part.c.name, M.imported_part.c.content_hash]).
+                    select_from(part.outerjoin(M.imported_part)).
+                    where(and_(part.c.parent_part_id==writer.parent_id,
+                               part.c.name.in_(names[i:i + 500]))).
+                    order_by(part.c.id.desc())):
+            existing[name] = (part_id, content_hash)
+
+    changed = dict((existing[name][0], name) for name in names
+                   if name in existing and
+                   existing[name][1] != _get_content_hash(values[name]))
+    # part id => attr type id => set of attr ids
+    current_attr_ids = dict((part_id, {}) for part_id in changed)
+    part_ids = list(changed)
+    for i in range(0, len(part_ids), 500):
+        for part_id, attr_id, attr_type_id in writer.connection.execute(
+                select([M.PartAttrMap.part_id, M.Attr.id, M.Attr.attr_type_id]).
+                    select_from(M.PartAttrMap.__table__.join(M.Attr.__table__)).
+                    where(M.PartAttrMap.part_id.in_(part_ids[i:i + 500]))):
+            current_attr_ids[part_id].setdefault(attr_type_id, set()).add(attr_id)
+
+    inserted = updated = 0
+    for name in names:
+        if name not in existing:
+            writer.add_part(name, values[name])
+            inserted += 1
+        elif existing[name][0] in changed:
+            part_id = existing[name][0]
+            writer.set_attributes(part_id, values[name], current_attr_ids[part_id])
+            updated += 1
+    writer.write()
+    return inserted, updated, len(names) - inserted - updated
+
+
+def get_all_rows(wikitext, columns=PROCESSOR_COLUMNS):
+    all_dicts = fix_table_row_dict(iter_table_rows(wikitext), columns)
+    replace_html_chars(all_dicts)
     return all_dicts
 
 
+# Multi-article import
+def _parse_article(args):
+    """ Runs in the parsing processes """
+    title, wikitext, columns = args
+    return title, get_all_rows(wikitext, columns)
+
+
+def iter_parsed_articles(titles, fetcher, articles=ARTICLES, processes=None):
+    """
+    Fetches and parses the articles concurrently and yields (title, rows) in
+    the order the articles are finished. The articles are fetched by
+    FETCH_THREADS threads and parsed by a pool of processes (default: one
+    per CPU). With processes=1 or a single title they are parsed in this
+    process.
+    """
+    for title in titles:
+        if title not in articles:
+            raise Exception('No mapping configured for Wikipedia article %r' % title)
+
+    fetch_pool = ThreadPool(max(min(len(titles), FETCH_THREADS), 1))
+    parse_pool = None
+    try:
+        fetched = fetch_pool.imap_unordered(lambda title: (title, fetcher.fetch(title)), titles)
+        tasks = ((title, wikitext, articles[title]['columns']) for title, wikitext in fetched)
+        processes = processes or multiprocessing.cpu_count()
+        if processes > 1 and len(titles) > 1:
+            parse_pool = multiprocessing.Pool(processes)
+            results = parse_pool.imap_unordered(_parse_article, tasks)
+        else:
+            results = six.moves.map(_parse_article, tasks)
+        for title, rows in results:
+            yield title, rows
+    finally:
+        for pool in (fetch_pool, parse_pool):
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+def insert_articles(parsed_articles, articles=ARTICLES, batch_size=BATCH_SIZE, upsert=False):
+    """
+    Single writer for the rows of iter_parsed_articles. The rows are inserted
+    with insert_records (upsert_records if upsert is True), one transaction
+    per batch_size rows. Returns the numbers of (inserted, updated,
+    unchanged) Parts.
+    """
+    counts = [0, 0, 0]
+    for title, rows in parsed_articles:
+        parent_part_name = articles[title]['parent']
+        for i in range(0, len(rows), batch_size):
+            if upsert:
+                batch_counts = upsert_records(rows[i:i + batch_size], parent_part_name)
+            else:
+                batch_counts = (len(insert_records(rows[i:i + batch_size], parent_part_name)), 0, 0)
+            counts = [count + batch_count for count, batch_count in zip(counts, batch_counts)]
+            M.db_session.commit()
+    return tuple(counts)
+
+
+def import_articles(titles=None, fetcher=None, articles=ARTICLES, processes=None,
+                    batch_size=BATCH_SIZE, upsert=False):
+    """
+    Imports the processors of the articles (default: all of articles).
+    With upsert the Parts of a previous import are updated instead of added
+    again (see upsert_records).
+    Returns the numbers of (inserted, updated, unchanged) Parts, counted per
+    distinct name of a batch.
+    """
+    fetcher = fetcher or ArticleFetcher(HttpTransport())
+    parsed_articles = iter_parsed_articles(list(titles or articles), fetcher, articles, processes)
+    return insert_articles(parsed_articles, articles, batch_size, upsert)
+
+
 if __name__ == '__main__':
-    wikitext = open('wikiarticle.txt').read()
-    print(get_all_rows(wikitext))
+    with io.open('wikiarticle.txt', encoding='utf-8') as f:
+        print(get_all_rows(f))
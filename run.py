@@ -19,8 +19,12 @@ import sadisplay
 
 import hwdb.model as M
 from hwdb import ui
+from hwdb import api
+from hwdb import fulltext
 from hwdb import wikipedia
 from hwdb import init_data
+from hwdb import query_plans
+from hwdb import sync
 
 
 data_path = os.environ.get('DATA_PATH', '.')
@@ -28,6 +32,13 @@ data_path = os.environ.get('DATA_PATH', '.')
 filepath = os.path.join(data_path, 'hwdb4.sqlite')
 dbpath = 'sqlite:///' + filepath
 static_folder = os.path.join(data_path, 'hwdb/static')
+# Optional directory to persist the rendered trees of the UI
+fragment_cache_path = os.environ.get('FRAGMENT_CACHE_PATH')
+# Downloaded Wikipedia articles
+wikipedia_cache_path = os.environ.get('WIKIPEDIA_CACHE_PATH',
+                                      os.path.join(data_path, 'wikipedia_cache'))
+# Optional directory with articles (<title>.txt) used instead of the network
+wikipedia_fixtures_path = os.environ.get('WIKIPEDIA_FIXTURES_PATH')
 
 debug = False
 
@@ -44,6 +55,8 @@ def _make_app():
     app.config['SQLALCHEMY_ECHO'] = False
     app.secret_key = 'Todo'
     app.register_blueprint(ui.bp)
+    app.register_blueprint(api.bp)
+    ui.fragment_cache.directory = fragment_cache_path
 
     db = SQLAlchemy(app)
     M.db_session = db.session
@@ -51,6 +64,10 @@ def _make_app():
 
 
 def run_ui(args):
+    # Databases created by older versions lack the newer tables
+    created = M.upgrade_db(M.get_engine(dbpath, debug))
+    if created:
+        print('Created the tables: %s' % ', '.join(created))
     app = _make_app()
     app.debug = True
     if False:
@@ -78,19 +95,21 @@ def reset_db(args):
     M.db_session.flush()
     init_data.import_attr_types()
     M.db_session.flush()
-    init_data.import_parts()
-    init_data.import_standards()
-    M.db_session.flush()
-    init_data.import_connectors()
-    init_data.import_subparts()
+    if args.bulk:
+        init_data.bulk_import_parts()
+    else:
+        init_data.import_parts()
+        init_data.import_standards()
+        M.db_session.flush()
+        init_data.import_connectors()
+        init_data.import_subparts()
     M.db_session.flush()
     init_data.import_systems()
+    M.db_session.flush()
+    sync.record_seeded_keys(sync.DataState.from_data())
 
     if args.wikipedia:
-        wikitext = wikipedia.fetch_from_wikipedia()
-        all_rows = wikipedia.get_all_rows(wikitext)
-        for d in all_rows:
-            wikipedia.insert_record(d)
+        _import_wikipedia(args, upsert=False)
 
     M.db_session.commit()
     M.db_session.close()
@@ -98,6 +117,99 @@ def reset_db(args):
     _make_ER()
 
 
+def _make_wikipedia_fetcher(args):
+    if wikipedia_fixtures_path:
+        transport = wikipedia.FixtureTransport(wikipedia_fixtures_path)
+    elif args.offline:
+        transport = None
+    else:
+        transport = wikipedia.HttpTransport()
+    return wikipedia.ArticleFetcher(transport, wikipedia.ArticleCache(wikipedia_cache_path))
+
+
+def _import_wikipedia(args, upsert):
+    fetcher = _make_wikipedia_fetcher(args)
+    inserted, updated, unchanged = wikipedia.import_articles(
+        args.wikipedia_title, fetcher, processes=args.processes, upsert=upsert)
+    print('Wikipedia articles: %s downloaded, %s from the cache' % (fetcher.downloads, fetcher.hits))
+    print('Processors inserted: %s  updated: %s  unchanged: %s' % (inserted, updated, unchanged))
+
+
+def import_wikipedia(args):
+    engine = M.get_engine(dbpath, debug)
+    M.create_all(engine)
+    M.init_scoped_session(engine)
+    _import_wikipedia(args, upsert=True)
+    M.db_session.commit()
+    M.db_session.close()
+
+
+def sync_db(args):
+    engine = M.get_engine(dbpath, debug)
+    M.create_all(engine)
+    M.init_scoped_session(engine)
+    stats, moved_parts = sync.sync_db()
+    M.db_session.commit()
+    M.db_session.close()
+    for table, (inserted, updated, deleted) in stats.items():
+        print('%-20s inserted: %4s  updated: %4s  deleted: %4s' % (table, inserted, updated, deleted))
+    for name, deleted_parent, new_parent in moved_parts:
+        print('Moved %s from the deleted Part %s to %s' % (name, deleted_parent, new_parent or 'the top level'))
+
+
+def rebuild_part_closure(args):
+    engine = M.get_engine(dbpath, debug)
+    M.create_all(engine)
+    M.init_scoped_session(engine)
+    M.rebuild_part_closure()
+    M.db_session.commit()
+    M.db_session.close()
+    print('Rebuilt the closure table of the Part hierarchy')
+
+
+def rebuild_effective_attrs(args):
+    engine = M.get_engine(dbpath, debug)
+    M.create_all(engine)
+    M.init_scoped_session(engine)
+    M.rebuild_effective_attrs()
+    M.db_session.commit()
+    M.db_session.close()
+    print('Rebuilt the effective attributes of the Parts')
+
+
+def rebuild_fulltext_index(args):
+    engine = M.get_engine(dbpath, debug)
+    M.create_all(engine)
+    M.init_scoped_session(engine)
+    fulltext.rebuild_index()
+    M.db_session.commit()
+    M.db_session.close()
+    print('Rebuilt the full-text index of the Parts')
+
+
+def update_numeric_values(args):
+    engine = M.get_engine(dbpath, debug)
+    M.create_all(engine)
+    M.init_scoped_session(engine)
+    updated = M.update_numeric_values()
+    M.db_session.commit()
+    M.db_session.close()
+    print('Updated the numeric values of %s attributes' % updated)
+
+
+def create_indexes(args):
+    engine = M.get_engine(dbpath, debug)
+    created = M.create_indexes(engine)
+    print('Created indexes: %s' % (', '.join(created) or '-'))
+
+
+def check_query_plans(args):
+    engine = M.get_engine(dbpath, debug)
+    M.init_scoped_session(engine)
+    query_plans.check_query_plans()
+    print('All checked queries use an index')
+
+
 def _make_ER():
     desc = sadisplay.describe(M.get_model_classes().values())
     if not os.path.exists(static_folder):
@@ -121,13 +233,25 @@ if __name__ == '__main__':
     COMMANDS = {
         'run_ui': run_ui,
         'reset_db': reset_db,
+        'sync_db': sync_db,
+        'import_wikipedia': import_wikipedia,
+        'rebuild_part_closure': rebuild_part_closure,
+        'rebuild_effective_attrs': rebuild_effective_attrs,
+        'rebuild_fulltext_index': rebuild_fulltext_index,
+        'update_numeric_values': update_numeric_values,
+        'create_indexes': create_indexes,
+        'check_query_plans': check_query_plans,
     }
 
 
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('command', choices=COMMANDS.keys(), help='Run one of the commands')
     parser.add_argument('--force', action="store_true", help='Force yes on user input for the given command')
-    parser.add_argument('--wikipedia', action="store_true", help='Parse Pentium 4 tables from Wikipedia')
+    parser.add_argument('--bulk', action="store_true", help='reset_db: Insert the parts with bulk inserts instead of the ORM')
+    parser.add_argument('--wikipedia', action="store_true", help='Parse processor tables from Wikipedia')
+    parser.add_argument('--wikipedia-title', action="append", help='reset_db, import_wikipedia: Title of a Wikipedia article to import (default: %s)' % ', '.join(wikipedia.ARTICLES))
+    parser.add_argument('--processes', type=int, help='reset_db, import_wikipedia: Number of processes parsing Wikipedia articles if more than one is imported (default: number of CPUs)')
+    parser.add_argument('--offline', action="store_true", help='reset_db, import_wikipedia: Only use the cached Wikipedia articles')
 
     args = parser.parse_args()
 
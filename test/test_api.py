@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from flask import Flask
+
+import hwdb.model as M
+from hwdb import api
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class Test_api(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_api, self).setUp()
+        app = Flask(__name__)
+        app.register_blueprint(api.bp)
+        self.client = app.test_client()
+
+        unit = M.Unit(name='Hertz', label='Hz')
+        self.frequency = M.AttrType(name='Frequency', unit=unit)
+        self.cpu = M.Part(name='CPU')
+        self.sse2 = M.Part(name='SSE2', is_standard=True)
+        self.b1 = M.Part(name='B', parent_part=self.cpu)
+        self.b2 = M.Part(name='B', parent_part=self.cpu)
+        self.a = M.Part(name='A', parent_part=self.cpu)
+        M.db_session.add_all([self.frequency, self.cpu, self.sse2, self.b1, self.b2, self.a])
+        M.db_session.flush()
+        M.db_session.add(M.PartAttrTypeMap(part=self.cpu, attr_type=self.frequency))
+        M.db_session.flush()
+        self.a.add_attributes({'Frequency': '2000'})
+        self.b1.add_attributes({'Frequency': '3000'})
+        self.b1.add_standards('SSE2')
+        M.db_session.flush()
+
+
+    def _get(self, url, **params):
+        response = self.client.get(url, query_string=params)
+        self.assertEqual(200, response.status_code)
+        return response.get_json()
+
+
+    def test_keyset_pages(self):
+        ids = []
+        page = self._get('/api/parts', limit=2, fields='id')
+        while True:
+            ids.extend(part['id'] for part in page['parts'])
+            if not page['next']:
+                break
+            page = self._get('/api/parts', limit=2, fields='id', after=page['next'])
+        self.assertEqual([self.a.id, self.b1.id, self.b2.id, self.cpu.id, self.sse2.id], ids)
+
+    def test_fields(self):
+        page = self._get('/api/units', fields='name,label')
+        self.assertEqual([{'name': 'Hertz', 'label': 'Hz'}], page['units'])
+        self.assertEqual(400, self.client.get('/api/units?fields=password').status_code)
+        self.assertEqual(400, self.client.get('/api/units?after=x').status_code)
+
+    def test_part_filters(self):
+        names = lambda **params: [part['name'] for part in
+                                  self._get('/api/parts', fields='name', **params)['parts']]
+        self.assertEqual(['A', 'B', 'B'], names(parent=self.cpu.id))
+        self.assertEqual(['CPU'], names(attr_type='Frequency'))
+        self.assertEqual([self.b1.id], [part['id'] for part in
+                                        self._get('/api/parts', standard='SSE2')['parts']])
+        self.assertEqual(['B'], names(attr='Frequency', min=2500))
+
+    def test_attributes(self):
+        page = self._get('/api/attributes', attr_type='Frequency', fields='value,attr_type')
+        self.assertEqual([{'value': '2000', 'attr_type': 'Frequency'},
+                          {'value': '3000', 'attr_type': 'Frequency'}], page['attributes'])
+        page = self._get('/api/attributes', part=self.b1.id, fields='value')
+        self.assertEqual([{'value': '3000'}], page['attributes'])
+        page = self._get('/api/attr_types', part=self.cpu.id, fields='name,unit')
+        self.assertEqual([{'name': 'Frequency', 'unit': 'Hertz'}], page['attr_types'])
+
+    def test_search(self):
+        page = self._get('/api/search', q='Frequency>=2500 and supports SSE2', fields='id')
+        self.assertEqual([{'id': self.b1.id}], page['parts'])
+        self.assertEqual(400, self.client.get('/api/search?q=Frequency>fast').status_code)
@@ -0,0 +1,91 @@
+from multiprocessing.pool import ThreadPool
+import shutil
+import tempfile
+from unittest import TestCase
+
+from hwdb import cache
+from hwdb.cache import FragmentCache
+
+
+class Test_FragmentCache(TestCase):
+    def test_version(self):
+        cache = FragmentCache()
+        cache.set('parts', (1, 1.0), '<ul></ul>')
+        self.assertEqual('<ul></ul>', cache.get('parts', (1, 1.0)))
+        self.assertEqual(None, cache.get('parts', (2, 2.0)))
+        self.assertEqual(None, cache.get('standards', (1, 1.0)))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_get_or_render(self):
+        cache = FragmentCache()
+        calls = []
+        render = lambda: calls.append(1) or '<ul></ul>'
+        self.assertEqual('<ul></ul>', cache.get_or_render('parts', 1, render))
+        self.assertEqual('<ul></ul>', cache.get_or_render('parts', 1, render))
+        self.assertEqual(1, len(calls))
+        cache.get_or_render('parts', 2, render)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, len(cache))
+
+    def test_lru(self):
+        cache = FragmentCache(max_size=2)
+        cache.set('a', 1, 'A')
+        cache.set('b', 1, 'B')
+        cache.get('a', 1)
+        cache.set('c', 1, 'C')
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get('b', 1))
+        self.assertEqual('A', cache.get('a', 1))
+
+    def test_threads(self):
+        cache = FragmentCache(max_size=5)
+        def render(i):
+            name = 'fragment %s' % (i % 10)
+            return cache.get_or_render(name, i % 3, lambda: name)
+        pool = ThreadPool(8)
+        try:
+            fragments = pool.map(render, range(2000))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(['fragment %s' % (i % 10) for i in range(2000)], fragments)
+        self.assertEqual(2000, cache.hits + cache.misses)
+        self.assertEqual(5, len(cache))
+
+    def test_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            FragmentCache(directory=directory).set('parts', (1, 1.5), u'<ul>\xe4</ul>')
+            cache = FragmentCache(directory=directory)
+            self.assertEqual(None, cache.get('parts', (2, 1.5)))
+            self.assertEqual(u'<ul>\xe4</ul>', cache.get('parts', (1, 1.5)))
+        finally:
+            shutil.rmtree(directory)
+
+
+
+class Test_validators(TestCase):
+    def test_changes_within_one_second(self):
+        # Changed at 100.3: no Last-Modified until the second is over
+        versions = {'part': (1, 100.3)}
+        self.assertEqual(None, cache.get_last_modified(versions, now=100.5))
+        self.assertFalse(cache.is_not_modified('a', None, if_modified_since=100))
+        self.assertEqual(101, cache.get_last_modified(versions, now=101.0))
+
+        # Changed again at 100.7, within the same second
+        versions = {'part': (2, 100.7)}
+        self.assertEqual(101, cache.get_last_modified(versions, now=101.2))
+        # A client which got Last-Modified 101 has the content of both changes
+        self.assertTrue(cache.is_not_modified('b', 101, if_modified_since=101))
+
+        # Changed at 101.3: a client having 101 gets the new content
+        versions = {'part': (3, 101.3)}
+        last_modified = cache.get_last_modified(versions, now=102.0)
+        self.assertEqual(102, last_modified)
+        self.assertFalse(cache.is_not_modified('c', last_modified, if_modified_since=101))
+
+    def test_etag_takes_precedence(self):
+        etag = cache.get_etag('/parts', ['part'], {'part': (1, 1.0)})
+        self.assertNotEqual(etag, cache.get_etag('/parts', ['part'], {'part': (2, 1.0)}))
+        self.assertFalse(cache.is_not_modified(etag, 1, lambda e: e == 'old', 10))
+        self.assertTrue(cache.is_not_modified(etag, 1, lambda e: e == etag))
@@ -0,0 +1,140 @@
+from multiprocessing.pool import ThreadPool
+from unittest import TestCase
+
+import hwdb.model as M
+from hwdb import fulltext
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class Test_fulltext(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_fulltext, self).setUp()
+        text = M.Unit(name='text', label='Text')
+        kb = M.Unit(name='KB', label='Kilobyte', format='%(unit)s Kilobyte')
+        codename = M.AttrType(name='Codename', unit=text)
+        l2_cache = M.AttrType(name='L2 cache', unit=kb)
+        cpu = M.Part(name='CPU', note='Central processing unit')
+        M.db_session.add_all([M.PartAttrTypeMap(part=cpu, attr_type=codename),
+                              M.PartAttrTypeMap(part=cpu, attr_type=l2_cache)])
+        M.db_session.flush()
+        for name, note, attributes in [
+                ('Pentium 4', 'Intel processor with the Netburst architecture', {}),
+                ('Athlon', 'AMD processor', {'Codename': 'Thunderbird', 'L2 cache': '256'}),
+                ('Thunderbird', None, {})]:
+            part = M.Part(name=name, note=note, parent_part=cpu)
+            part.add_attributes(attributes)
+        M.db_session.flush()
+
+
+    def _search(self, text, **kwargs):
+        return [part.name for part in fulltext.search(text, **kwargs)]
+
+
+    def _check_search(self):
+        self.assertEqual(['Pentium 4'], self._search('netburst'))
+        # Prefixes of all words have to match
+        self.assertEqual(['Pentium 4'], self._search('proc int'))
+        self.assertEqual(['Athlon', 'Pentium 4'], sorted(self._search('processor')))
+        # A matching name is ranked higher than a text attribute
+        self.assertEqual(['Thunderbird', 'Athlon'], self._search('thunder'))
+        # AttrType names are indexed, numeric values not
+        self.assertEqual(['Athlon', 'CPU'], sorted(self._search('l2 cache')))
+        self.assertEqual([], self._search('256'))
+        self.assertEqual([], self._search(' ,. '))
+        self.assertEqual(['Athlon'], self._search('thunder', limit=1, offset=1))
+
+        # Changes of the transaction are indexed before a search
+        pentium4 = M.Part.search('Pentium 4')
+        pentium4.note = 'Intel processor'
+        M.Part.search('Athlon').add_attributes({'Codename': 'Palomino'})
+        M.db_session.delete(M.Part.search('Thunderbird'))
+        M.db_session.flush()
+        self.assertEqual([], self._search('netburst'))
+        self.assertEqual(['Athlon'], self._search('palomino'))
+        self.assertEqual(['Athlon'], self._search('thunder'))
+
+        M.AttrType.search('L2 cache').name = 'Second level cache'
+        M.db_session.flush()
+        self.assertEqual(['Athlon', 'CPU'], sorted(self._search('second level')))
+        self.assertEqual([], self._search('l2'))
+
+    def test_fts5(self):
+        self.assertIsInstance(fulltext._get_index(M.db_session.connection()),
+                              fulltext._Fts5Index)
+        self._check_search()
+
+    def test_indexed_on_commit(self):
+        M.db_session.add(M.Part(name='Celeron'))
+        M.db_session.commit()
+        self.assertNotIn('fulltext_changes', M.db_session.info)
+        self.assertEqual(1, M.db_session.execute(
+            "SELECT count(*) FROM part_fts WHERE part_fts MATCH 'celeron'").scalar())
+
+    def test_memory_index(self):
+        fulltext._indexes[M.db_session.connection().engine] = fulltext._MemoryIndex()
+        self._check_search()
+
+    def test_memory_index_commit(self):
+        index = fulltext._indexes[M.db_session.connection().engine] = fulltext._MemoryIndex()
+        M.db_session.commit()
+        self.assertEqual([], self._search('celeron'))
+        M.db_session.add(M.Part(name='Celeron'))
+        M.db_session.flush()
+        # Other threads don't see the uncommitted Part
+        self.assertEqual(['Celeron'], self._search('celeron'))
+        self.assertNotIn('celeron', index._postings)
+        M.db_session.commit()
+        self.assertIn('celeron', index._postings)
+        self.assertEqual(M.get_table_versions(fulltext.TABLES), index.versions)
+
+        M.db_session.add(M.Part(name='Duron'))
+        M.db_session.flush()
+        self.assertEqual(['Duron'], self._search('duron'))
+        M.db_session.rollback()
+        self.assertEqual([], self._search('duron'))
+        self.assertNotIn('fulltext_index', M.db_session.info)
+
+    def test_memory_index_changed_without_orm(self):
+        fulltext._indexes[M.db_session.connection().engine] = fulltext._MemoryIndex()
+        self.assertEqual([], self._search('celeron'))
+        connection = M.db_session.connection()
+        connection.execute(M.Part.__table__.insert().values(name='Celeron'))
+        M.bump_table_versions(connection, ['part'])
+        self.assertEqual(['Celeron'], self._search('celeron'))
+
+
+
+class Test_MemoryIndex(TestCase):
+    def test_threads(self):
+        index = fulltext._MemoryIndex()
+        index.versions = {}
+        def work(i):
+            if i % 2:
+                doc = {'name': 'Part %s' % i, 'note': '', 'attrs': ''}
+                index.apply([i], {i: doc}, {})
+                return None
+            # Like search() without the version check
+            with index._lock:
+                return index._search(['part'], 1000, 0)
+        pool = ThreadPool(8)
+        try:
+            pool.map(work, range(2000))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(1000, len(index._search(['part'], 1000, 0)))
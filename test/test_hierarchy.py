@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+from sqlalchemy import select
+
+import hwdb.model as M
+from hwdb import hierarchy
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class Test_part_hierarchy(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_part_hierarchy, self).setUp()
+        self.b = M.Part(name='B')
+        self.a = M.Part(name='A')
+        self.a2 = M.Part(name='A2', parent_part=self.a)
+        self.a1 = M.Part(name='A1', parent_part=self.a)
+        self.a11 = M.Part(name='A11', parent_part=self.a1, is_standard=True)
+        self.a111 = M.Part(name='A111', parent_part=self.a11)
+        M.db_session.add_all([self.b, self.a, self.a2, self.a1, self.a11, self.a111])
+        M.db_session.flush()
+
+
+    def _rows(self, tree, order_by):
+        return M.db_session.execute(select([tree]).order_by(order_by)).fetchall()
+
+
+    def test_descendants(self):
+        tree = hierarchy.part_descendants()
+        rows = self._rows(tree, hierarchy.sort_order(tree))
+        self.assertEqual(['A', 'A1', 'A11', 'A111', 'A2', 'B'], [r.name for r in rows])
+        self.assertEqual([0, 1, 2, 3, 1, 0], [r.depth for r in rows])
+        path = '%s/%s/%s/%s' % (self.a.id, self.a1.id, self.a11.id, self.a111.id)
+        self.assertEqual(path, rows[3].path)
+
+    def test_descendants_with_conditions(self):
+        tree = hierarchy.part_descendants(root_condition=M.Part.id==self.a.id,
+                                          condition=M.Part.is_standard==False)
+        rows = self._rows(tree, hierarchy.sort_order(tree))
+        self.assertEqual(['A', 'A1', 'A2'], [r.name for r in rows])
+
+    def test_descendants_same_name(self):
+        # Siblings with the same name are ordered by id, 9 before 10
+        parts = [M.Part(id=part_id, name='C') for part_id in (10, 9)]
+        parts.append(M.Part(id=11, name='C1', parent_part=parts[0]))
+        parts.append(M.Part(id=12, name='C1', parent_part=parts[1]))
+        M.db_session.add_all(parts)
+        M.db_session.flush()
+        tree = hierarchy.part_descendants(root_condition=M.Part.name=='C')
+        rows = self._rows(tree, hierarchy.sort_order(tree))
+        self.assertEqual(['9', '9/12', '10', '10/11'], [r.path for r in rows])
+
+    def test_ancestors(self):
+        tree = hierarchy.part_ancestors(self.a111.id)
+        rows = self._rows(tree, tree.c.depth)
+        self.assertEqual(['A111', 'A11', 'A1', 'A'], [r.name for r in rows])
+        self.assertEqual([0, 1, 2, 3], [r.depth for r in rows])
@@ -2,6 +2,7 @@ from unittest import TestCase
 
 #from hwdb.init_data import get_initial_objects, get_objects_computer_BA
 import hwdb.model as M
+from hwdb import init_data
 
 
 TEST_DB_PATH = 'sqlite:///:memory:'
@@ -33,3 +34,78 @@ class _Init_DB_Mixin(object):
         #M.db_session.flush()
 
         #M.db_session.commit()
+
+
+class Test_BulkImporter(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_BulkImporter, self).setUp()
+        unit = M.Unit(name='count', label='Count')
+        M.db_session.add_all([M.AttrType(name='Pin count', unit=unit),
+                              M.AttrType(name='Color', unit=unit),
+                              M.Part(name='Existing')])
+        M.db_session.flush()
+
+    def _import(self, elements, **part_kwargs):
+        importer = init_data.BulkImporter()
+        importer.add(elements, **part_kwargs)
+        importer.write()
+
+    def test_import(self):
+        self._import([
+            {'<name>': 'Socket', '<attr_types>': ['Pin count'], '<children>': [
+                {'<name>': 'Socket A', '<attrs>': {'Pin count': 240}},
+                {'<name>': 'Socket B', '<attrs>': {'Pin count': '240'},
+                 '<children>': [{'<name>': 'Socket B1'}]},
+            ]},
+        ])
+        self._import([{'<name>': 'Standard', '<children>': [{'<name>': 'S1'}]}],
+                     is_standard=True)
+        self._import([{'<name>': 'Existing', '<children>': [
+            {'<name>': 'Socket C', '<standards>': ['S1']},
+        ]}])
+
+        socket = M.Part.search('Socket')
+        self.assertEqual(['Socket A', 'Socket B', 'Socket B1'],
+                         sorted(p.name for p in socket.query_descendants()))
+        self.assertEqual(['Pin count'], [m.attr_type.name for m in socket.attr_type_maps])
+        self.assertTrue(M.Part.search('S1').is_standard)
+
+        attr = M.db_session.query(M.Attr).one()
+        self.assertEqual('240', attr.value)
+        self.assertEqual(['Socket A', 'Socket B'], sorted(m.part.name for m in attr.part_maps))
+
+        socket_c = M.Part.search('Socket C')
+        self.assertEqual('Existing', socket_c.parent_part.name)
+        self.assertEqual(['S1'], [m.container_part.name for m in socket_c.container_maps])
+        self.assertEqual([], socket_c.attr_maps)
+        self.assertEqual(['240'], [attr.value for attr, source_part_id in
+                                   M.Part.search('Socket B1').query_effective_attrs()])
+
+    def test_concurrent_insert(self):
+        # The ids are assigned by the database when the rows are added
+        importer = init_data.BulkImporter()
+        M.db_session.add(M.Part(name='Other'))
+        M.db_session.flush()
+        importer.add([{'<name>': 'Socket', '<children>': [{'<name>': 'Socket A'}]}])
+        importer.write()
+        self.assertEqual('Socket', M.Part.search('Socket A').parent_part.name)
+        self.assertEqual(4, M.db_session.query(M.Part).count())
+
+    def test_closure_table(self):
+        self._import([{'<name>': 'A', '<children>': [
+            {'<name>': 'A1', '<children>': [{'<name>': 'A11'}]}]}])
+        self._import([{'<name>': 'A1', '<children>': [{'<name>': 'A12'}]}])
+        rows = sorted(M.db_session.execute(M.part_closure.select()))
+        M.rebuild_part_closure()
+        self.assertEqual(sorted(M.db_session.execute(M.part_closure.select())), rows)
+
+    def test_attr_type_of_existing_part(self):
+        # The AttrType is registered for an existing Part and used by a new
+        # child in the same import
+        self._import([{'<name>': 'Existing', '<attr_types>': ['Color'], '<children>': [
+            {'<name>': 'Child', '<attrs>': {'Color': 'red'}}]}])
+        self.assertEqual(['red'], [m.attr.value for m in M.Part.search('Child').attr_maps])
+
+    def test_attr_type_not_registered(self):
+        self.assertRaises(Exception, self._import,
+                          [{'<name>': 'A', '<attrs>': {'Color': 'red'}}])
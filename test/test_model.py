@@ -1,5 +1,7 @@
 from unittest import TestCase
 
+from sqlalchemy import select
+
 import hwdb.model as M
 
 
@@ -73,6 +75,427 @@ class Test_DB(_Init_DB_Mixin, TestCase):
         self.assertEqual('subchild_part_2_2_1', c2.children[0].name)
 
 
+class Test_PartClosure(_Init_DB_Mixin, TestCase):
+    def _closure_rows(self):
+        return sorted(M.db_session.execute(M.part_closure.select()).fetchall())
+
+    def _tree(self):
+        a = M.Part(name='A')
+        a1 = M.Part(name='A1', parent_part=a)
+        a11 = M.Part(name='A11', parent_part=a1)
+        a111 = M.Part(name='A111', parent_part=a11)
+        b = M.Part(name='B')
+        M.db_session.add_all([a, a1, a11, a111, b])
+        M.db_session.flush()
+        return a, a1, a11, a111, b
+
+    def test_ancestors_and_descendants(self):
+        a, a1, a11, a111, b = self._tree()
+        self.assertEqual(['A11', 'A1', 'A'], [p.name for p in a111.query_ancestors()])
+        self.assertEqual(['A111', 'A11', 'A1', 'A'],
+                         [p.name for p in a111.query_ancestors(include_self=True)])
+        self.assertEqual(['A1', 'A11', 'A111'], [p.name for p in a.query_descendants()])
+        self.assertEqual([], b.query_ancestors().all())
+        self.assertEqual([], b.query_descendants().all())
+
+    def test_reparent(self):
+        a, a1, a11, a111, b = self._tree()
+        a11.parent_part = b
+        M.db_session.flush()
+        self.assertEqual(['A11', 'B'], [p.name for p in a111.query_ancestors()])
+        self.assertEqual(['A1'], [p.name for p in a.query_descendants()])
+        self.assertEqual(['A11', 'A111'], [p.name for p in b.query_descendants()])
+
+        a11.parent_part = None
+        M.db_session.flush()
+        self.assertEqual(['A11'], [p.name for p in a111.query_ancestors()])
+        self.assertEqual([], b.query_descendants().all())
+
+    def test_reparent_below_own_descendant(self):
+        a, a1, a11, a111, b = self._tree()
+        a1.parent_part = a111
+        self.assertRaises(Exception, M.db_session.flush)
+
+    def test_delete(self):
+        a, a1, a11, a111, b = self._tree()
+        M.db_session.delete(a111)
+        M.db_session.flush()
+        self.assertEqual(['A1', 'A11'], [p.name for p in a.query_descendants()])
+        self.assertNotIn(a111.id, [r.descendant_id for r in self._closure_rows()])
+
+    def test_rebuild(self):
+        a, a1, a11, a111, b = self._tree()
+        a11.parent_part = b
+        M.db_session.flush()
+        maintained = self._closure_rows()
+        M.rebuild_part_closure()
+        self.assertEqual(maintained, self._closure_rows())
+
+    def test_search_PartAttrTypeMap(self):
+        a, a1, a11, a111, b = self._tree()
+        unit = M.Unit(name='u', label='U')
+        attr_type = M.AttrType(name='T', unit=unit)
+        other_type = M.AttrType(name='O', unit=unit)
+        mapping_a = M.PartAttrTypeMap(part=a, attr_type=attr_type)
+        mapping_a11 = M.PartAttrTypeMap(part=a11, attr_type=attr_type)
+        M.db_session.add_all([mapping_a, mapping_a11, other_type])
+        M.db_session.flush()
+
+        self.assertIs(mapping_a11, M.search_PartAttrTypeMap(a111, attr_type))
+        self.assertIs(mapping_a, M.search_PartAttrTypeMap(a1, attr_type))
+        self.assertIsNone(M.search_PartAttrTypeMap(b, attr_type))
+        self.assertIsNone(M.search_PartAttrTypeMap(a111, other_type))
+
+        # Unflushed parts are resolved through their parents
+        pending = M.Part(name='pending', parent_part=a1)
+        self.assertIs(mapping_a, M.search_PartAttrTypeMap(pending, attr_type))
+
+
+class Test_AttrTypeResolver(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_AttrTypeResolver, self).setUp()
+        unit = M.Unit(name='u', label='U')
+        self.attr_type = M.AttrType(name='T', unit=unit)
+        self.a = M.Part(name='A')
+        self.a1 = M.Part(name='A1', parent_part=self.a)
+        self.b = M.Part(name='B')
+        M.db_session.add_all([self.attr_type, self.a1, self.b,
+                              M.PartAttrTypeMap(part=self.a, attr_type=self.attr_type)])
+        M.db_session.commit()
+        self.resolver = M.get_attr_type_resolver()
+
+    def test_inherited(self):
+        self.assertIs(self.resolver, M.get_attr_type_resolver())
+        self.assertTrue(self.resolver.is_allowed(self.a, self.attr_type))
+        self.assertTrue(self.resolver.is_allowed(self.a1, self.attr_type))
+        self.assertFalse(self.resolver.is_allowed(self.b, self.attr_type))
+        self.assertTrue(self.resolver.is_allowed(M.Part(name='new', parent_part=self.a1),
+                                                 self.attr_type))
+
+    def test_invalidated_by_new_mapping(self):
+        self.assertFalse(self.resolver.is_allowed(self.b, self.attr_type))
+        M.db_session.add(M.PartAttrTypeMap(part=self.b, attr_type=self.attr_type))
+        M.db_session.flush()
+        self.assertTrue(self.resolver.is_allowed(self.b, self.attr_type))
+
+    def test_invalidated_by_reparent(self):
+        self.assertTrue(self.resolver.is_allowed(self.a1, self.attr_type))
+        self.a1.parent_part = self.b
+        M.db_session.flush()
+        self.assertFalse(self.resolver.is_allowed(self.a1, self.attr_type))
+
+    def test_invalidated_by_rollback(self):
+        M.db_session.add(M.PartAttrTypeMap(part=self.b, attr_type=self.attr_type))
+        M.db_session.flush()
+        self.assertTrue(self.resolver.is_allowed(self.b, self.attr_type))
+        M.db_session.rollback()
+        self.assertFalse(self.resolver.is_allowed(self.b, self.attr_type))
+
+
+class Test_AttrCache(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_AttrCache, self).setUp()
+        unit = M.Unit(name='u', label='U')
+        self.attr_type = M.AttrType(name='T', unit=unit)
+        parent = M.Part(name='P')
+        M.db_session.add_all([self.attr_type,
+                              M.PartAttrTypeMap(part=parent, attr_type=self.attr_type)])
+        M.db_session.flush()
+
+    def _add_part(self, name, value):
+        part = M.Part(name=name, parent_part=M.Part.search('P'))
+        M.db_session.add(part)
+        part.add_attributes({'T': value})
+        return part
+
+    def test_shared_before_flush(self):
+        p1 = self._add_part('p1', 168)
+        p2 = self._add_part('p2', '168')
+        self.assertIs(p1.attr_maps[0].attr, p2.attr_maps[0].attr)
+        M.db_session.flush()
+        p3 = self._add_part('p3', '168')
+        self.assertIs(p1.attr_maps[0].attr, p3.attr_maps[0].attr)
+        self.assertEqual(1, M.db_session.query(M.Attr).count())
+
+        attr_cache = M.get_attr_cache()
+        self.assertEqual(2, attr_cache.hits)
+        self.assertEqual(1, attr_cache.misses)
+
+    def test_lru(self):
+        attr_cache = M.AttrCache(max_size=2)
+        attrs = [M.Attr(attr_type=self.attr_type, value=str(i)) for i in range(3)]
+        M.db_session.add_all(attrs)
+        for attr in attrs:
+            attr_cache.add(attr)
+        self.assertEqual(3, len(attr_cache))
+        M.db_session.flush()
+        attr_cache.flushed()
+        self.assertEqual(2, len(attr_cache))
+
+        attr_cache.get(self.attr_type, '1')
+        attr_cache.add(M.db_session.query(M.Attr).filter_by(value='0').one())
+        self.assertIsNotNone(attr_cache.get(self.attr_type, '1'))
+        self.assertIsNone(attr_cache.get(self.attr_type, '2'))
+
+    def test_cleared_by_rollback(self):
+        self._add_part('p1', 'x')
+        self.assertEqual(1, len(M.get_attr_cache()))
+        M.db_session.rollback()
+        self.assertEqual(0, len(M.get_attr_cache()))
+
+    def test_cleared_by_close(self):
+        self._add_part('p1', 'x')
+        M.db_session.commit()
+        self.assertEqual(0, len(M.get_attr_cache()))
+        self._add_part('p2', 'y')
+        M.db_session.close()
+        self.assertEqual(0, len(M.get_attr_cache()))
+        self.assertEqual({}, M.get_name_cache())
+
+
+class Test_search(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_search, self).setUp()
+        M.db_session.add_all([M.Part(name='A'), M.Part(name='B'),
+                              M.Part(name='C'), M.Part(name='C')])
+        M.db_session.flush()
+
+    def test_search(self):
+        self.assertEqual('A', M.Part.search('A').name)
+        self.assertIn('A', M.get_name_cache(cls=M.Part))
+        self.assertRaises(Exception, M.Part.search, 'C')
+        self.assertRaises(Exception, M.Part.search, 'D')
+
+    def test_search_many(self):
+        self.assertEqual(['B', 'A', 'B'],
+                         [p.name for p in M.Part.search_many(['B', 'A', 'B'])])
+        self.assertEqual([], M.Part.search_many([]))
+        self.assertRaises(Exception, M.Part.search_many, ['A', 'D'])
+
+    def test_invalidated_by_insert(self):
+        M.Part.search('A')
+        M.db_session.add(M.Part(name='A'))
+        M.db_session.flush()
+        self.assertRaises(Exception, M.Part.search, 'A')
+
+    def test_invalidated_by_rename(self):
+        a = M.Part.search('A')
+        a.name = 'D'
+        M.db_session.flush()
+        self.assertRaises(Exception, M.Part.search, 'A')
+        self.assertIs(a, M.Part.search('D'))
+
+    def test_deleted_without_orm(self):
+        a_id = M.Part.search('A').id
+        M.db_session.expunge_all()
+        M.db_session.execute(M.Part.__table__.delete().where(M.Part.__table__.c.id==a_id))
+        self.assertRaises(Exception, M.Part.search, 'A')
+        M.db_session.execute(M.Part.__table__.insert().values(name='A'))
+        self.assertEqual('A', M.Part.search('A').name)
+
+    def test_invalidated_by_delete(self):
+        M.db_session.delete(M.Part.search('A'))
+        M.db_session.flush()
+        self.assertRaises(Exception, M.Part.search, 'A')
+
+
+class Test_table_versions(_Init_DB_Mixin, TestCase):
+    def _versions(self):
+        versions = M.get_table_versions(['part', 'unit'])
+        return versions['part'][0], versions['unit'][0]
+
+    def test_bumped_on_flush(self):
+        self.assertEqual((0, 0), self._versions())
+        part = M.Part(name='A')
+        M.db_session.add(part)
+        M.db_session.flush()
+        self.assertEqual((1, 0), self._versions())
+        part.note = 'Note'
+        M.db_session.flush()
+        self.assertEqual((2, 0), self._versions())
+        M.db_session.delete(part)
+        M.db_session.add(M.Unit(name='Hertz', label='Hz'))
+        M.db_session.flush()
+        self.assertEqual((3, 1), self._versions())
+
+    def test_bump_table_versions(self):
+        M.bump_table_versions(M.db_session.connection(), ['unit', 'unit', 'seeded_key'])
+        self.assertEqual((0, 1), self._versions())
+        self.assertEqual([('unit', 1)], [tuple(row) for row in M.db_session.execute(
+            select([M.table_version.c.table_name, M.table_version.c.version]))])
+
+    def test_collection_change(self):
+        part = M.Part(name='A')
+        attr_type = M.AttrType(name='Frequency', unit=M.Unit(name='Hertz', label='Hz'))
+        M.db_session.add_all([part, attr_type])
+        M.db_session.flush()
+        part.attr_type_maps.append(M.PartAttrTypeMap(attr_type=attr_type))
+        M.db_session.flush()
+        # Only the new mapping changed a table
+        self.assertEqual((1, 1), self._versions())
+        self.assertEqual(1, M.get_table_versions(['part_attr_type_map'])['part_attr_type_map'][0])
+
+
+
+class Test_upgrade_db(TestCase):
+    def test_upgrade_db(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        # The tables of the first version of the model
+        M.Base.metadata.create_all(engine, tables=[
+            M.Base.metadata.tables[name] for name in
+            ('unit', 'attr_type', 'part', 'part_attr_type_map', 'part_connection',
+             'attr', 'part_attr_map', 'multi_attr')])
+        connection = engine.connect()
+        unit_id = connection.execute(M.Unit.__table__.insert().values(
+            name='MHz', label='Megahertz')).inserted_primary_key[0]
+        attr_type_id = connection.execute(M.AttrType.__table__.insert().values(
+            name='Frequency', unit_id=unit_id)).inserted_primary_key[0]
+        cpu_id = connection.execute(M.Part.__table__.insert().values(
+            name='CPU')).inserted_primary_key[0]
+        connection.execute(M.PartAttrTypeMap.__table__.insert().values(
+            part_id=cpu_id, attr_type_id=attr_type_id))
+        connection.execute(M.Part.__table__.insert().values(name='P4', parent_part_id=cpu_id))
+        connection.close()
+
+        self.assertIn('table_version', M.upgrade_db(engine))
+        self.assertEqual([], M.upgrade_db(engine))
+        M.init_session(engine)
+        # The closure table was filled, the Attrs allowed by the parent can be added
+        M.Part.search('P4').add_attributes({'Frequency': '1300'})
+        M.db_session.add(M.Part(name='A'))
+        M.db_session.commit()
+        self.assertEqual(['1300'], [attr.value for attr, source_part_id
+                                    in M.Part.search('P4').query_effective_attrs()])
+        M.db_session.close()
+
+
+class Test_numeric_values(_Init_DB_Mixin, TestCase):
+    def test_parse_numeric_value(self):
+        parse = M.parse_numeric_value
+        self.assertEqual((2800, 2800), parse('2,800 MHz', 'MHz', '%(unit)s MHz'))
+        self.assertEqual((637, 637), parse('$637', '$', '$%(unit)s'))
+        self.assertEqual((1.1, 1.5), parse(u'1.1\u20131.5', 'V', '%(unit)s V', from_to=True))
+        self.assertEqual((None, None), parse('1.1-1.5', 'V', '%(unit)s V'))
+        self.assertEqual((1, 1), parse('Yes', 'bool'))
+        self.assertEqual((None, None), parse('Pentium', 'text'))
+        self.assertEqual((None, None), parse('fast', 'MHz'))
+
+    def _attr_types(self):
+        mhz = M.Unit(name='MHz', label='Megahertz', format='%(unit)s MHz')
+        volt = M.Unit(name='V', label='Volt', format='%(unit)s V')
+        frequency = M.AttrType(name='Frequency', unit=mhz)
+        voltage = M.AttrType(name='Voltage range', unit=volt, from_to=True)
+        cpu = M.Part(name='CPU')
+        M.db_session.add_all([frequency, voltage, cpu])
+        M.db_session.add_all([M.PartAttrTypeMap(part=cpu, attr_type=frequency),
+                              M.PartAttrTypeMap(part=cpu, attr_type=voltage)])
+        M.db_session.flush()
+        return frequency, voltage, cpu
+
+    def test_set_on_flush(self):
+        frequency, voltage, cpu = self._attr_types()
+        attr = M.Attr(attr_type=voltage, value='1.1-1.5')
+        M.db_session.add(attr)
+        M.db_session.flush()
+        self.assertEqual((1.1, 1.5), (attr.value_from, attr.value_to))
+        attr.value = '1.2'
+        M.db_session.flush()
+        self.assertEqual((1.2, 1.2), (attr.value_from, attr.value_to))
+
+        attr.value = '1.1-1.5'
+        voltage.from_to = False
+        M.db_session.flush()
+        M.db_session.expire(attr)
+        self.assertEqual((None, None), (attr.value_from, attr.value_to))
+
+    def test_unit_changed(self):
+        frequency, voltage, cpu = self._attr_types()
+        attr = M.Attr(attr_type=frequency, value='2.8 GHz')
+        M.db_session.add(attr)
+        M.db_session.flush()
+        self.assertEqual((None, None), (attr.value_from, attr.value_to))
+        frequency.unit.name = 'GHz'
+        frequency.unit.format = '%(unit)s GHz'
+        M.db_session.flush()
+        M.db_session.expire(attr)
+        self.assertEqual((2.8, 2.8), (attr.value_from, attr.value_to))
+
+    def test_range_queries(self):
+        frequency, voltage, cpu = self._attr_types()
+        parts = {}
+        for name, mhz, volt in [('A', '1800', '1.0-1.2'), ('B', '2400', '1.3-1.5'),
+                                ('C', '3200', '1.1-1.4')]:
+            parts[name] = M.Part(name=name, parent_part=cpu)
+            parts[name].add_attributes({'Frequency': mhz, 'Voltage range': volt})
+        M.db_session.flush()
+
+        names = lambda query: sorted(part.name for part in query)
+        self.assertEqual(['B'], names(M.Part.query_by_attr_range('Frequency', 2000, 3000)))
+        self.assertEqual(['B', 'C'], names(M.Part.query_by_attr_range(frequency, min_value=2000)))
+        self.assertEqual(['A', 'C'], names(M.Part.query_by_attr_range(voltage, 1.15, 1.2)))
+        self.assertEqual(['1800'], [attr.value for attr in
+                                    M.Attr.query_range(frequency, max_value=2000)])
+
+
+class Test_effective_attrs(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_effective_attrs, self).setUp()
+        unit = M.Unit(name='text', label='Text')
+        vendor = M.AttrType(name='Vendor', unit=unit)
+        version = M.AttrType(name='Version', unit=unit)
+        self.cpu = M.Part(name='CPU')
+        M.db_session.add_all([M.PartAttrTypeMap(part=self.cpu, attr_type=vendor),
+                              M.PartAttrTypeMap(part=self.cpu, attr_type=version)])
+        self.family = M.Part(name='Pentium 4', parent_part=self.cpu)
+        self.model = M.Part(name='Willamette', parent_part=self.family)
+        self.other = M.Part(name='Athlon', parent_part=self.cpu)
+        M.db_session.add_all([self.family, self.model, self.other])
+        M.db_session.flush()
+        self.family.add_attributes({'Vendor': 'Intel', 'Version': '1'})
+        self.model.add_attributes({'Version': '2'})
+        M.db_session.flush()
+
+    def _effective(self, part):
+        return sorted((attr.attr_type.name, attr.value, source_part_id)
+                      for attr, source_part_id in part.query_effective_attrs())
+
+    def _rows(self):
+        M.refresh_pending_effective_attrs()
+        return sorted(tuple(row) for row in M.db_session.execute(M.effective_attr.select()))
+
+    def test_inherit_and_override(self):
+        self.assertEqual([('Vendor', 'Intel', self.family.id), ('Version', '2', self.model.id)],
+                         self._effective(self.model))
+        self.assertEqual([], self._effective(self.other))
+
+    def test_refreshed_on_changes(self):
+        self.model.parent_part = self.other
+        M.db_session.flush()
+        self.assertEqual([('Version', '2', self.model.id)], self._effective(self.model))
+
+        self.other.add_attributes({'Vendor': 'AMD'})
+        M.db_session.flush()
+        self.assertEqual([('Vendor', 'AMD', self.other.id), ('Version', '2', self.model.id)],
+                         self._effective(self.model))
+
+        M.db_session.delete(self.model.attr_maps[0])
+        M.db_session.flush()
+        self.assertEqual([('Vendor', 'AMD', self.other.id)], self._effective(self.model))
+
+    def test_refreshed_before_commit(self):
+        self.other.add_attributes({'Vendor': 'AMD'})
+        M.db_session.commit()
+        self.assertNotIn('effective_attr_changes', M.db_session.info)
+        maintained = self._rows()
+        M.rebuild_effective_attrs()
+        self.assertEqual(maintained, self._rows())
+
+    def test_rebuild(self):
+        maintained = self._rows()
+        M.rebuild_effective_attrs()
+        self.assertEqual(maintained, self._rows())
+
+
 class Test_PartConnection(_Init_DB_Mixin, TestCase):
     def test_tODO():
         """
@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+import hwdb.model as M
+from hwdb import query_plans
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class Test_query_plans(_Init_DB_Mixin, TestCase):
+    def test_hot_queries_use_indexes(self):
+        query_plans.check_query_plans()
+        # The objects the queries are built from aren't added
+        self.assertEqual([], list(M.db_session.new))
+
+    def test_table_scan_is_found(self):
+        M.db_session.execute('DROP INDEX ix_part_name')
+        failures = query_plans.find_table_scans()
+        self.assertEqual(['Part.search', '/api/parts: keyset page'],
+                         [description for description, plan in failures])
+        self.assertRaises(AssertionError, query_plans.check_query_plans)
+
+    def test_create_indexes(self):
+        M.db_session.execute('DROP INDEX ix_part_name')
+        M.db_session.commit()
+        self.assertEqual(['ix_part_name'], M.create_indexes(M.db_session.get_bind()))
+        self.assertEqual([], M.create_indexes(M.db_session.get_bind()))
@@ -0,0 +1,88 @@
+from unittest import TestCase
+
+import hwdb.model as M
+from hwdb import search
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class Test_parse_query(TestCase):
+    def test_parse(self):
+        self.assertEqual([('attr', 'Vendor', '=', 'Intel'),
+                          ('attr', 'L2 cache', '>=', 512.0),
+                          ('supports', 'SSE2')],
+                         search.parse_query('Vendor=Intel and L2 cache >= 512 and supports SSE2'))
+
+    def test_quoted(self):
+        self.assertEqual([('attr', 'Area (mm<sup>2</sup>)', '<', 100.0),
+                          ('attr', 'Note', '!=', 'Black and "white"')],
+                         search.parse_query(r'"Area (mm<sup>2</sup>)"<100 AND '
+                                            r'Note != "Black and \"white\""'))
+
+    def test_invalid(self):
+        for text in ['', 'Vendor', 'Vendor=Intel and', '=Intel', 'Frequency > fast',
+                     'a = b = c']:
+            self.assertRaises(ValueError, search.parse_query, text)
+
+
+
+class Test_search(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_search, self).setUp()
+        kb = M.Unit(name='KB', label='Kilobyte', format='%(unit)s Kilobyte')
+        text = M.Unit(name='text', label='Text')
+        vendor = M.AttrType(name='Vendor', unit=text)
+        l2_cache = M.AttrType(name='L2 cache', unit=kb)
+        cpu = M.Part(name='CPU')
+        M.db_session.add_all([M.PartAttrTypeMap(part=cpu, attr_type=vendor),
+                              M.PartAttrTypeMap(part=cpu, attr_type=l2_cache),
+                              M.Part(name='SSE2', is_standard=True)])
+        M.db_session.flush()
+
+        pentium4 = M.Part(name='Pentium 4', parent_part=cpu)
+        pentium4.add_standards('SSE2')
+        for name, parent, attributes in [
+                ('Willamette', pentium4, {'Vendor': 'Intel', 'L2 cache': '256'}),
+                ('Northwood', pentium4, {'Vendor': 'Intel', 'L2 cache': '512'}),
+                ('Athlon', cpu, {'Vendor': 'AMD', 'L2 cache': '512'})]:
+            part = M.Part(name=name, parent_part=parent)
+            part.add_attributes(attributes)
+        M.db_session.flush()
+
+
+    def _search(self, text, inherited=False):
+        return [part.name for part in search.search(text, inherited)]
+
+
+    def test_search(self):
+        self.assertEqual(['Northwood', 'Willamette'], self._search('Vendor=Intel'))
+        self.assertEqual(['Athlon', 'Northwood'], self._search('L2 cache>=512'))
+        self.assertEqual(['Willamette'], self._search('L2 cache<512'))
+        self.assertEqual(['Athlon'], self._search('Vendor!=Intel and L2 cache>300'))
+
+    def test_inherited_attributes(self):
+        amd = M.Part(name='AMD CPU', parent_part=M.Part.search('CPU'))
+        amd.add_attributes({'Vendor': 'AMD'})
+        M.db_session.add(M.Part(name='Duron', parent_part=amd))
+        M.db_session.flush()
+        self.assertEqual(['AMD CPU', 'Athlon'], self._search('Vendor=AMD'))
+        self.assertEqual(['AMD CPU', 'Athlon', 'Duron'], self._search('Vendor=AMD', inherited=True))
+
+    def test_supports(self):
+        self.assertEqual(['Northwood', 'Pentium 4', 'Willamette'], self._search('supports SSE2'))
+        self.assertEqual(['Northwood'],
+                         self._search('Vendor=Intel and L2 cache>=512 and supports SSE2'))
@@ -0,0 +1,120 @@
+from unittest import TestCase
+
+import hwdb.model as M
+from hwdb import sync
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class _Data(object):
+    """ Replaces the module hwdb.data """
+    def __init__(self):
+        self.units = [dict(name='count', label='Count')]
+        self.attr_types = [{'name': 'Pin count', 'unit': 'count'}]
+        self.parts = [{'Socket': {'<attr_types>': ['Pin count']}}]
+        self.standards = ['DDR']
+        self.connectors = []
+        self.subparts = [{'Socket': [{
+            'Socket A': {'<attrs>': {'Pin count': 240}, '<standards>': ['DDR']},
+            'Socket B': {'<attrs>': {'Pin count': 240}},
+        }]}]
+        self.systems = [{'Socket A': ['Socket B']}]
+
+
+class Test_sync_db(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_sync_db, self).setUp()
+        self.data = _Data()
+        self._orig_data = sync.data
+        sync.data = self.data
+
+    def tearDown(self):
+        sync.data = self._orig_data
+        super(Test_sync_db, self).tearDown()
+
+    def _sync(self):
+        stats, self.moved_parts = sync.sync_db()
+        return dict((table, tuple(table_stats)) for table, table_stats in stats.items())
+
+    def _values(self, part_name):
+        return sorted(value for value, in M.db_session.query(M.Attr.value).
+                      join(M.PartAttrMap).join(M.Part).filter(M.Part.name==part_name))
+
+    def test_sync(self):
+        self.assertEqual({
+            'unit': (1, 0, 0), 'attr_type': (1, 0, 0), 'part': (4, 0, 0),
+            'part_attr_type_map': (1, 0, 0), 'part_attr_map': (2, 0, 0),
+            'part_connection': (2, 0, 0)}, self._sync())
+        self.assertTrue(M.Part.search('Socket A').is_system)
+        self.assertEqual(1, M.db_session.query(M.Attr).count())
+
+        # Nothing changed
+        self.assertEqual(set([(0, 0, 0)]), set(self._sync().values()))
+
+        user_part = M.Part(name='User part', parent_part=M.Part.search('Socket B'))
+        M.db_session.add(user_part)
+        M.db_session.flush()
+
+        self.data.subparts = [{'Socket': [{
+            'Socket A': {'<attrs>': {'Pin count': 184}, '<standards>': ['DDR']},
+            'Socket C': {'<attrs>': {'Pin count': 184}},
+        }]}]
+        self.data.systems = [{'Socket A': ['Socket C']}]
+        stats = self._sync()
+        self.assertEqual((1, 0, 1), stats['part'])
+        # The changed value of Socket A is deleted and inserted
+        self.assertEqual((2, 0, 2), stats['part_attr_map'])
+        self.assertEqual((1, 0, 1), stats['part_connection'])
+
+        self.assertRaises(Exception, M.Part.search, 'Socket B')
+        # The user's Part is moved to the parent of Socket B
+        self.assertEqual([('User part', 'Socket B', 'Socket')], self.moved_parts)
+        M.db_session.expire(user_part)
+        self.assertEqual('Socket', user_part.parent_part.name)
+        self.assertEqual(['184'], [attr.value for attr in M.db_session.query(M.Attr)])
+        self.assertEqual(['Socket C'], [pc.contained_part.name for pc in
+                                        M.Part.search('Socket A').part_connection_children])
+
+    def test_multi_value(self):
+        self.data.attr_types.append({'name': 'Part number', 'unit': 'count'})
+        self.data.parts = [{'Socket': {'<attr_types>': ['Pin count', 'Part number']}}]
+        self._sync()
+        # A user adds another value of the same AttrType
+        M.Part.search('Socket A').add_attributes({'Part number': 'A2'})
+        self.data.subparts[0]['Socket'][0]['Socket A']['<attrs>']['Part number'] = 'A1'
+        self.assertEqual((1, 0, 0), self._sync()['part_attr_map'])
+        self.assertEqual(set([(0, 0, 0)]), set(self._sync().values()))
+        self.assertEqual(['240', 'A1', 'A2'], self._values('Socket A'))
+
+    def test_seeded_keys_without_value(self):
+        self._sync()
+        # Recorded before the value was part of the key
+        M.db_session.execute(M.seeded_key.delete().where(
+            M.seeded_key.c.table_name=='part_attr_map'))
+        M.db_session.execute(M.seeded_key.insert(), [
+            dict(table_name='part_attr_map', key=sync._encode_key((name, 'Pin count')))
+            for name in ('Socket A', 'Socket B')])
+        self.data.subparts[0]['Socket'][0]['Socket B']['<attrs>'] = {}
+        self.assertEqual((0, 0, 1), self._sync()['part_attr_map'])
+        self.assertEqual([], self._values('Socket B'))
+
+    def test_user_rows_are_kept(self):
+        self._sync()
+        M.db_session.add(M.Part(name='User part'))
+        M.db_session.flush()
+        self._sync()
+        self.assertEqual('User part', M.Part.search('User part').name)
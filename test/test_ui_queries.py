@@ -0,0 +1,118 @@
+import json
+from unittest import TestCase
+
+import hwdb.model as M
+from hwdb import ui_queries
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+
+class Test_ui_queries(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_ui_queries, self).setUp()
+        text = M.Unit(name='text', label='Text')
+        vendor = M.AttrType(name='Vendor', unit=text)
+        socket = M.AttrType(name='Socket', unit=text)
+        self.usb = M.Part(name='USB', is_standard=True)
+        self.usb2 = M.Part(name='USB 2.0', is_standard=True, parent_part=self.usb)
+        self.sse = M.Part(name='SSE', is_standard=True)
+        self.cpu = M.Part(name='CPU', note='Processor')
+        self.p4 = M.Part(name='Pentium 4', parent_part=self.cpu)
+        self.athlon = M.Part(name='Athlon', parent_part=self.cpu)
+        self.board = M.Part(name='Board')
+        self.pc = M.Part(name='PC', is_system=True)
+        M.db_session.add_all([self.usb, self.usb2, self.sse, self.p4, self.athlon,
+                              self.board, self.pc,
+                              M.PartAttrTypeMap(part=self.cpu, attr_type=vendor),
+                              M.PartAttrTypeMap(part=self.cpu, attr_type=socket)])
+        M.db_session.flush()
+        self.cpu.add_attributes({'Vendor': 'Intel'})
+        self.p4.add_attributes({'Vendor': 'Intel', 'Socket': '478'})
+        self.athlon.add_attributes({'Vendor': 'AMD', 'Socket': '478'})
+        self.p4.add_standards('SSE')
+        self.board.add_standards('USB 2.0')
+        M.db_session.add_all([
+            M.PartConnection(parent_part=self.pc, container_part=self.pc,
+                             contained_part=self.board),
+            M.PartConnection(parent_part=self.pc, container_part=self.board,
+                             contained_part=self.p4)])
+        M.db_session.flush()
+
+
+    def test_load_part_tree(self):
+        children, standards = ui_queries.load_part_tree()
+        self.assertEqual(['Board', 'CPU', 'PC'], [part.name for part in children[None]])
+        self.assertEqual(['Athlon', 'Pentium 4'], [part.name for part in children[self.cpu.id]])
+        self.assertNotIn(self.usb.id, children)
+        self.assertEqual(['SSE'], [standard.name for standard in standards[self.p4.id]])
+
+    def test_iter_parts_json(self):
+        doc = json.loads(''.join(ui_queries.iter_parts_json()))
+        self.assertEqual({'parts': [
+            {'name': 'Board'},
+            {'name': 'CPU', 'note': 'Processor', 'attr_types': ['Socket', 'Vendor'],
+             'children': [{'name': 'Athlon'}, {'name': 'Pentium 4'}]},
+            {'name': 'PC'}]}, doc)
+
+    def test_iter_parts_json_empty(self):
+        M.db_session.rollback()
+        self.assertEqual({'parts': []}, json.loads(''.join(ui_queries.iter_parts_json())))
+
+    def test_part_detail(self):
+        # Loaded like in a new request
+        M.db_session.expunge_all()
+        part = ui_queries.query_part_detail(self.p4.id).one()
+        self.assertEqual(['478', 'Intel'], sorted(m.attr.value for m in part.attr_maps))
+        # Intel is shared with the CPU, 478 with the Athlon
+        counts = dict(ui_queries.query_share_counts(self.p4.id))
+        self.assertEqual({'478': 2, 'Intel': 2},
+                         dict((m.attr.value, counts[m.attr_id]) for m in part.attr_maps))
+
+    def test_inherited_attrs(self):
+        northwood = M.Part(name='Northwood', parent_part=self.p4)
+        M.db_session.add(northwood)
+        M.db_session.flush()
+        self.assertEqual([('Socket', '478', 'Pentium 4'), ('Vendor', 'Intel', 'Pentium 4')],
+                         sorted((attr.attr_type.name, attr.value, name)
+                                for attr, source_part_id, name
+                                in ui_queries.query_inherited_attrs(northwood)))
+        # Own attributes override the inherited ones
+        self.assertEqual([], ui_queries.query_inherited_attrs(self.p4).all())
+
+    def test_load_connections(self):
+        connections = ui_queries.load_connections()
+        self.assertEqual(['Board'], [row.name for row in connections[(self.pc.id, self.pc.id)]])
+        self.assertEqual(['Pentium 4'],
+                         [row.name for row in connections[(self.pc.id, self.board.id)]])
+        self.assertEqual(['PC'], [row.name for row in ui_queries.query_systems()])
+
+    def test_query_shared_attributes(self):
+        attrs = ui_queries.query_shared_attributes().all()
+        self.assertEqual([('Socket', '478'), ('Vendor', 'Intel')],
+                         [(attr.attr_type.name, attr.value) for attr in attrs])
+        self.assertEqual(['Athlon', 'Pentium 4'],
+                         sorted(m.part.name for m in attrs[0].part_maps))
+        vendor = M.AttrType.search('Vendor')
+        self.assertEqual(['Intel'], [attr.value for attr in
+                                     ui_queries.query_shared_attributes(vendor.id)])
+        self.assertEqual([], ui_queries.query_shared_attributes(value='AMD').all())
+
+    def test_load_standard_tree(self):
+        children, contained_parts = ui_queries.load_standard_tree()
+        self.assertEqual(['SSE', 'USB'], [standard.name for standard in children[None]])
+        self.assertEqual(['USB 2.0'], [standard.name for standard in children[self.usb.id]])
+        self.assertEqual(['Board'], [part.name for part in contained_parts[self.usb2.id]])
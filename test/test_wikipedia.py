@@ -0,0 +1,314 @@
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import hwdb.model as M
+from hwdb import fulltext
+from hwdb import wikipedia
+
+
+TEST_DB_PATH = 'sqlite:///:memory:'
+
+
+class _Init_DB_Mixin(object):
+    def setUp(self):
+        engine = M.get_engine(TEST_DB_PATH, False)
+        M.create_all(engine)
+        M.init_session(engine)
+
+
+    def tearDown(self):
+        M.db_session.rollback()
+        M.db_session.close()
+
+
+class _CountingTransport(object):
+    """ Transport serving a changeable article, counting the requests """
+    def __init__(self):
+        self.revision_id = 1
+        self.wikitext = u'{|\n|}'
+        self.requests = []
+
+
+    def get_revision_id(self, title):
+        self.requests.append(('revision', title))
+        return self.revision_id
+
+
+    def get_article(self, title):
+        self.requests.append(('article', title))
+        return self.revision_id, self.wikitext
+
+
+
+class Test_ArticleFetcher(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = wikipedia.ArticleCache(os.path.join(self.directory, 'cache'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_revalidation(self):
+        transport = _CountingTransport()
+        fetcher = wikipedia.ArticleFetcher(transport, self.cache)
+        self.assertEqual(u'{|\n|}', fetcher.fetch('List'))
+        # Unchanged: only the revision id is requested
+        self.assertEqual(u'{|\n|}', fetcher.fetch('List'))
+        self.assertEqual([('article', 'List'), ('revision', 'List')], transport.requests)
+
+        transport.revision_id = 2
+        transport.wikitext = u'{|\n! Model\n|}'
+        self.assertEqual(u'{|\n! Model\n|}', fetcher.fetch('List'))
+        self.assertEqual(('article', 'List'), transport.requests[-1])
+        self.assertEqual((2, 1), (fetcher.downloads, fetcher.hits))
+        self.assertEqual(u'{|\n|}', self.cache.get('List', 1))
+
+    def test_max_age(self):
+        transport = _CountingTransport()
+        fetcher = wikipedia.ArticleFetcher(transport, self.cache, max_age=3600)
+        fetcher.fetch('List')
+        fetcher.fetch('List')
+        self.assertEqual([('article', 'List')], transport.requests)
+
+    def test_offline(self):
+        fetcher = wikipedia.ArticleFetcher(cache=self.cache)
+        self.assertRaises(Exception, fetcher.fetch, 'List')
+        wikipedia.ArticleFetcher(_CountingTransport(), self.cache).fetch('List')
+        self.assertEqual(u'{|\n|}', fetcher.fetch('List'))
+
+    def test_threads(self):
+        fetcher = wikipedia.ArticleFetcher(_CountingTransport(), self.cache)
+        titles = ['List %s' % (i % 10) for i in range(200)]
+        pool = ThreadPool(8)
+        try:
+            pool.map(fetcher.fetch, titles)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(200, fetcher.downloads + fetcher.hits)
+
+    def test_fixture_transport(self):
+        with io.open(os.path.join(self.directory, 'List_of_CPUs.txt'), 'w', encoding='utf-8') as f:
+            f.write(u'{|\n! Model ×\n|}')
+        fetcher = wikipedia.ArticleFetcher(wikipedia.FixtureTransport(self.directory), self.cache)
+        articles = wikipedia.fetch_articles(['List of CPUs'], fetcher)
+        self.assertEqual([u'{|\n! Model ×\n|}'], list(articles.values()))
+        fetcher.fetch('List of CPUs')
+        self.assertEqual((1, 1), (fetcher.downloads, fetcher.hits))
+        self.assertRaises(Exception, fetcher.fetch, 'Missing')
+
+
+
+class Test_iter_table_rows(TestCase):
+    def test_spans(self):
+        wikitext = u'''Intro
+{| class="wikitable"
+|+ Caption
+! Model Number !! [[CPU socket|Socket]] !! colspan="2" | Cache
+|-
+! !! !! L1 !! L2
+|-
+| rowspan="2" | [[Pentium 4|P4]] 2.0 || rowspan="3" | 478 || 8 KB || 256 KB
+|-
+| 16 KB
+| 512 KB
+|-
+| Pentium 4 2.4 || colspan="2" style="x" | 1 MB
+|}
+Text
+{|
+| no || header
+|}
+'''
+        self.assertEqual([
+            {'Model Number': '[[Pentium 4|P4]] 2.0', '[[CPU socket|Socket]]': '478',
+             'Cache L1': '8 KB', 'Cache L2': '256 KB'},
+            {'Model Number': '[[Pentium 4|P4]] 2.0', '[[CPU socket|Socket]]': '478',
+             'Cache L1': '16 KB', 'Cache L2': '512 KB'},
+            {'Model Number': 'Pentium 4 2.4', '[[CPU socket|Socket]]': '478',
+             'Cache L1': '1 MB', 'Cache L2': '1 MB'},
+        ], list(wikipedia.iter_table_rows(wikitext)))
+
+    def test_multi_line_cells(self):
+        lines = [u'{|\n', u'! Name || sSpec\n', u'|-\n', u'| A || SL1\n', u'SL2<br>\n',
+                 u'{|\n', u'| nested\n', u'|}\n', u'|-\n', u'| B\n', u'|}\n']
+        rows = list(wikipedia.iter_table_rows(iter(lines)))
+        self.assertEqual([{'Name': 'A', 'sSpec': 'SL1\nSL2<br>\n{|\n| nested\n|}'},
+                          {'Name': 'B', 'sSpec': ''}], rows)
+
+        # Blank lines don't end up at the end of a cell
+        lines = [u'{|\n', u'! Name || Frequency\n', u'|-\n', u'| A\n', u'| 1.3 GHz\n',
+                 u'\n', u'  \n', u'|-\n', u'| B\n', u'|\n', u'\n', u'2 GHz\n', u'|}\n']
+        rows = list(wikipedia.iter_table_rows(iter(lines)))
+        self.assertEqual([{'Name': 'A', 'Frequency': '1.3 GHz'},
+                          {'Name': 'B', 'Frequency': '2 GHz'}], rows)
+
+
+
+PENTIUM_4_ARTICLE = u'''{| class="wikitable"
+! Model Number || sSpec Number || Frequency || Multiplier || Part Number(s) || Voltage || FSB Speed || Release Date || L2 Cache || Socket || TDP
+|-
+| [http://ark.intel.com/1 Pentium 4 1.3] || SL4SF<br>SL5GC || 1.3&nbsp;GHz || 13× || RN80528PC001G0K || 1.7 V || 400 MT/s || January 3, 2001 || 256 || Socket 423 || 48.9 W
+|-
+| Pentium 4 1.4 || SL4SG || 1.4&nbsp;GHz || 14× || RN80528PC002G0K || 1.7 V || 400 MT/s || rowspan="2" | November 20, 2000 || 256 || Socket 423 || 51.8 W
+|-
+| Pentium 4 1.5 || SL4SH || 1.5&nbsp;GHz || 15× || RN80528PC003G0K || 1.7 V || 400 MT/s || 256 || Socket 423 || 57.8 W
+|}
+'''
+
+CELERON_ARTICLE = u'''{|
+! Processor || Clock || L2
+|-
+| Celeron 1.7 || 1700 || 128
+|}
+'''
+
+
+class Test_import_articles(_Init_DB_Mixin, TestCase):
+    def setUp(self):
+        super(Test_import_articles, self).setUp()
+        cpu = M.Part(name='CPU')
+        for attr_type_name, unit_name in [('Frequency', 'MHz'), ('Clock multiplier', 'factor'),
+                                          ('Front side bus', 'MT/s'), ('Release date', 'date'),
+                                          ('L2 cache', 'KB'), ('Thermal design power', 'W'),
+                                          ('Source', 'url')]:
+            attr_type = M.AttrType(name=attr_type_name, unit=M.Unit(name=unit_name, label=unit_name))
+            M.db_session.add(M.PartAttrTypeMap(part=cpu, attr_type=attr_type))
+        M.db_session.add_all([M.Part(name='Pentium 4', parent_part=cpu),
+                              M.Part(name='Celeron', parent_part=cpu)])
+        M.db_session.flush()
+
+        self.directory = tempfile.mkdtemp()
+        for title, wikitext in [('Pentium_4', PENTIUM_4_ARTICLE), ('Celeron', CELERON_ARTICLE)]:
+            with io.open(os.path.join(self.directory, title + '.txt'), 'w', encoding='utf-8') as f:
+                f.write(wikitext)
+        self.fetcher = wikipedia.ArticleFetcher(wikipedia.FixtureTransport(self.directory))
+        self.articles = {
+            'Pentium_4': {'parent': 'Pentium 4', 'columns': wikipedia.PROCESSOR_COLUMNS},
+            'Celeron': {'parent': 'Celeron', 'columns': OrderedDict([
+                ('name', {'headers': ('Processor', )}),
+                ('Frequency', {'headers': ('Clock', )}),
+                ('L2 cache', {'headers': ('L2', )}),
+                ('Release date', {'headers': ('Release Date', ), 'optional': True}),
+            ])},
+        }
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(Test_import_articles, self).tearDown()
+
+
+    def _get_attrs(self, part_name):
+        part = M.Part.search(part_name)
+        return part.parent_part.name, dict((attr_map.attr.attr_type.name, attr_map.attr.value)
+                                           for attr_map in part.attr_maps)
+
+
+    def _check_import(self, processes):
+        counts = wikipedia.import_articles(['Pentium_4', 'Celeron'], self.fetcher, self.articles,
+                                           processes=processes, batch_size=2)
+        self.assertEqual((4, 0, 0), counts)
+        self.assertEqual(('Pentium 4', {
+            'Source': 'http://ark.intel.com/1', 'Frequency': '1300', 'Clock multiplier': '13',
+            'Front side bus': '400', 'Release date': 'January 3, 2001', 'L2 cache': '256',
+            'Thermal design power': '48.9'}), self._get_attrs('Pentium 4 1.3'))
+        self.assertEqual('November 20, 2000', self._get_attrs('Pentium 4 1.5')[1]['Release date'])
+        self.assertEqual(('Celeron', {'Frequency': '1700', 'L2 cache': '128'}),
+                         self._get_attrs('Celeron 1.7'))
+
+    def test_import(self):
+        self._check_import(processes=1)
+
+    def test_import_parallel(self):
+        self._check_import(processes=2)
+
+    def test_unknown_article(self):
+        self.assertRaises(Exception, wikipedia.import_articles, ['Athlon'], self.fetcher,
+                          self.articles)
+
+    def test_insert_records(self):
+        M.Part.search('Pentium 4').add_attributes({'Frequency': '1300'})
+        M.db_session.flush()
+        attr_count = M.db_session.query(M.Attr).count()
+        rows = [{'name': 'P4 %s' % i, 'URL': None, 'Frequency': '1300',
+                 'L2 cache': str(256 * (i % 2 + 1)), 'Socket': 'Socket 478'} for i in range(4)]
+        part_ids = wikipedia.insert_records(rows, 'Pentium 4')
+        self.assertEqual(4, len(part_ids))
+        # 1300 existed, 256 and 512 are new
+        self.assertEqual(attr_count + 2, M.db_session.query(M.Attr).count())
+        self.assertEqual(('Pentium 4', {'Frequency': '1300', 'L2 cache': '512'}),
+                         self._get_attrs('P4 1'))
+        part = M.Part.search('P4 3')
+        ancestor_ids = M.db_session.query(M.part_closure.c.ancestor_id).\
+            filter(M.part_closure.c.descendant_id==part.id).\
+            order_by(M.part_closure.c.depth)
+        self.assertEqual([part.id, part.parent_part_id, part.parent_part.parent_part_id],
+                         [ancestor_id for ancestor_id, in ancestor_ids])
+        self.assertEqual([('Frequency', part.id), ('L2 cache', part.id)],
+                         sorted((attr.attr_type.name, source_part_id)
+                                for attr, source_part_id in part.query_effective_attrs()))
+        self.assertEqual(sorted(part_ids),
+                         sorted(part.id for part in fulltext.search('p4', limit=10)))
+
+    def test_insert_records_not_allowed(self):
+        M.db_session.add(M.AttrType(name='Color', unit=M.Unit.search('url')))
+        M.db_session.flush()
+        part_count = M.db_session.query(M.Part).count()
+        self.assertRaises(Exception, wikipedia.insert_records,
+                          [{'name': 'P4', 'Frequency': '1'}, {'name': 'P4', 'Color': 'red'}],
+                          'Pentium 4')
+        self.assertEqual(part_count, M.db_session.query(M.Part).count())
+
+    def test_upsert(self):
+        def import_articles():
+            return wikipedia.import_articles(['Pentium_4', 'Celeron'], self.fetcher, self.articles,
+                                             processes=1, upsert=True)
+
+        self.assertEqual((4, 0, 0), import_articles())
+        part_count = M.db_session.query(M.Part).count()
+        self.assertEqual((0, 0, 4), import_articles())
+
+        M.Part.search('Celeron 1.7').add_attributes({'Release date': '2002'})
+        M.db_session.commit()
+        with io.open(os.path.join(self.directory, 'Celeron.txt'), 'w', encoding='utf-8') as f:
+            f.write(CELERON_ARTICLE.replace('|| 128', '|| 256'))
+        self.assertEqual((0, 1, 3), import_articles())
+        self.assertEqual(part_count, M.db_session.query(M.Part).count())
+        # Attributes of other AttrTypes are kept
+        self.assertEqual(('Celeron', {'Frequency': '1700', 'L2 cache': '256', 'Release date': '2002'}),
+                         self._get_attrs('Celeron 1.7'))
+        self.assertEqual(['Celeron 1.7'],
+                         [part.name for part in M.Part.query_by_attr_range('L2 cache', 200, 300)
+                          if part.name.startswith('Celeron')])
+
+    def test_delete_imported_part(self):
+        wikipedia.upsert_records([{'name': 'P4', 'Frequency': '1300'}], 'Pentium 4')
+        part = M.Part.search('P4')
+        for attr_map in part.attr_maps:
+            M.db_session.delete(attr_map)
+        M.db_session.delete(part)
+        M.db_session.flush()
+        self.assertEqual([], M.db_session.execute(M.imported_part.select()).fetchall())
+
+    def test_upsert_records(self):
+        rows = [{'name': 'P4', 'Frequency': '1300'}, {'name': 'P4', 'Frequency': '1400'},
+                {'name': 'P4 HT', 'Frequency': '3000'}]
+        # Counted per distinct name, the last row of P4 is used
+        self.assertEqual((2, 0, 0), wikipedia.upsert_records(rows, 'Pentium 4'))
+        self.assertEqual('1400', self._get_attrs('P4')[1]['Frequency'])
+        # A Part with the same name but another parent is a different Part
+        self.assertEqual((1, 0, 0), wikipedia.upsert_records(rows[:1], 'Celeron'))
+        self.assertEqual((0, 1, 1), wikipedia.upsert_records(rows[:1] + rows[2:], 'Pentium 4'))
+        self.assertEqual('1300', M.db_session.query(M.Attr).join(M.PartAttrMap).join(M.Part).
+                         filter(M.Part.name=='P4', M.Part.parent_part.has(name='Pentium 4')).
+                         one().value)
+        # The replaced attribute isn't used by any Part anymore
+        self.assertEqual(0, M.db_session.query(M.Attr).filter_by(value='1400').count())